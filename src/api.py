@@ -1,19 +1,151 @@
-from flask import Flask, request, jsonify, render_template
-from database import DatabaseManager
+from flask import Flask, request, jsonify, render_template, make_response
+from database import DatabaseManager, segment_id_for_way
+import atexit
 import os
-import random
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from sqlalchemy import text
-from speed_prediction import fetch_pems_speed, predict_next_speeds
-
-# simple in-memory store for previous coordinates keyed by client address.
-# Each client id maps to a deque holding the last 15 coordinates.
-previous_coords = {}
+from speed_prediction import predict_next_speeds, predict_station_speeds, synthetic_speeds
+from pems_poller import PemsPoller
+from spatial_index import SpatialIndex
+from lookup_cache import CachedLookup, LookupCache, ThrottledRevision
+from polyline import band_for_zoom
+from probe_writer import ProbeWriter
+from client_state import create_client_state_store
+from speed_rollups import time_bucket
+from topology import RoadGraph
+from api_helpers import (
+    POLYLINE_ENCODERS, TOPOLOGY_DIRECTIONS, cached_suggestions, chain_fields, corridor_fields,
+    encode_segments_page, fill_suggestions, motion_heading, parse_bbox, parse_chain_request,
+    parse_lookahead, parse_probe, parse_traversal, rollup_keys, suggestion_fields, traversal_fields,
+    way_fields,
+)
+from metrics import (
+    MetricsRegistry, SamplingProfiler, instrument_engine, instrument_flask, instrument_methods,
+)
 
 app = Flask(__name__, template_folder='templates')
 db_manager = DatabaseManager()
 
+# Request latency, SQL timings, pool usage and cache statistics for GET /metrics
+metrics = MetricsRegistry()
+profiler = SamplingProfiler(
+    threshold=float(os.getenv('PROFILE_SLOW_REQUESTS_MS', 500)) / 1000,
+    interval=float(os.getenv('PROFILE_INTERVAL_MS', 5)) / 1000,
+)
+if os.getenv('PROFILE_ENABLED', '').lower() in ('1', 'true', 'yes'):
+    profiler.configure(True)
+# Token required to toggle the profiler remotely; without it only localhost may
+PROFILER_TOKEN = os.getenv('PROFILER_TOKEN')
+instrument_flask(app, metrics, profiler)
+instrument_engine(db_manager.engine, metrics)
+# COPY-based writes use raw connections, which engine events do not see
+instrument_methods(
+    db_manager, metrics,
+    ['store_user_data_batch', 'update_user_data_segments', 'rebuild_speed_rollups'],
+    'db_method_duration_seconds', 'DatabaseManager call time',
+)
+
+# Recent coordinates per client address, used to estimate the travel direction
+client_state = create_client_state_store()
+
+# Upper bound on coordinates per /api/lanes/batch request
+MAX_BATCH_POINTS = int(os.getenv('MAX_BATCH_POINTS', 1000))
+
+# Upper bound on the road returned by /api/lanes/ahead
+LOOKAHEAD_MAX_KM = float(os.getenv('LOOKAHEAD_MAX_KM', 50))
+
+# Nearest-way lookups go to PostGIS ('sql') or an in-memory index ('memory')
+LOOKUP_BACKEND = os.getenv('LOOKUP_BACKEND', 'sql')
+if LOOKUP_BACKEND == 'memory':
+    lookup = SpatialIndex(db_manager)
+    if os.getenv('LOOKUP_SNAPSHOT'):
+        lookup.load_snapshot(os.getenv('LOOKUP_SNAPSHOT'))
+    else:
+        lookup.load()
+    lookup.start_auto_refresh(float(os.getenv('LOOKUP_REFRESH_SECONDS', 30)))
+else:
+    lookup = db_manager
+
+# Quantized-coordinate cache in front of the lookup backend (size 0 disables it)
+LOOKUP_CACHE_SIZE = int(os.getenv('LOOKUP_CACHE_SIZE', 100000))
+lookup_cache = None
+if LOOKUP_CACHE_SIZE > 0:
+    lookup_cache = LookupCache(
+        max_size=LOOKUP_CACHE_SIZE,
+        ttl=float(os.getenv('LOOKUP_CACHE_TTL', 300)),
+    )
+    # The in-memory index is fast enough to cache exact coordinates and
+    # tracks its own revision; PostGIS lookups share cells and poll it
+    lookup = CachedLookup(
+        lookup, lookup_cache,
+        precision=None if LOOKUP_BACKEND == 'memory' else float(os.getenv('LOOKUP_CACHE_PRECISION', 1e-4)),
+        candidates=int(os.getenv('LOOKUP_CACHE_CANDIDATES', 32)),
+        revision_source=None if LOOKUP_BACKEND == 'memory' else ThrottledRevision(
+            db_manager.get_network_revision, float(os.getenv('LOOKUP_REVISION_SECONDS', 5))
+        ),
+    )
+    db_manager.add_change_listener(lookup_cache.invalidate)
+
+# Upper bound on stations per /api/recommended_speeds request
+MAX_STATIONS = int(os.getenv('MAX_STATIONS', 5000))
+# Stations are fetched from PeMS concurrently
+pems_executor = ThreadPoolExecutor(max_workers=int(os.getenv('PEMS_FETCH_WORKERS', 16)))
+
+# PeMS data is polled in the background and served from a TTL cache
+pems_poller = PemsPoller(
+    interval=float(os.getenv('PEMS_POLL_SECONDS', 30)),
+    ttl=float(os.getenv('PEMS_CACHE_TTL', 60)),
+    stale_ttl=float(os.getenv('PEMS_STALE_TTL', 600)),
+    failure_ttl=float(os.getenv('PEMS_FAILURE_TTL', 30)),
+    history=int(os.getenv('PEMS_HISTORY', 30)),
+    workers=int(os.getenv('PEMS_FETCH_WORKERS', 16)),
+)
+if os.getenv('PEMS_WATCH_STATIONS'):
+    pems_poller.watch(int(s) for s in os.getenv('PEMS_WATCH_STATIONS').split(',') if s.strip())
+pems_poller.start()
+atexit.register(pems_poller.stop)
+
+# Speed rollup summaries, keyed by (segment_id, lane_index, hour-of-week bucket)
+rollup_cache = LookupCache(
+    max_size=int(os.getenv('ROLLUP_CACHE_SIZE', 100000)),
+    ttl=float(os.getenv('ROLLUP_CACHE_TTL', 30)),
+)
+
+# Serialized /segments pages, keyed by network revision and query parameters
+SEGMENTS_PAGE_SIZE = int(os.getenv('SEGMENTS_PAGE_SIZE', 1000))
+SEGMENTS_MAX_PAGE_SIZE = int(os.getenv('SEGMENTS_MAX_PAGE_SIZE', 10000))
+segments_cache = LookupCache(
+    max_size=int(os.getenv('SEGMENTS_CACHE_SIZE', 256)),
+    ttl=float(os.getenv('SEGMENTS_CACHE_TTL', 3600)),
+)
+# Read at most once per SEGMENTS_REVISION_TTL instead of on every page request
+segments_revision = ThrottledRevision(
+    db_manager.get_network_revision, float(os.getenv('SEGMENTS_REVISION_TTL', 1))
+)
+
+# Probes from POST /speed are written behind the request in batches
+probe_writer = ProbeWriter(
+    db_manager,
+    batch_size=int(os.getenv('PROBE_BATCH_SIZE', 500)),
+    flush_interval=float(os.getenv('PROBE_FLUSH_SECONDS', 1.0)),
+    max_queue=int(os.getenv('PROBE_QUEUE_SIZE', 50000)),
+    max_retries=int(os.getenv('PROBE_MAX_RETRIES', 5)),
+)
+atexit.register(probe_writer.close)
+
+# Way connectivity for /api/topology, built on first use and updated on ingest
+road_graph = RoadGraph(db_manager, debounce=float(os.getenv('TOPOLOGY_DEBOUNCE_SECONDS', 1)))
+road_graph.start_auto_refresh(float(os.getenv('TOPOLOGY_REFRESH_SECONDS', 60)))
+
+if lookup_cache is not None:
+    metrics.register_stats('lookup_cache', lookup_cache.stats)
+metrics.register_stats('rollup_cache', rollup_cache.stats)
+metrics.register_stats('segments_cache', segments_cache.stats)
+metrics.register_stats('probe_writer', probe_writer.stats)
+metrics.register_stats('client_state', client_state.stats)
+metrics.register_stats('pems', pems_poller.metrics)
+metrics.register_stats('road_graph', road_graph.stats)
+
 @app.route('/')
 def index():
     """Serve the main HTML page"""
@@ -45,54 +177,150 @@ def get_lanes():
                 'message': 'Both lat and lon parameters are required'
             }), 400
             
-        # Get lanes information
-        lanes, lanes_forward, lanes_backward, distance = db_manager.get_lanes_at_coordinate(
-            lat, lon, max_distance
-        )
+        # Get lanes and way information in a single lookup
+        way_info = lookup.get_nearest_way(lat, lon, max_distance)
         
-        if lanes is None:
+        if way_info is None or way_info.lanes is None:
             return jsonify({
                 'found': False,
                 'message': 'No road found within the specified distance'
             })
         
         # Determine direction using moving average of the last 15 requests
-        client_id = request.remote_addr
-        history = previous_coords.setdefault(client_id, deque(maxlen=15))
-        history.append({'lat': lat, 'lon': lon})
+        motion = client_state.record(request.remote_addr, lat, lon)
 
         direction = None
-        if len(history) > 1:
-            lat_diffs = [history[i + 1]['lat'] - history[i]['lat'] for i in range(len(history) - 1)]
-            avg_lat_diff = sum(lat_diffs) / len(lat_diffs)
+        if motion is not None:
+            avg_lat_diff = motion[0]
             direction = 'north' if avg_lat_diff > 0 else 'south'
 
-        # Get additional information about the way
-        way_info = db_manager.get_nearest_way(lat, lon, max_distance)
+        return jsonify({**way_fields(way_info), 'direction': direction})
         
+    except Exception as e:
         return jsonify({
-            'found': True,
-            'lanes': lanes,
-            'lanes_forward': lanes_forward,
-            'lanes_backward': lanes_backward,
-            'distance': distance,
-            'distance_km': distance * 111.0,  # Approximate conversion to kilometers
-            'way_id': way_info.way_id,
-            'highway_type': way_info.highway_type,
-            'name': way_info.name,
-            'maxspeed': way_info.maxspeed,
-            'direction': direction
-        })
-        
+            'error': 'Server error',
+            'message': str(e)
+        }), 500
+
+@app.route('/api/lanes/batch', methods=['POST'])
+def get_lanes_batch():
+    """
+    Get lane information for many coordinates in one request.
+    
+    JSON body:
+    - points: List of {"lat": ..., "lon": ..., "errordist": ...} objects
+      (errordist is optional per point)
+    - errordist: Default maximum search distance in degrees (optional, default: 0.001)
+    
+    Returns:
+    JSON with one result per point, in request order
+    """
+    data = request.get_json(silent=True) or {}
+    points = data.get('points')
+    default_distance = data.get('errordist', 0.001)
+
+    if not isinstance(points, list):
+        return jsonify({
+            'error': 'Missing parameters',
+            'message': 'A list of points is required'
+        }), 400
+    if len(points) > MAX_BATCH_POINTS:
+        return jsonify({
+            'error': 'Too many points',
+            'message': f'At most {MAX_BATCH_POINTS} points are allowed per request'
+        }), 400
+
+    try:
+        coords = [(float(p['lat']), float(p['lon'])) for p in points]
+        max_distances = [float(p.get('errordist', default_distance)) for p in points]
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return jsonify({
+            'error': 'Invalid parameters',
+            'message': 'Every point needs numeric lat and lon values'
+        }), 400
+
+    try:
+        ways = lookup.get_nearest_ways(coords, max_distances)
     except Exception as e:
         return jsonify({
             'error': 'Server error',
             'message': str(e)
         }), 500
 
+    results = [way_fields(way) if way is not None else {'found': False} for way in ways]
+    return jsonify({'results': results})
+
+@app.route('/api/lanes/ahead', methods=['GET'])
+def get_lanes_ahead():
+    """
+    Lanes, maxspeed and geometry of the road ahead, so clients can stop polling.
+    
+    Query parameters:
+    - lat, lon: Current position (required)
+    - heading: Direction of travel in compass degrees (optional, estimated
+      from this client's recent requests when missing)
+    - distance_km: Length of road to return (optional, default: 5)
+    - errordist: Maximum search distance in degrees (optional, default: 0.001)
+    - encoding: Polyline format, json, encoded or delta (optional, default: encoded)
+    
+    Returns:
+    JSON with the ways ahead in driving order, each with its lane tags, the
+    lanes in the direction of travel, maxspeed, distance range along the
+    corridor in meters and traveled polyline, plus the corridor bbox.
+    Clients resolve lanes locally until they leave the corridor.
+    """
+    try:
+        lat, lon, heading, distance_km, max_distance, encoding = parse_lookahead(request.args, LOOKAHEAD_MAX_KM)
+    except ValueError as e:
+        return jsonify({'error': 'Invalid parameters', 'message': str(e)}), 400
+
+    try:
+        way_info = lookup.get_nearest_way(lat, lon, max_distance)
+        motion = client_state.record(request.remote_addr, lat, lon)
+        if heading is None:
+            heading = motion_heading(motion, lat)
+        corridor = []
+        if way_info is not None:
+            road_graph.ensure_loaded()
+            if way_info.way_id in road_graph:
+                corridor = road_graph.corridor(way_info.way_id, lat, lon, heading, distance_km * 1000)
+    except Exception as e:
+        return jsonify({'error': 'Server error', 'message': str(e)}), 500
+
+    if not corridor:
+        return jsonify({
+            'found': False,
+            'message': 'No road found within the specified distance'
+        })
+    return jsonify(corridor_fields(road_graph, corridor, heading, encoding))
+
+def _speed_suggestions(keys):
+    """
+    Rollup summaries for (segment_id, lane_index, bucket) keys.
+    
+    Cached summaries are served directly; the rest are read from
+    speed_rollups in one query.
+    """
+    summaries, missing = cached_suggestions(rollup_cache, keys)
+    if not missing:
+        return summaries
+    rollups = db_manager.get_speed_rollups(rollup_keys(missing))
+    return fill_suggestions(rollup_cache, keys, summaries, missing, rollups)
+
 @app.route('/api/suggested_speed', methods=['GET'])
 def suggested_speed():
-    """Return a random suggested speed for now."""
+    """
+    Suggest a speed for a lane at a coordinate.
+    
+    Query parameters:
+    - lat, lon: Coordinate (required)
+    - lane: Lane index (required)
+    
+    Returns:
+    JSON with the median probe speed for the nearest segment and lane at
+    this hour of the week (or all-time, if the hour has few probes),
+    falling back to the posted maxspeed when no probes were stored.
+    """
     lat = request.args.get('lat', type=float)
     lon = request.args.get('lon', type=float)
     lane = request.args.get('lane', type=int)
@@ -100,9 +328,30 @@ def suggested_speed():
     if lat is None or lon is None or lane is None:
         return jsonify({'error': 'Missing parameters'}), 400
 
-    speed = random.randint(0, 60)
-    return jsonify({'suggested_speed': speed})
+    try:
+        way = lookup.get_nearest_way(lat, lon)
+        if way is None:
+            return jsonify({'error': 'No segment found'}), 404
+        segment_id = segment_id_for_way(way.way_id)
+        summary = _speed_suggestions([(segment_id, lane, time_bucket(datetime.utcnow()))])[0]
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    speed, confidence = suggestion_fields(summary, way)
+    return jsonify({
+        'suggested_speed': speed,
+        'confidence': confidence,
+        'segment_id': segment_id,
+        'stats': summary,
+    })
+
 
+def _station_speeds(station_id):
+    """Cached lane history for a station, or synthetic speeds if PeMS is unreachable."""
+    cached = pems_poller.get(station_id)
+    if cached is None:
+        return synthetic_speeds()
+    return cached[0]
 
 @app.route('/api/recommended_speed', methods=['GET'])
 def recommended_speed():
@@ -112,48 +361,104 @@ def recommended_speed():
         return jsonify({'error': 'Missing station_id'}), 400
 
     try:
-        current_speeds = fetch_pems_speed(station_id)
-        predictions = predict_next_speeds(current_speeds, horizon=30)
+        current_speeds = _station_speeds(station_id)
+        predictions = predict_next_speeds(
+            current_speeds, horizon=30, sample_interval=pems_poller.interval
+        )
     except Exception as exc:
         return jsonify({'error': str(exc)}), 500
 
     return jsonify({'station_id': station_id, 'recommendations': predictions})
 
+@app.route('/api/recommended_speeds', methods=['GET', 'POST'])
+def recommended_speeds():
+    """
+    Return predicted lane speeds for many stations in one call.
+    
+    Query parameters (GET):
+    - station_ids: Comma-separated station IDs
+    
+    JSON body (POST):
+    - station_ids: List of station IDs
+    - horizon: Seconds to predict (optional, default: 30)
+    
+    Returns:
+    JSON mapping each station ID to the same per-lane recommendations as
+    /api/recommended_speed. All lanes are fit in one batched pass.
+    """
+    try:
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            station_ids = [int(station) for station in data.get('station_ids') or []]
+            horizon = int(data.get('horizon', 30))
+        else:
+            raw = request.args.get('station_ids', '')
+            station_ids = [int(part) for part in raw.split(',') if part.strip()]
+            horizon = request.args.get('horizon', default=30, type=int)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'station_ids must be integers'}), 400
+
+    if not station_ids:
+        return jsonify({'error': 'Missing station_ids'}), 400
+    if len(station_ids) > MAX_STATIONS:
+        return jsonify({'error': f'At most {MAX_STATIONS} stations are allowed per request'}), 400
+    if not 0 < horizon <= 3600:
+        return jsonify({'error': 'horizon must be between 1 and 3600'}), 400
+
+    station_ids = list(dict.fromkeys(station_ids))
+    try:
+        current = dict(zip(station_ids, pems_executor.map(_station_speeds, station_ids)))
+        predictions = predict_station_speeds(
+            current, horizon=horizon, sample_interval=pems_poller.interval
+        )
+    except Exception as exc:
+        return jsonify({'error': str(exc)}), 500
+
+    return jsonify({
+        'horizon': horizon,
+        'recommendations': {str(station): lanes for station, lanes in predictions.items()},
+    })
+
+@app.route('/api/pems/metrics', methods=['GET'])
+def pems_metrics():
+    """PeMS cache freshness and fetch failure counters."""
+    return jsonify(pems_poller.metrics())
+
+def _queue_full_response():
+    response = jsonify({'error': 'Ingestion queue full, retry later'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, int(probe_writer.flush_interval)))
+    return response
+
 @app.route('/speed', methods=['POST'])
 def post_speed():
-    data = request.get_json()
-    lat = data.get('lat')
-    lon = data.get('lon')
-    timestamp = data.get('timestamp')
-    speed = data.get('speed')
-    lane_index = data.get('lane_index')
+    data = request.get_json(silent=True)
 
     # Validate input
-    if None in (lat, lon, timestamp, speed, lane_index):
-        return jsonify({'error': 'Missing required fields'}), 400
+    try:
+        lat, lon, row = parse_probe(data)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
 
     # Find nearest segment (way)
-    way = db_manager.get_nearest_way(lat, lon)
+    way = lookup.get_nearest_way(lat, lon)
     if not way:
         return jsonify({'error': 'No segment found'}), 404
 
-    # For demo, create a fake segment id and confidence
-    matched_segment_id = f"680N-{way.way_id}"
-    suggested_speed = 77  # Placeholder logic
-    confidence = 0.94     # Placeholder logic
-
-    # Store user data
+    # Nearest-way snap; map_matching.py refines stored probes offline
+    matched_segment_id = segment_id_for_way(way.way_id)
     try:
-        db_manager.store_user_data({
-            'lat': lat,
-            'lon': lon,
-            'timestamp': datetime.fromisoformat(timestamp),
-            'speed': speed,
-            'lane_index': lane_index,
-            'segment_id': matched_segment_id,
-        })
+        summary = _speed_suggestions(
+            [(matched_segment_id, row['lane_index'], time_bucket(row['timestamp']))]
+        )[0]
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    suggested_speed, confidence = suggestion_fields(summary, way)
+
+    # Queue user data; it is written to user_data in the background
+    row['segment_id'] = matched_segment_id
+    if not probe_writer.submit([row]):
+        return _queue_full_response()
 
     return jsonify({
         'suggested_speed': suggested_speed,
@@ -161,47 +466,250 @@ def post_speed():
         'confidence': confidence
     })
 
+@app.route('/speed/batch', methods=['POST'])
+def post_speed_batch():
+    """
+    Submit several speed probes in one request.
+    
+    JSON body:
+    - probes: List of objects with the same fields as POST /speed
+    
+    Returns:
+    JSON with one result per probe, in request order. Probes without a
+    nearby segment are not stored. Responds 503 with Retry-After when the
+    ingestion queue is full; no probe of the request is stored then.
+    """
+    data = request.get_json(silent=True) or {}
+    probes = data.get('probes')
+
+    if not isinstance(probes, list):
+        return jsonify({'error': 'A list of probes is required'}), 400
+    if len(probes) > MAX_BATCH_POINTS:
+        return jsonify({
+            'error': f'At most {MAX_BATCH_POINTS} probes are allowed per request'
+        }), 400
+
+    try:
+        parsed = [parse_probe(probe) for probe in probes]
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid probe: {e}'}), 400
+
+    try:
+        ways = lookup.get_nearest_ways([(lat, lon) for lat, lon, _ in parsed])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    rows = []
+    matched_ways = []
+    for (_, _, row), way in zip(parsed, ways):
+        if way is not None:
+            row['segment_id'] = segment_id_for_way(way.way_id)
+            rows.append(row)
+            matched_ways.append(way)
+
+    try:
+        summaries = iter(_speed_suggestions([
+            (row['segment_id'], row['lane_index'], time_bucket(row['timestamp'])) for row in rows
+        ]))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    results = []
+    matched = iter(zip(rows, matched_ways))
+    for way in ways:
+        if way is None:
+            results.append({'error': 'No segment found'})
+            continue
+        row, way = next(matched)
+        speed, confidence = suggestion_fields(next(summaries), way)
+        results.append({
+            'suggested_speed': speed,
+            'matched_segment_id': row['segment_id'],
+            'confidence': confidence,
+        })
+
+    if rows and not probe_writer.submit(rows):
+        return _queue_full_response()
+
+    return jsonify({'accepted': len(rows), 'results': results})
+
 @app.route('/segments', methods=['GET'])
 def get_segments():
-    session = db_manager.Session()
-    segments = []
-    try:
-        # Only select Sinclair Freeway segments
-        ways = session.execute(
-            text("""SELECT way_id, name FROM ways WHERE name ILIKE '%Sinclair%'""")
-        ).fetchall()
-        if not ways:
-            return jsonify([])  # Return empty list if no segments found
-        for way in ways:
-            nodes = session.execute(
-                text("""SELECT n.lat, n.lon FROM nodes n
-                          JOIN way_nodes wn ON n.node_id = wn.node_id
-                          WHERE wn.way_id = :way_id
-                          ORDER BY wn.sequence"""),
-                {'way_id': way.way_id}
-            ).fetchall()
-            polyline = [[n.lat, n.lon] for n in nodes]
-            segments.append({
-                'id': f"Sinclair-{way.way_id}",
-                'lane_index': 2,
-                'polyline': polyline,
-                'mile_range': [12.3, 12.8]
-            })
-        return jsonify(segments)
+    """
+    Get road segment polylines for map display.
+    
+    Query parameters:
+    - name: Only ways whose name contains this text (optional, default: Sinclair;
+      pass an empty value for all ways)
+    - bbox: min_lon,min_lat,max_lon,max_lat viewport filter (optional)
+    - after: Return ways with way_id greater than this, for paging (optional)
+    - limit: Page size (optional, default: SEGMENTS_PAGE_SIZE)
+    - zoom: Map zoom level; geometry is simplified for the zoom band (optional,
+      default: full resolution)
+    - format: Polyline encoding, one of json ([[lat, lon], ...]), encoded
+      (Google encoded polyline string) or delta (flat delta-quantized integers
+      at 1e-5 degrees) (optional, default: json)
+    
+    Returns:
+    JSON list of segments. When more ways are available the X-Next-After
+    header holds the value to pass as `after` for the next page. Responses
+    carry an ETag, honour If-None-Match and are gzip-compressed when the
+    client accepts it.
+    """
+    name = request.args.get('name', default='Sinclair')
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', default=SEGMENTS_PAGE_SIZE, type=int)
+    zoom = request.args.get('zoom', type=int)
+    encoding = request.args.get('format', default='json')
+    if encoding not in POLYLINE_ENCODERS:
+        return jsonify({
+            'error': 'Invalid format',
+            'message': f"format must be one of {', '.join(POLYLINE_ENCODERS)}"
+        }), 400
+    band = band_for_zoom(zoom)
+    try:
+        bbox = parse_bbox(request.args['bbox']) if request.args.get('bbox') else None
+    except ValueError as e:
+        return jsonify({'error': 'Invalid bbox', 'message': str(e)}), 400
+    limit = max(1, min(limit, SEGMENTS_MAX_PAGE_SIZE))
+
+    try:
+        # The revision changes on every load, so it versions the cached payload
+        key = (segments_revision.current(), name, bbox, after, limit, band, encoding)
+        cached = segments_cache.get(key)
+        if cached is None:
+            rows = db_manager.get_segment_polylines(
+                name=name or None, bbox=bbox, after=after, limit=limit, band=band
+            )
+            # Compress once per page; every later hit reuses the bytes
+            cached = encode_segments_page(rows, name, encoding, limit)
+            segments_cache.put(key, cached)
     except Exception as e:
         print(f"Error in /segments: {e}")
         return jsonify({'error': str(e)}), 500
-    finally:
-        session.close()
+
+    etag, body, gzipped, next_after = cached
+    use_gzip = 'gzip' in request.accept_encodings
+    if use_gzip:
+        etag += '-gz'
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(gzipped if use_gzip else body)
+        response.mimetype = 'application/json'
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if next_after is not None:
+        response.headers['X-Next-After'] = str(next_after)
+    return response
+
+@app.route('/api/topology/<direction>', methods=['GET'])
+def traverse_topology(direction):
+    """
+    Ways downstream or upstream of a way, nearest first.
+    
+    Query parameters:
+    - way_id: Way to start from (required)
+    - max_distance: Search radius along the road in meters (optional, default: 10000)
+    - limit: Maximum ways returned (optional, default: 100)
+    - same_name: Only follow ways with the start way's name, e.g. one freeway (optional)
+    
+    Returns:
+    JSON with the reached ways, each with the distance in meters from the
+    end (downstream) or start (upstream) of the way, its length and lanes.
+    """
+    if direction not in TOPOLOGY_DIRECTIONS:
+        return jsonify({'error': 'direction must be downstream or upstream'}), 404
+    try:
+        way_id, max_distance, limit, same_name = parse_traversal(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        road_graph.ensure_loaded()
+        if way_id not in road_graph:
+            return jsonify({'error': 'Unknown way_id'}), 404
+        traverse = road_graph.downstream if direction == 'downstream' else road_graph.upstream
+        reached = traverse(way_id, max_distance=max_distance, limit=limit, same_name=same_name)
+        return jsonify(traversal_fields(road_graph, way_id, reached))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/topology/chains', methods=['POST'])
+def topology_chains():
+    """
+    Order ways into connected chains in the direction of travel.
+    
+    Body: JSON {"way_ids": [...]}, or the OSM XML of a route relation
+    (e.g. data/156071.xml) whose way members are chained.
+    
+    Returns:
+    JSON with the chains (way IDs in order, total length in meters and road
+    names) and the requested ways missing from the network.
+    """
+    try:
+        xml = None if request.is_json else request.get_data(as_text=True)
+        way_ids = parse_chain_request(request.get_json(silent=True), xml)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        road_graph.ensure_loaded()
+        return jsonify(chain_fields(road_graph, way_ids))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Simple health check endpoint"""
     return jsonify({
         'status': 'healthy',
-        'message': 'OSM Lanes API is running'
+        'message': 'OSM Lanes API is running',
+        'lookup_backend': LOOKUP_BACKEND,
+        'lookup_cache': lookup_cache.stats() if lookup_cache is not None else None,
+        'probe_writer': probe_writer.stats(),
+        'client_state': client_state.stats(),
     })
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition of request, SQL, pool and cache metrics."""
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+def _profiler_allowed():
+    if PROFILER_TOKEN:
+        return request.headers.get('X-Profiler-Token') == PROFILER_TOKEN
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+@app.route('/metrics/profiler', methods=['GET', 'POST'])
+def sampling_profiler():
+    """
+    Slow-request profiles, and runtime control of the sampling profiler.
+
+    POST {"enabled": true, "threshold_ms": 250, "interval_ms": 5} turns it on;
+    {"enabled": false} turns it off. Collected profiles are kept.
+    """
+    if not _profiler_allowed():
+        return jsonify({'error': 'Forbidden'}), 403
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            threshold = data.get('threshold_ms')
+            interval = data.get('interval_ms')
+            profiler.configure(
+                bool(data.get('enabled', True)),
+                threshold=float(threshold) / 1000 if threshold is not None else None,
+                interval=float(interval) / 1000 if interval is not None else None,
+            )
+        except (TypeError, ValueError):
+            return jsonify({'error': 'threshold_ms and interval_ms must be numbers'}), 400
+    return jsonify(profiler.report())
+
 if __name__ == '__main__':
     # Get port from environment or use 5000 as default
     port = int(os.getenv('PORT', 5000))
@@ -0,0 +1,283 @@
+import gzip
+import hashlib
+import json
+import math
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from parser import extract_way_ids_from_relation
+from polyline import encode_deltas, encode_polyline
+from speed_rollups import ALL_TIME_BUCKET, pick_rollup
+
+# Shared by the Flask app (api.py) and the asyncio server (async_api.py)
+
+# Polyline encodings offered by /segments
+POLYLINE_ENCODERS = {
+    'json': lambda coords: coords,
+    'encoded': encode_polyline,
+    'delta': encode_deltas,
+}
+
+REQUIRED_PROBE_FIELDS = ('lat', 'lon', 'timestamp', 'speed', 'lane_index')
+# user_data.lane_index is an integer column
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+
+# /api/topology traversal defaults and bounds
+TOPOLOGY_DIRECTIONS = ('downstream', 'upstream')
+DEFAULT_TRAVERSAL_DISTANCE = 10000.0
+MAX_TRAVERSAL_WAYS = 1000
+
+# /api/lanes/ahead corridor length in kilometres
+DEFAULT_LOOKAHEAD_KM = 5.0
+
+_NO_ROLLUP = object()
+
+
+def way_fields(way: Any) -> Dict[str, Any]:
+    """Lane and way attributes reported for a nearest-way match."""
+    return {
+        'found': True,
+        'lanes': way.lanes,
+        'lanes_forward': way.lanes_forward,
+        'lanes_backward': way.lanes_backward,
+        'distance': way.distance,
+        'distance_km': way.distance * 111.0,  # Approximate conversion to kilometers
+        'way_id': way.way_id,
+        'highway_type': way.highway_type,
+        'name': way.name,
+        'maxspeed': way.maxspeed,
+    }
+
+
+def maxspeed_value(maxspeed: Any) -> Optional[float]:
+    """Numeric part of an OSM maxspeed tag such as '65 mph', or None."""
+    try:
+        return float(str(maxspeed).split()[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def suggestion_fields(summary: Optional[Dict[str, Any]], way: Any) -> Tuple[Optional[float], float]:
+    """suggested_speed and confidence from a rollup summary, else the way's maxspeed."""
+    if summary is not None:
+        samples = summary['samples']
+        return round(summary['p50'], 1), round(samples / (samples + 20.0), 2)
+    return maxspeed_value(way.maxspeed), 0.0
+
+
+def cached_suggestions(
+    cache: Any, keys: Sequence[Tuple[str, int, int]]
+) -> Tuple[List[Any], List[Tuple[str, int, int]]]:
+    """
+    Rollup summaries already in ``cache``, and the keys still to fetch.
+
+    Fetch the rollups for ``rollup_keys(missing)`` and finish with
+    ``fill_suggestions``.
+    """
+    summaries = [cache.get(key, _NO_ROLLUP) for key in keys]
+    missing = list(dict.fromkeys(key for key, summary in zip(keys, summaries) if summary is _NO_ROLLUP))
+    return summaries, missing
+
+
+def rollup_keys(missing: Sequence[Tuple[str, int, int]]) -> List[Tuple[str, int, int]]:
+    """Rollup rows needed for ``missing``: each hourly key and its all-time fallback."""
+    wanted = list(missing) + [(segment_id, lane, ALL_TIME_BUCKET) for segment_id, lane, _ in missing]
+    return list(dict.fromkeys(wanted))
+
+
+def fill_suggestions(
+    cache: Any,
+    keys: Sequence[Tuple[str, int, int]],
+    summaries: List[Any],
+    missing: Sequence[Tuple[str, int, int]],
+    rollups: Dict[Tuple[str, int, int], Any],
+) -> List[Optional[Dict[str, Any]]]:
+    for key in missing:
+        cache.put(key, pick_rollup(rollups, *key))
+    return [
+        cache.get(key) if summary is _NO_ROLLUP else summary
+        for key, summary in zip(keys, summaries)
+    ]
+
+
+def parse_probe(data: Any) -> Tuple[float, float, Dict[str, Any]]:
+    """Validate one probe payload and return (lat, lon, row without segment_id)."""
+    if not isinstance(data, dict) or any(data.get(field) is None for field in REQUIRED_PROBE_FIELDS):
+        raise ValueError('Missing required fields')
+    lat = float(data['lat'])
+    lon = float(data['lon'])
+    speed = float(data['speed'])
+    # NaN/inf break the rollups and out-of-range lanes break the COPY,
+    # so reject them here rather than at write time
+    if not all(math.isfinite(value) for value in (lat, lon, speed)):
+        raise ValueError('lat, lon and speed must be finite numbers')
+    lane_index = int(data['lane_index'])
+    if not INT32_MIN <= lane_index <= INT32_MAX:
+        raise ValueError('lane_index is out of range')
+    device_id = data.get('device_id')
+    return lat, lon, {
+        'lat': lat,
+        'lon': lon,
+        'timestamp': datetime.fromisoformat(data['timestamp']),
+        'speed': speed,
+        'lane_index': lane_index,
+        'device_id': str(device_id)[:64] if device_id is not None else None,
+    }
+
+
+def parse_bbox(value: str) -> Tuple[float, float, float, float]:
+    """Parse a 'min_lon,min_lat,max_lon,max_lat' query parameter."""
+    parts = [float(part) for part in value.split(',')]
+    if len(parts) != 4:
+        raise ValueError('bbox must be min_lon,min_lat,max_lon,max_lat')
+    return tuple(parts)
+
+
+def encode_segments_page(
+    rows: Sequence[Any], name: Optional[str], encoding: str, limit: int
+) -> Tuple[str, bytes, bytes, Optional[int]]:
+    """
+    Serialize a /segments page once.
+
+    Returns (etag, body, gzipped body, next ``after`` value or None).
+    """
+    label = name or 'way'
+    encode = POLYLINE_ENCODERS[encoding]
+    segments = [{
+        'id': f"{label}-{row.way_id}",
+        'lane_index': 2,
+        'polyline': encode(row.polyline),
+        'mile_range': [12.3, 12.8]
+    } for row in rows]
+    body = json.dumps(segments, separators=(',', ':')).encode('utf-8')
+    next_after = rows[-1].way_id if len(rows) == limit else None
+    return hashlib.sha1(body).hexdigest(), body, gzip.compress(body), next_after
+
+
+def parse_traversal(args: Any) -> Tuple[int, float, int, bool]:
+    """
+    Parse /api/topology/<direction> query parameters.
+
+    Returns (way_id, max_distance in meters, limit, same_name).
+    """
+    way_id = args.get('way_id')
+    if way_id is None:
+        raise ValueError('Missing way_id')
+    max_distance = float(args.get('max_distance', DEFAULT_TRAVERSAL_DISTANCE))
+    limit = int(args.get('limit', 100))
+    if max_distance <= 0 or not 0 < limit <= MAX_TRAVERSAL_WAYS:
+        raise ValueError(f'max_distance must be positive and limit between 1 and {MAX_TRAVERSAL_WAYS}')
+    same_name = str(args.get('same_name', '')).lower() in ('1', 'true', 'yes')
+    return int(way_id), max_distance, limit, same_name
+
+
+def traversal_fields(graph: Any, way_id: int, reached: Sequence[Any]) -> Dict[str, Any]:
+    """Response body for a traversal: each reached way with its lane attributes."""
+    ways = []
+    for item in reached:
+        way = graph.way(item.way_id)
+        ways.append({
+            'way_id': item.way_id,
+            'distance_m': round(item.distance, 1),
+            'node_id': item.node_id,
+            'length_m': round(graph.way_length(item.way_id), 1),
+            'lanes': way[1],
+            'lanes_forward': way[2],
+            'lanes_backward': way[3],
+            'highway_type': way[4],
+            'name': way[5],
+            'maxspeed': way[6],
+        })
+    return {'way_id': way_id, 'ways': ways}
+
+
+def parse_chain_request(data: Any, xml: Optional[str] = None) -> List[int]:
+    """Way IDs for /api/topology/chains from a JSON body or relation XML."""
+    if xml:
+        return extract_way_ids_from_relation(xml)
+    if not isinstance(data, dict) or not isinstance(data.get('way_ids'), list):
+        raise ValueError('A list of way_ids or a relation XML body is required')
+    return [int(way_id) for way_id in data['way_ids']]
+
+
+def chain_fields(graph: Any, way_ids: Sequence[int]) -> Dict[str, Any]:
+    chains = graph.chains(way_ids)
+    return {
+        'chains': [{
+            'way_ids': chain,
+            'length_m': round(sum(graph.way_length(way_id) for way_id in chain), 1),
+            'names': list(dict.fromkeys(graph.way(way_id)[5] for way_id in chain if graph.way(way_id)[5])),
+        } for chain in chains],
+        'missing': [way_id for way_id in dict.fromkeys(way_ids) if way_id not in graph],
+    }
+
+
+def motion_heading(motion: Optional[Tuple[float, float]], lat: float) -> Optional[float]:
+    """Compass heading in degrees of a client's average (lat, lon) step, or None."""
+    if motion is None or (motion[0] == 0 and motion[1] == 0):
+        return None
+    return math.degrees(math.atan2(motion[1] * math.cos(math.radians(lat)), motion[0])) % 360
+
+
+def parse_lookahead(args: Any, max_km: float) -> Tuple[float, float, Optional[float], float, float, str]:
+    """
+    Parse /api/lanes/ahead query parameters.
+
+    Returns (lat, lon, heading or None, distance in km, errordist, encoding).
+    """
+    if args.get('lat') is None or args.get('lon') is None:
+        raise ValueError('Both lat and lon parameters are required')
+    lat = float(args['lat'])
+    lon = float(args['lon'])
+    heading = args.get('heading')
+    heading = float(heading) % 360 if heading not in (None, '') else None
+    distance_km = float(args.get('distance_km', DEFAULT_LOOKAHEAD_KM))
+    if not 0 < distance_km <= max_km:
+        raise ValueError(f'distance_km must be between 0 and {max_km:g}')
+    encoding = args.get('encoding', 'encoded')
+    if encoding not in POLYLINE_ENCODERS:
+        raise ValueError(f"encoding must be one of {', '.join(POLYLINE_ENCODERS)}")
+    return lat, lon, heading, distance_km, float(args.get('errordist', 0.001)), encoding
+
+
+def corridor_fields(
+    graph: Any, corridor: Sequence[Any], heading: Optional[float], encoding: str
+) -> Dict[str, Any]:
+    """
+    Response body for /api/lanes/ahead.
+
+    Every way of the corridor carries its lane tags, the lanes in the
+    direction of travel and the traveled geometry, so a client can match
+    its next fixes locally until it leaves the corridor.
+    """
+    encode = POLYLINE_ENCODERS[encoding]
+    ways = []
+    lats = []
+    lons = []
+    for item in corridor:
+        way = graph.way(item.way_id)
+        ways.append({
+            'way_id': item.way_id,
+            'direction': 'forward' if item.forward else 'backward',
+            'start_m': round(item.start, 1),
+            'end_m': round(item.end, 1),
+            'lanes': way[1],
+            'lanes_forward': way[2],
+            'lanes_backward': way[3],
+            'lanes_in_direction': item.lanes,
+            'highway_type': way[4],
+            'name': way[5],
+            'maxspeed': way[6],
+            'polyline': encode(item.coords),
+        })
+        lats.extend(lat for lat, _ in item.coords)
+        lons.extend(lon for _, lon in item.coords)
+    return {
+        'found': True,
+        'way_id': corridor[0].way_id,
+        'heading': heading,
+        'distance_m': round(corridor[-1].end, 1),
+        'bbox': [min(lons), min(lats), max(lons), max(lats)],
+        'encoding': encoding,
+        'ways': ways,
+    }
@@ -0,0 +1,633 @@
+import asyncio
+import inspect
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Any
+
+from aiohttp import web
+
+from api_helpers import (
+    POLYLINE_ENCODERS, TOPOLOGY_DIRECTIONS, cached_suggestions, chain_fields, corridor_fields,
+    encode_segments_page, fill_suggestions, motion_heading, parse_bbox, parse_chain_request,
+    parse_lookahead, parse_probe, parse_traversal, rollup_keys, suggestion_fields, traversal_fields,
+    way_fields,
+)
+from async_database import AsyncDatabaseManager
+from client_state import create_client_state_store
+from database import DatabaseManager, segment_id_for_way
+from lookup_cache import AsyncCachedLookup, CachedLookup, LookupCache, ThrottledRevision
+from metrics import MetricsRegistry
+from pems_poller import PemsPoller
+from polyline import band_for_zoom
+from spatial_index import SpatialIndex
+from speed_prediction import predict_next_speeds, predict_station_speeds, synthetic_speeds
+from speed_rollups import time_bucket
+from probe_writer import ProbeWriter
+from topology import RoadGraph
+
+# Same settings as api.py, plus the asyncpg pool size
+MAX_BATCH_POINTS = int(os.getenv('MAX_BATCH_POINTS', 1000))
+LOOKAHEAD_MAX_KM = float(os.getenv('LOOKAHEAD_MAX_KM', 50))
+MAX_STATIONS = int(os.getenv('MAX_STATIONS', 5000))
+LOOKUP_BACKEND = os.getenv('LOOKUP_BACKEND', 'sql')
+LOOKUP_CACHE_SIZE = int(os.getenv('LOOKUP_CACHE_SIZE', 100000))
+SEGMENTS_PAGE_SIZE = int(os.getenv('SEGMENTS_PAGE_SIZE', 1000))
+SEGMENTS_MAX_PAGE_SIZE = int(os.getenv('SEGMENTS_MAX_PAGE_SIZE', 10000))
+DB_POOL_MIN = int(os.getenv('ASYNC_DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.getenv('ASYNC_DB_POOL_MAX', 20))
+
+INDEX_HTML = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'index.html')
+
+json_response = partial(web.json_response, dumps=partial(json.dumps, default=str))
+
+
+def _query_value(request: web.Request, name: str, type: Any, default: Any = None) -> Any:
+    """Typed query parameter; like Flask, a malformed value counts as missing."""
+    value = request.query.get(name)
+    if value is None:
+        return default
+    try:
+        return type(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class _LoopBoundWriter:
+    """Lets ProbeWriter's thread write through the event loop's asyncpg pool."""
+
+    def __init__(self, db: AsyncDatabaseManager, loop: asyncio.AbstractEventLoop):
+        self.db = db
+        self.loop = loop
+
+    def store_user_data_batch(self, rows):
+        return asyncio.run_coroutine_threadsafe(self.db.store_user_data_batch(rows), self.loop).result()
+
+
+class AsyncLanesAPI:
+    """
+    The routes of api.py served by aiohttp on one event loop.
+
+    Database reads and probe writes go through ``AsyncDatabaseManager``,
+    so a request waiting on PostgreSQL does not hold a worker. PeMS
+    lookups that miss the poller cache run on a thread pool. Probes are
+    still written behind the request by ``ProbeWriter`` in batches.
+    """
+
+    def __init__(self):
+        self.metrics = MetricsRegistry()
+        self.db = AsyncDatabaseManager(min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, metrics=self.metrics)
+        self.client_state = create_client_state_store()
+
+        self.lookup_cache = None
+        if LOOKUP_BACKEND == 'memory':
+            # Lookups are CPU-only and answered inline on the loop
+            self.lookup = SpatialIndex(DatabaseManager())
+            if os.getenv('LOOKUP_SNAPSHOT'):
+                self.lookup.load_snapshot(os.getenv('LOOKUP_SNAPSHOT'))
+            else:
+                self.lookup.load()
+            self.lookup.start_auto_refresh(float(os.getenv('LOOKUP_REFRESH_SECONDS', 30)))
+        else:
+            self.lookup = self.db
+        if LOOKUP_CACHE_SIZE > 0:
+            self.lookup_cache = LookupCache(
+                max_size=LOOKUP_CACHE_SIZE,
+                ttl=float(os.getenv('LOOKUP_CACHE_TTL', 300)),
+            )
+            if LOOKUP_BACKEND == 'memory':
+                # Fast enough to cache exact coordinates
+                self.lookup = CachedLookup(self.lookup, self.lookup_cache, precision=None)
+            else:
+                self.lookup = AsyncCachedLookup(
+                    self.lookup, self.lookup_cache,
+                    precision=float(os.getenv('LOOKUP_CACHE_PRECISION', 1e-4)),
+                    candidates=int(os.getenv('LOOKUP_CACHE_CANDIDATES', 32)),
+                    revision_source=ThrottledRevision(
+                        self.db.get_network_revision, float(os.getenv('LOOKUP_REVISION_SECONDS', 5))
+                    ),
+                )
+
+        self.pems_executor = ThreadPoolExecutor(max_workers=int(os.getenv('PEMS_FETCH_WORKERS', 16)))
+        self.pems_poller = PemsPoller(
+            interval=float(os.getenv('PEMS_POLL_SECONDS', 30)),
+            ttl=float(os.getenv('PEMS_CACHE_TTL', 60)),
+            stale_ttl=float(os.getenv('PEMS_STALE_TTL', 600)),
+            failure_ttl=float(os.getenv('PEMS_FAILURE_TTL', 30)),
+            history=int(os.getenv('PEMS_HISTORY', 30)),
+            workers=int(os.getenv('PEMS_FETCH_WORKERS', 16)),
+        )
+        if os.getenv('PEMS_WATCH_STATIONS'):
+            self.pems_poller.watch(
+                int(s) for s in os.getenv('PEMS_WATCH_STATIONS').split(',') if s.strip()
+            )
+
+        self.rollup_cache = LookupCache(
+            max_size=int(os.getenv('ROLLUP_CACHE_SIZE', 100000)),
+            ttl=float(os.getenv('ROLLUP_CACHE_TTL', 30)),
+        )
+        self.segments_cache = LookupCache(
+            max_size=int(os.getenv('SEGMENTS_CACHE_SIZE', 256)),
+            ttl=float(os.getenv('SEGMENTS_CACHE_TTL', 3600)),
+        )
+        self.segments_revision = ThrottledRevision(
+            self.db.get_network_revision, float(os.getenv('SEGMENTS_REVISION_TTL', 1))
+        )
+        # Created on startup, once the event loop it writes through is running
+        self.probe_writer = None
+
+        # Loaded from the database on first use, off the event loop
+        self.road_graph = RoadGraph(DatabaseManager(), listen=False)
+        self.road_graph.start_auto_refresh(float(os.getenv('TOPOLOGY_REFRESH_SECONDS', 60)))
+
+        self._request_duration = self.metrics.histogram(
+            'http_request_duration_seconds', 'HTTP request latency', ['endpoint', 'method', 'status']
+        )
+        self._request_exceptions = self.metrics.counter(
+            'http_request_exceptions_total', 'Unhandled exceptions by endpoint', ['endpoint', 'exception']
+        )
+        if self.lookup_cache is not None:
+            self.metrics.register_stats('lookup_cache', self.lookup_cache.stats)
+        self.metrics.register_stats('rollup_cache', self.rollup_cache.stats)
+        self.metrics.register_stats('segments_cache', self.segments_cache.stats)
+        self.metrics.register_stats('probe_writer', lambda: self.probe_writer and self.probe_writer.stats())
+        self.metrics.register_stats('client_state', self.client_state.stats)
+        self.metrics.register_stats('pems', self.pems_poller.metrics)
+        self.metrics.register_stats('road_graph', self.road_graph.stats)
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._metrics_middleware])
+        app.on_startup.append(self._startup)
+        app.on_cleanup.append(self._cleanup)
+        app.router.add_get('/', self.index)
+        app.router.add_get('/api/lanes', self.get_lanes)
+        app.router.add_post('/api/lanes/batch', self.get_lanes_batch)
+        app.router.add_get('/api/lanes/ahead', self.get_lanes_ahead)
+        app.router.add_get('/api/suggested_speed', self.suggested_speed)
+        app.router.add_get('/api/recommended_speed', self.recommended_speed)
+        app.router.add_route('*', '/api/recommended_speeds', self.recommended_speeds)
+        app.router.add_get('/api/pems/metrics', self.pems_metrics)
+        app.router.add_post('/speed', self.post_speed)
+        app.router.add_post('/speed/batch', self.post_speed_batch)
+        app.router.add_get('/segments', self.get_segments)
+        app.router.add_post('/api/topology/chains', self.topology_chains)
+        app.router.add_get('/api/topology/{direction}', self.traverse_topology)
+        app.router.add_get('/api/health', self.health_check)
+        app.router.add_get('/metrics', self.get_metrics)
+        return app
+
+    async def _startup(self, app: web.Application) -> None:
+        await self.db.connect()
+        self.probe_writer = ProbeWriter(
+            _LoopBoundWriter(self.db, asyncio.get_running_loop()),
+            batch_size=int(os.getenv('PROBE_BATCH_SIZE', 500)),
+            flush_interval=float(os.getenv('PROBE_FLUSH_SECONDS', 1.0)),
+            max_queue=int(os.getenv('PROBE_QUEUE_SIZE', 50000)),
+            max_retries=int(os.getenv('PROBE_MAX_RETRIES', 5)),
+        )
+        self.pems_poller.start()
+
+    async def _cleanup(self, app: web.Application) -> None:
+        # close() blocks until queued probes are written through this loop
+        await asyncio.get_running_loop().run_in_executor(None, self.probe_writer.close)
+        self.pems_poller.stop()
+        self.road_graph.stop_auto_refresh()
+        self.pems_executor.shutdown(wait=False)
+        await self.db.close()
+
+    @web.middleware
+    async def _metrics_middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        route = request.match_info.route
+        endpoint = route.resource.canonical if route.resource is not None else 'unmatched'
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        except Exception as e:
+            self._request_exceptions.inc(endpoint=endpoint, exception=type(e).__name__)
+            raise
+        finally:
+            self._request_duration.observe(
+                time.perf_counter() - started, endpoint=endpoint, method=request.method, status=status
+            )
+
+    async def _lookup(self, method: str, *args: Any) -> Any:
+        # The in-memory index answers synchronously, the database asynchronously
+        result = getattr(self.lookup, method)(*args)
+        return await result if inspect.isawaitable(result) else result
+
+    async def _speed_suggestions(self, keys):
+        summaries, missing = cached_suggestions(self.rollup_cache, keys)
+        if not missing:
+            return summaries
+        rollups = await self.db.get_speed_rollups(rollup_keys(missing))
+        return fill_suggestions(self.rollup_cache, keys, summaries, missing, rollups)
+
+    async def _station_speeds(self, station_id: int):
+        """Cached lane history for a station, or synthetic speeds if PeMS is unreachable."""
+        loop = asyncio.get_running_loop()
+        cached = await loop.run_in_executor(self.pems_executor, self.pems_poller.get, station_id)
+        if cached is None:
+            return synthetic_speeds()
+        return cached[0]
+
+    def _queue_full_response(self) -> web.Response:
+        return json_response(
+            {'error': 'Ingestion queue full, retry later'}, status=503,
+            headers={'Retry-After': str(max(1, int(self.probe_writer.flush_interval)))},
+        )
+
+    async def index(self, request: web.Request) -> web.StreamResponse:
+        return web.FileResponse(INDEX_HTML)
+
+    async def get_lanes(self, request: web.Request) -> web.Response:
+        """Same as GET /api/lanes in api.py."""
+        lat = _query_value(request, 'lat', float)
+        lon = _query_value(request, 'lon', float)
+        max_distance = _query_value(request, 'errordist', float, 0.001)
+        if lat is None or lon is None:
+            return json_response({
+                'error': 'Missing parameters',
+                'message': 'Both lat and lon parameters are required'
+            }, status=400)
+
+        try:
+            way_info = await self._lookup('get_nearest_way', lat, lon, max_distance)
+        except Exception as e:
+            return json_response({'error': 'Server error', 'message': str(e)}, status=500)
+
+        if way_info is None or way_info.lanes is None:
+            return json_response({
+                'found': False,
+                'message': 'No road found within the specified distance'
+            })
+
+        motion = self.client_state.record(request.remote, lat, lon)
+        direction = None
+        if motion is not None:
+            direction = 'north' if motion[0] > 0 else 'south'
+        return json_response({**way_fields(way_info), 'direction': direction})
+
+    async def get_lanes_batch(self, request: web.Request) -> web.Response:
+        """Same as POST /api/lanes/batch in api.py."""
+        data = await self._json_body(request) or {}
+        points = data.get('points')
+        default_distance = data.get('errordist', 0.001)
+
+        if not isinstance(points, list):
+            return json_response({
+                'error': 'Missing parameters',
+                'message': 'A list of points is required'
+            }, status=400)
+        if len(points) > MAX_BATCH_POINTS:
+            return json_response({
+                'error': 'Too many points',
+                'message': f'At most {MAX_BATCH_POINTS} points are allowed per request'
+            }, status=400)
+
+        try:
+            coords = [(float(p['lat']), float(p['lon'])) for p in points]
+            max_distances = [float(p.get('errordist', default_distance)) for p in points]
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return json_response({
+                'error': 'Invalid parameters',
+                'message': 'Every point needs numeric lat and lon values'
+            }, status=400)
+
+        try:
+            ways = await self._lookup('get_nearest_ways', coords, max_distances)
+        except Exception as e:
+            return json_response({'error': 'Server error', 'message': str(e)}, status=500)
+
+        results = [way_fields(way) if way is not None else {'found': False} for way in ways]
+        return json_response({'results': results})
+
+    async def get_lanes_ahead(self, request: web.Request) -> web.Response:
+        """Same as GET /api/lanes/ahead in api.py."""
+        try:
+            lat, lon, heading, distance_km, max_distance, encoding = parse_lookahead(
+                request.query, LOOKAHEAD_MAX_KM
+            )
+        except ValueError as e:
+            return json_response({'error': 'Invalid parameters', 'message': str(e)}, status=400)
+
+        try:
+            way_info = await self._lookup('get_nearest_way', lat, lon, max_distance)
+            motion = self.client_state.record(request.remote, lat, lon)
+            if heading is None:
+                heading = motion_heading(motion, lat)
+            corridor = []
+            if way_info is not None:
+                await asyncio.get_running_loop().run_in_executor(None, self.road_graph.ensure_loaded)
+                if way_info.way_id in self.road_graph:
+                    corridor = self.road_graph.corridor(way_info.way_id, lat, lon, heading, distance_km * 1000)
+        except Exception as e:
+            return json_response({'error': 'Server error', 'message': str(e)}, status=500)
+
+        if not corridor:
+            return json_response({
+                'found': False,
+                'message': 'No road found within the specified distance'
+            })
+        return json_response(corridor_fields(self.road_graph, corridor, heading, encoding))
+
+    async def suggested_speed(self, request: web.Request) -> web.Response:
+        """Same as GET /api/suggested_speed in api.py."""
+        lat = _query_value(request, 'lat', float)
+        lon = _query_value(request, 'lon', float)
+        lane = _query_value(request, 'lane', int)
+        if lat is None or lon is None or lane is None:
+            return json_response({'error': 'Missing parameters'}, status=400)
+
+        try:
+            way = await self._lookup('get_nearest_way', lat, lon, 0.001)
+            if way is None:
+                return json_response({'error': 'No segment found'}, status=404)
+            segment_id = segment_id_for_way(way.way_id)
+            summary = (await self._speed_suggestions(
+                [(segment_id, lane, time_bucket(datetime.utcnow()))]
+            ))[0]
+        except Exception as e:
+            return json_response({'error': str(e)}, status=500)
+
+        speed, confidence = suggestion_fields(summary, way)
+        return json_response({
+            'suggested_speed': speed,
+            'confidence': confidence,
+            'segment_id': segment_id,
+            'stats': summary,
+        })
+
+    async def recommended_speed(self, request: web.Request) -> web.Response:
+        """Same as GET /api/recommended_speed in api.py."""
+        station_id = _query_value(request, 'station_id', int)
+        if station_id is None:
+            return json_response({'error': 'Missing station_id'}, status=400)
+
+        try:
+            current_speeds = await self._station_speeds(station_id)
+            predictions = predict_next_speeds(
+                current_speeds, horizon=30, sample_interval=self.pems_poller.interval
+            )
+        except Exception as exc:
+            return json_response({'error': str(exc)}, status=500)
+
+        return json_response({'station_id': station_id, 'recommendations': predictions})
+
+    async def recommended_speeds(self, request: web.Request) -> web.Response:
+        """Same as GET/POST /api/recommended_speeds in api.py."""
+        if request.method not in ('GET', 'POST'):
+            raise web.HTTPMethodNotAllowed(request.method, ['GET', 'POST'])
+        try:
+            if request.method == 'POST':
+                data = await self._json_body(request) or {}
+                station_ids = [int(station) for station in data.get('station_ids') or []]
+                horizon = int(data.get('horizon', 30))
+            else:
+                raw = request.query.get('station_ids', '')
+                station_ids = [int(part) for part in raw.split(',') if part.strip()]
+                horizon = _query_value(request, 'horizon', int, 30)
+        except (TypeError, ValueError):
+            return json_response({'error': 'station_ids must be integers'}, status=400)
+
+        if not station_ids:
+            return json_response({'error': 'Missing station_ids'}, status=400)
+        if len(station_ids) > MAX_STATIONS:
+            return json_response(
+                {'error': f'At most {MAX_STATIONS} stations are allowed per request'}, status=400
+            )
+        if not 0 < horizon <= 3600:
+            return json_response({'error': 'horizon must be between 1 and 3600'}, status=400)
+
+        station_ids = list(dict.fromkeys(station_ids))
+        try:
+            speeds = await asyncio.gather(*(self._station_speeds(station) for station in station_ids))
+            predictions = predict_station_speeds(
+                dict(zip(station_ids, speeds)), horizon=horizon,
+                sample_interval=self.pems_poller.interval,
+            )
+        except Exception as exc:
+            return json_response({'error': str(exc)}, status=500)
+
+        return json_response({
+            'horizon': horizon,
+            'recommendations': {str(station): lanes for station, lanes in predictions.items()},
+        })
+
+    async def pems_metrics(self, request: web.Request) -> web.Response:
+        return json_response(self.pems_poller.metrics())
+
+    async def post_speed(self, request: web.Request) -> web.Response:
+        """Same as POST /speed in api.py."""
+        try:
+            lat, lon, row = parse_probe(await self._json_body(request))
+        except (TypeError, ValueError) as e:
+            return json_response({'error': str(e)}, status=400)
+
+        try:
+            way = await self._lookup('get_nearest_way', lat, lon, 0.001)
+        except Exception as e:
+            return json_response({'error': str(e)}, status=500)
+        if not way:
+            return json_response({'error': 'No segment found'}, status=404)
+
+        matched_segment_id = segment_id_for_way(way.way_id)
+        try:
+            summary = (await self._speed_suggestions(
+                [(matched_segment_id, row['lane_index'], time_bucket(row['timestamp']))]
+            ))[0]
+        except Exception as e:
+            return json_response({'error': str(e)}, status=500)
+        suggested_speed, confidence = suggestion_fields(summary, way)
+
+        row['segment_id'] = matched_segment_id
+        if not self.probe_writer.submit([row]):
+            return self._queue_full_response()
+
+        return json_response({
+            'suggested_speed': suggested_speed,
+            'matched_segment_id': matched_segment_id,
+            'confidence': confidence
+        })
+
+    async def post_speed_batch(self, request: web.Request) -> web.Response:
+        """Same as POST /speed/batch in api.py."""
+        data = await self._json_body(request) or {}
+        probes = data.get('probes')
+        if not isinstance(probes, list):
+            return json_response({'error': 'A list of probes is required'}, status=400)
+        if len(probes) > MAX_BATCH_POINTS:
+            return json_response(
+                {'error': f'At most {MAX_BATCH_POINTS} probes are allowed per request'}, status=400
+            )
+
+        try:
+            parsed = [parse_probe(probe) for probe in probes]
+        except (TypeError, ValueError) as e:
+            return json_response({'error': f'Invalid probe: {e}'}, status=400)
+
+        try:
+            ways = await self._lookup('get_nearest_ways', [(lat, lon) for lat, lon, _ in parsed], 0.001)
+        except Exception as e:
+            return json_response({'error': str(e)}, status=500)
+
+        rows = []
+        matched_ways = []
+        for (_, _, row), way in zip(parsed, ways):
+            if way is not None:
+                row['segment_id'] = segment_id_for_way(way.way_id)
+                rows.append(row)
+                matched_ways.append(way)
+
+        try:
+            summaries = await self._speed_suggestions([
+                (row['segment_id'], row['lane_index'], time_bucket(row['timestamp'])) for row in rows
+            ])
+        except Exception as e:
+            return json_response({'error': str(e)}, status=500)
+
+        results = []
+        matched = iter(zip(rows, matched_ways, summaries))
+        for way in ways:
+            if way is None:
+                results.append({'error': 'No segment found'})
+                continue
+            row, way, summary = next(matched)
+            speed, confidence = suggestion_fields(summary, way)
+            results.append({
+                'suggested_speed': speed,
+                'matched_segment_id': row['segment_id'],
+                'confidence': confidence,
+            })
+
+        if rows and not self.probe_writer.submit(rows):
+            return self._queue_full_response()
+
+        return json_response({'accepted': len(rows), 'results': results})
+
+    async def get_segments(self, request: web.Request) -> web.Response:
+        """Same as GET /segments in api.py."""
+        name = request.query.get('name', 'Sinclair')
+        after = _query_value(request, 'after', int)
+        limit = _query_value(request, 'limit', int, SEGMENTS_PAGE_SIZE)
+        zoom = _query_value(request, 'zoom', int)
+        encoding = request.query.get('format', 'json')
+        if encoding not in POLYLINE_ENCODERS:
+            return json_response({
+                'error': 'Invalid format',
+                'message': f"format must be one of {', '.join(POLYLINE_ENCODERS)}"
+            }, status=400)
+        band = band_for_zoom(zoom)
+        try:
+            bbox = parse_bbox(request.query['bbox']) if request.query.get('bbox') else None
+        except ValueError as e:
+            return json_response({'error': 'Invalid bbox', 'message': str(e)}, status=400)
+        limit = max(1, min(limit, SEGMENTS_MAX_PAGE_SIZE))
+
+        try:
+            key = (await self.segments_revision.current_async(), name, bbox, after, limit, band, encoding)
+            cached = self.segments_cache.get(key)
+            if cached is None:
+                rows = await self.db.get_segment_polylines(
+                    name=name or None, bbox=bbox, after=after, limit=limit, band=band
+                )
+                cached = encode_segments_page(rows, name, encoding, limit)
+                self.segments_cache.put(key, cached)
+        except Exception as e:
+            print(f"Error in /segments: {e}")
+            return json_response({'error': str(e)}, status=500)
+
+        etag, body, gzipped, next_after = cached
+        use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+        if use_gzip:
+            etag += '-gz'
+        if any(tag.value in (etag, '*') for tag in request.if_none_match or ()):
+            response = web.Response(status=304)
+        else:
+            response = web.Response(body=gzipped if use_gzip else body, content_type='application/json')
+            if use_gzip:
+                response.headers['Content-Encoding'] = 'gzip'
+        response.etag = etag
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Vary'] = 'Accept-Encoding'
+        if next_after is not None:
+            response.headers['X-Next-After'] = str(next_after)
+        return response
+
+    async def traverse_topology(self, request: web.Request) -> web.Response:
+        """Same as GET /api/topology/<direction> in api.py."""
+        direction = request.match_info['direction']
+        if direction not in TOPOLOGY_DIRECTIONS:
+            return json_response({'error': 'direction must be downstream or upstream'}, status=404)
+        try:
+            way_id, max_distance, limit, same_name = parse_traversal(request.query)
+        except ValueError as e:
+            return json_response({'error': str(e)}, status=400)
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.road_graph.ensure_loaded)
+            if way_id not in self.road_graph:
+                return json_response({'error': 'Unknown way_id'}, status=404)
+            traverse = self.road_graph.downstream if direction == 'downstream' else self.road_graph.upstream
+            reached = traverse(way_id, max_distance=max_distance, limit=limit, same_name=same_name)
+            return json_response(traversal_fields(self.road_graph, way_id, reached))
+        except Exception as e:
+            return json_response({'error': str(e)}, status=500)
+
+    async def topology_chains(self, request: web.Request) -> web.Response:
+        """Same as POST /api/topology/chains in api.py."""
+        try:
+            if request.content_type == 'application/json':
+                way_ids = parse_chain_request(await self._json_body(request))
+            else:
+                way_ids = parse_chain_request(None, await request.text())
+        except Exception as e:
+            return json_response({'error': str(e)}, status=400)
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.road_graph.ensure_loaded)
+            return json_response(chain_fields(self.road_graph, way_ids))
+        except Exception as e:
+            return json_response({'error': str(e)}, status=500)
+
+    async def health_check(self, request: web.Request) -> web.Response:
+        return json_response({
+            'status': 'healthy',
+            'message': 'OSM Lanes API is running',
+            'server': 'async',
+            'lookup_backend': LOOKUP_BACKEND,
+            'lookup_cache': self.lookup_cache.stats() if self.lookup_cache is not None else None,
+            'probe_writer': self.probe_writer.stats() if self.probe_writer is not None else None,
+            'client_state': self.client_state.stats(),
+            'db_pool': self.db.pool_stats(),
+        })
+
+    async def get_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.metrics.render(),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+        )
+
+    @staticmethod
+    async def _json_body(request: web.Request) -> Any:
+        """Parsed JSON body, or None when it is missing or malformed (like Flask's silent=True)."""
+        try:
+            return await request.json()
+        except ValueError:
+            return None
+
+
+def create_app() -> web.Application:
+    return AsyncLanesAPI().create_app()
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), port=int(os.getenv('PORT', 5000)))
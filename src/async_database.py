@@ -0,0 +1,290 @@
+import json
+import re
+import time
+from collections import namedtuple
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import asyncpg
+
+from database import (
+    MERGE_SPEED_ROLLUPS_SQL, NEARBY_SEGMENTS_SQL, NEAREST_WAY_SQL, NEAREST_WAYS_SQL, SPEED_ROLLUPS_SQL,
+    USER_DATA_COLUMNS, get_database_url, segment_polylines_query,
+)
+from polyline import FULL_RESOLUTION_BAND
+from spatial_index import NearbySegment, NearestWay
+from speed_rollups import aggregate
+
+_NAMED_PARAM = re.compile(r'(?<!:):(\w+)')
+
+# Probes are inserted from parallel arrays so a batch is one prepared statement
+INSERT_USER_DATA_SQL = f"""
+INSERT INTO user_data ({', '.join(USER_DATA_COLUMNS)})
+SELECT * FROM unnest(
+    $1::double precision[], $2::double precision[], $3::timestamp[], $4::double precision[],
+    $5::integer[], $6::varchar[], $7::varchar[], $8::timestamp[]
+)
+"""
+
+# Same merge as the COPY path, reading partial rollups from arrays instead of
+# a staging table; histograms travel as '{n,...}' literals
+MERGE_SPEED_ROLLUP_ARRAYS_SQL = MERGE_SPEED_ROLLUPS_SQL.replace(
+    "FROM staging_speed_rollups",
+    """FROM (
+    SELECT segment_id, lane_index, bucket, count, mean, m2, CAST(histogram AS integer[]) AS histogram
+    FROM unnest(
+        $1::varchar[], $2::integer[], $3::integer[], $4::bigint[],
+        $5::double precision[], $6::double precision[], $7::text[]
+    ) AS u(segment_id, lane_index, bucket, count, mean, m2, histogram)
+) AS staging_speed_rollups""",
+)
+
+
+def to_positional(query: str, names: Sequence[str]) -> str:
+    """Rewrite ``:name`` parameters as asyncpg's ``$n`` placeholders, numbered by ``names``."""
+    index = {name: i + 1 for i, name in enumerate(names)}
+    return _NAMED_PARAM.sub(lambda match: f"${index[match.group(1)]}", query)
+
+
+NEAREST_WAY_PARAMS = ('lat', 'lon', 'max_distance')
+NEAREST_WAYS_PARAMS = ('lats', 'lons', 'max_distances')
+NEARBY_SEGMENTS_PARAMS = ('lats', 'lons', 'radii', 'limit')
+SPEED_ROLLUPS_PARAMS = ('segment_ids', 'lane_indexes', 'buckets')
+
+# Statements prepared once on every pooled connection
+PREPARED_STATEMENTS = {
+    'nearest_way': to_positional(NEAREST_WAY_SQL, NEAREST_WAY_PARAMS),
+    'nearest_ways': to_positional(NEAREST_WAYS_SQL, NEAREST_WAYS_PARAMS),
+    'nearby_segments': to_positional(NEARBY_SEGMENTS_SQL, NEARBY_SEGMENTS_PARAMS),
+    'speed_rollups': to_positional(SPEED_ROLLUPS_SQL, SPEED_ROLLUPS_PARAMS),
+    'insert_user_data': INSERT_USER_DATA_SQL,
+    'merge_speed_rollups': MERGE_SPEED_ROLLUP_ARRAYS_SQL,
+    'network_revision': "SELECT revision FROM network_revision WHERE id = 1",
+}
+
+
+SegmentPolyline = namedtuple('SegmentPolyline', ['way_id', 'name', 'polyline'])
+
+
+def _naive(value: Any) -> Any:
+    # The COPY path sends ISO text, and PostgreSQL drops the offset for
+    # timestamp columns; asyncpg rejects aware datetimes, so drop it here
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.replace(tzinfo=None)
+    return value
+
+
+class PreparedConnection(asyncpg.Connection):
+    """asyncpg connection carrying its server-side prepared statements by name."""
+
+    statements: Dict[str, Any]
+
+
+class AsyncDatabaseManager:
+    """
+    asyncpg counterpart of the ``DatabaseManager`` read and probe-write paths.
+
+    Every pooled connection prepares ``PREPARED_STATEMENTS`` when it is
+    opened, so hot queries are parsed and planned once per connection
+    rather than per request. Uses the same DATABASE_URL. Pass a
+    ``metrics.MetricsRegistry`` to time statements like the synchronous
+    engine.
+    """
+
+    def __init__(
+        self,
+        database_url: Optional[str] = None,
+        min_size: int = 2,
+        max_size: int = 20,
+        metrics: Any = None,
+    ):
+        # SQLAlchemy URLs may name a driver (postgresql+psycopg2://); asyncpg does not
+        self.database_url = re.sub(r'^postgresql\+\w+://', 'postgresql://', database_url or get_database_url())
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self._duration = None
+        self._errors = None
+        if metrics is not None:
+            self._duration = metrics.histogram(
+                'db_statement_duration_seconds', 'SQL statement execution time', ['statement']
+            )
+            self._errors = metrics.counter('db_statement_errors_total', 'Failed SQL statements', ['statement'])
+            metrics.register_collector(self._pool_metrics)
+
+    async def connect(self) -> None:
+        self.pool = await asyncpg.create_pool(
+            self.database_url,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            connection_class=PreparedConnection,
+            init=self._init_connection,
+        )
+
+    async def close(self) -> None:
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @staticmethod
+    async def _init_connection(conn: PreparedConnection) -> None:
+        await conn.set_type_codec('json', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+        conn.statements = {
+            name: await conn.prepare(query) for name, query in PREPARED_STATEMENTS.items()
+        }
+
+    async def _run(self, name: str, method: str, *args: Any) -> Any:
+        """Run prepared statement ``name`` with ``method`` (fetch, fetchrow, fetchval)."""
+        started = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                return await getattr(conn.statements[name], method)(*args)
+        except Exception:
+            if self._errors is not None:
+                self._errors.inc(statement=name)
+            raise
+        finally:
+            if self._duration is not None:
+                self._duration.observe(time.perf_counter() - started, statement=name)
+
+    def _pool_metrics(self):
+        if self.pool is None:
+            return []
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return [
+            ('db_pool_size', 'gauge', 'Connection pool size', [({}, size)]),
+            ('db_pool_checkedin', 'gauge', 'Connection pool checkedin', [({}, idle)]),
+            ('db_pool_checkedout', 'gauge', 'Connection pool checkedout', [({}, size - idle)]),
+        ]
+
+    def pool_stats(self) -> Dict[str, Any]:
+        if self.pool is None:
+            return {'connected': False}
+        return {
+            'connected': True,
+            'size': self.pool.get_size(),
+            'idle': self.pool.get_idle_size(),
+            'max_size': self.pool.get_max_size(),
+        }
+
+    async def get_network_revision(self) -> int:
+        return await self._run('network_revision', 'fetchval') or 0
+
+    async def get_nearest_way(self, lat: float, lon: float, max_distance: float = 0.001) -> Optional[NearestWay]:
+        row = await self._run('nearest_way', 'fetchrow', float(lat), float(lon), float(max_distance))
+        return NearestWay(*row) if row is not None else None
+
+    async def get_nearest_ways(
+        self,
+        points: Sequence[Tuple[float, float]],
+        max_distance: Union[float, Sequence[float]] = 0.001,
+    ) -> List[Optional[NearestWay]]:
+        """Same as ``DatabaseManager.get_nearest_ways``."""
+        if not points:
+            return []
+        if isinstance(max_distance, (int, float)):
+            max_distances = [float(max_distance)] * len(points)
+        else:
+            max_distances = [float(d) for d in max_distance]
+            if len(max_distances) != len(points):
+                raise ValueError("max_distance must have one value per point")
+        rows = await self._run(
+            'nearest_ways', 'fetch',
+            [float(lat) for lat, _ in points], [float(lon) for _, lon in points], max_distances,
+        )
+        # Columns after the ordinality index match NearestWay
+        return [NearestWay(*tuple(row)[1:]) if row['way_id'] is not None else None for row in rows]
+
+    async def get_nearby_segments(
+        self,
+        points: Sequence[Tuple[float, float]],
+        radii: Sequence[float],
+        limit: int,
+    ) -> List[List[NearbySegment]]:
+        """Same as ``DatabaseManager.get_nearby_segments``."""
+        if not points:
+            return []
+        rows = await self._run(
+            'nearby_segments', 'fetch',
+            [float(lat) for lat, _ in points], [float(lon) for _, lon in points],
+            [float(radius) for radius in radii], int(limit),
+        )
+        segments = [[] for _ in points]
+        for row in rows:
+            # Columns after the ordinality index match NearbySegment
+            segments[row['idx'] - 1].append(NearbySegment(*tuple(row)[1:]))
+        return segments
+
+    async def get_speed_rollups(
+        self, keys: Sequence[Tuple[str, int, int]]
+    ) -> Dict[Tuple[str, int, int], Tuple[int, float, float, List[int]]]:
+        """Same as ``DatabaseManager.get_speed_rollups``."""
+        if not keys:
+            return {}
+        rows = await self._run(
+            'speed_rollups', 'fetch',
+            [key[0] for key in keys], [key[1] for key in keys], [key[2] for key in keys],
+        )
+        return {
+            (row[0], row[1], row[2]): (row[3], row[4], row[5], list(row[6]))
+            for row in rows
+        }
+
+    async def get_segment_polylines(
+        self,
+        name: Optional[str] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        after: Optional[int] = None,
+        limit: Optional[int] = None,
+        band: int = FULL_RESOLUTION_BAND,
+    ) -> List[Any]:
+        """Same as ``DatabaseManager.get_segment_polylines``; uses asyncpg's statement cache."""
+        query, params = segment_polylines_query(name, bbox, after, limit, band)
+        names = list(params)
+        started = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(to_positional(query, names), *(params[n] for n in names))
+            return [SegmentPolyline(*row) for row in rows]
+        finally:
+            if self._duration is not None:
+                self._duration.observe(time.perf_counter() - started, statement='segment_polylines')
+
+    async def store_user_data_batch(self, rows: Sequence[Dict[str, Any]]) -> int:
+        """
+        Store probe rows and merge their speed rollups in one transaction.
+
+        Same contract as ``DatabaseManager.store_user_data_batch``.
+        """
+        if not rows:
+            return 0
+        now = datetime.utcnow()
+        rows = [{**row, 'created_at': row.get('created_at') or now} for row in rows]
+        columns = [[_naive(row.get(column)) for row in rows] for column in USER_DATA_COLUMNS]
+        partials = aggregate(rows)
+        started = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.statements['insert_user_data'].fetch(*columns)
+                    if partials:
+                        keys = list(partials)
+                        values = [partials[key] for key in keys]
+                        await conn.statements['merge_speed_rollups'].fetch(
+                            [key[0] for key in keys],
+                            [key[1] for key in keys],
+                            [key[2] for key in keys],
+                            [value[0] for value in values],
+                            [value[1] for value in values],
+                            [value[2] for value in values],
+                            ['{' + ','.join(str(n) for n in value[3]) + '}' for value in values],
+                        )
+        except Exception:
+            if self._errors is not None:
+                self._errors.inc(statement='store_user_data')
+            raise
+        finally:
+            if self._duration is not None:
+                self._duration.observe(time.perf_counter() - started, statement='store_user_data')
+        return len(rows)
@@ -0,0 +1,337 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from synthetic_osm import generate_osm_file, generate_osm_string
+from parser import iter_osm_xml, iter_osm_xml_columnar, parse_osm_xml, parse_osm_xml_columnar
+
+# Slowdown of the median time that --compare reports as a regression
+DEFAULT_REGRESSION_THRESHOLD = 1.2
+
+
+def measure(
+    fn: Callable[[], Any], repeat: int = 5, number: int = 1, items: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Time ``fn`` after one warm-up call.
+
+    Each of ``repeat`` rounds calls it ``number`` times. ``items`` is the
+    amount of work per call (rows, points, ...) for throughput figures.
+    """
+    fn()
+    rounds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - started) / number)
+    median = statistics.median(rounds)
+    result = {
+        'repeat': repeat,
+        'number': number,
+        'min_s': min(rounds),
+        'median_s': median,
+        'mean_s': statistics.mean(rounds),
+        'stdev_s': statistics.stdev(rounds) if len(rounds) > 1 else 0.0,
+    }
+    if items:
+        result['items'] = items
+        result['items_per_second'] = items / median if median > 0 else None
+    return result
+
+
+def sample_points(nodes: List[Dict[str, Any]], count: int, seed: int) -> List[Tuple[float, float]]:
+    """Query points a few meters off random network nodes."""
+    rng = random.Random(seed)
+    picked = [rng.choice(nodes) for _ in range(count)]
+    return [
+        (node['lat'] + rng.uniform(-0.0002, 0.0002), node['lon'] + rng.uniform(-0.0002, 0.0002))
+        for node in picked
+    ]
+
+
+def bench_parsing(args, results: Dict[str, Any], osm_path: str) -> List[Dict[str, Any]]:
+    xml_data = generate_osm_string(min(args.nodes, args.parse_nodes), args.seed)
+    nodes, ways, way_nodes = parse_osm_xml(xml_data, include_geom=False)
+    rows = len(nodes) + len(ways) + len(way_nodes)
+    results['parse_osm_xml'] = measure(
+        lambda: parse_osm_xml(xml_data), repeat=args.repeat, items=rows
+    )
+    results['parse_osm_xml_no_geom'] = measure(
+        lambda: parse_osm_xml(xml_data, include_geom=False), repeat=args.repeat, items=rows
+    )
+
+    results['parse_osm_xml_columnar'] = measure(
+        lambda: parse_osm_xml_columnar(xml_data), repeat=args.repeat, items=rows
+    )
+
+    def stream_file():
+        return sum(len(n) + len(w) + len(wn) for n, w, wn in iter_osm_xml(osm_path, include_geom=False))
+
+    def stream_file_columnar():
+        return sum(batch.rows for batch in iter_osm_xml_columnar(osm_path))
+
+    file_rows = stream_file()
+    results['iter_osm_xml_file'] = measure(stream_file, repeat=max(1, args.repeat // 2), items=file_rows)
+    results['iter_osm_xml_columnar_file'] = measure(
+        stream_file_columnar, repeat=max(1, args.repeat // 2), items=file_rows
+    )
+    return nodes
+
+
+def bench_database(args, results: Dict[str, Any], osm_path: str, nodes: List[Dict[str, Any]]) -> None:
+    from sqlalchemy import text
+    from database import DatabaseManager
+    from spatial_index import SpatialIndex
+
+    db = DatabaseManager()
+    db.init_db()
+
+    def reset():
+        with db.engine.begin() as conn:
+            conn.execute(text(
+                "TRUNCATE way_shapes, way_segments, way_nodes, ways, nodes, "
+                "user_data, speed_rollups"
+            ))
+
+    def load():
+        return db.bulk_store_osm_data(iter_osm_xml(osm_path, include_geom=False))
+
+    # Every round starts from empty tables; the reset is not timed
+    rounds = []
+    for _ in range(max(1, args.repeat // 2)):
+        reset()
+        stats = load()
+        rounds.append(stats['seconds'])
+    results['bulk_store_osm_data'] = {
+        'repeat': len(rounds),
+        'number': 1,
+        'min_s': min(rounds),
+        'median_s': statistics.median(rounds),
+        'mean_s': statistics.mean(rounds),
+        'stdev_s': statistics.stdev(rounds) if len(rounds) > 1 else 0.0,
+        'items': stats['rows'],
+        'items_per_second': stats['rows'] / statistics.median(rounds),
+    }
+    # Loading the same data again only compares versions
+    results['bulk_store_osm_data_unchanged'] = measure(
+        load, repeat=max(1, args.repeat // 2), items=stats['rows']
+    )
+
+    points = sample_points(nodes, args.points, args.seed)
+    point_iter = iter(points * (args.repeat + 2))
+    results['get_nearest_way_sql'] = measure(
+        lambda: db.get_nearest_way(*next(point_iter)), repeat=args.repeat, number=len(points) // 10 or 1
+    )
+    results['get_nearest_ways_sql'] = measure(
+        lambda: db.get_nearest_ways(points), repeat=args.repeat, items=len(points)
+    )
+
+    index = SpatialIndex(db)
+    results['spatial_index_load'] = measure(index.load, repeat=max(1, args.repeat // 2))
+    point_iter = iter(points * (args.repeat + 2))
+    results['get_nearest_way_memory'] = measure(
+        lambda: index.get_nearest_way(*next(point_iter)), repeat=args.repeat, number=len(points)
+    )
+    results['get_nearest_ways_memory'] = measure(
+        lambda: index.get_nearest_ways(points), repeat=args.repeat, items=len(points)
+    )
+
+
+def _start_fake_pems() -> Tuple[Any, str]:
+    from http.server import ThreadingHTTPServer
+    from fake_pems import make_handler
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/?station_id={{station_id}}"
+
+
+def bench_endpoints(args, results: Dict[str, Any], nodes: List[Dict[str, Any]]) -> None:
+    # The API reads its configuration at import time
+    server, pems_url = _start_fake_pems()
+    os.environ['PEMS_URL'] = pems_url
+    os.environ['LOOKUP_BACKEND'] = args.lookup_backend
+    import api
+
+    client = api.app.test_client()
+    points = sample_points(nodes, args.points, args.seed + 1)
+    point_iter = iter(points * (args.repeat * 10 + 20))
+    probe = {'timestamp': '2025-06-24T18:12:00', 'speed': 55, 'lane_index': 1, 'device_id': 'bench'}
+
+    def lanes():
+        lat, lon = next(point_iter)
+        return client.get('/api/lanes', query_string={'lat': lat, 'lon': lon})
+
+    def suggested():
+        lat, lon = next(point_iter)
+        return client.get('/api/suggested_speed', query_string={'lat': lat, 'lon': lon, 'lane': 1})
+
+    def post_speed():
+        lat, lon = next(point_iter)
+        return client.post('/speed', json={**probe, 'lat': lat, 'lon': lon})
+
+    batch = [{'lat': lat, 'lon': lon} for lat, lon in points[:100]]
+    probes = [{**probe, 'lat': lat, 'lon': lon} for lat, lon in points[:100]]
+    endpoints = {
+        'GET /api/lanes': (lanes, 10, None),
+        'POST /api/lanes/batch': (lambda: client.post('/api/lanes/batch', json={'points': batch}), 1, len(batch)),
+        'GET /api/suggested_speed': (suggested, 10, None),
+        'POST /speed': (post_speed, 10, None),
+        'POST /speed/batch': (lambda: client.post('/speed/batch', json={'probes': probes}), 1, len(probes)),
+        'GET /api/recommended_speed': (
+            lambda: client.get('/api/recommended_speed', query_string={'station_id': 1234}), 10, None
+        ),
+        'GET /api/recommended_speeds': (
+            lambda: client.get('/api/recommended_speeds', query_string={'station_ids': '1,2,3,4,5'}), 5, None
+        ),
+        'GET /segments': (
+            lambda: client.get('/segments', query_string={'name': '', 'limit': 1000}), 1, None
+        ),
+        'GET /segments zoom=10 encoded': (
+            lambda: client.get('/segments', query_string={'name': '', 'limit': 1000, 'zoom': 10, 'format': 'encoded'}),
+            1, None,
+        ),
+        'GET /api/health': (lambda: client.get('/api/health'), 10, None),
+    }
+    for name, (fn, number, items) in endpoints.items():
+        response = fn()
+        if response.status_code >= 500:
+            results[name] = {'error': f"HTTP {response.status_code}"}
+            continue
+        results[name] = measure(fn, repeat=args.repeat, number=number, items=items)
+
+    api.probe_writer.close()
+    server.shutdown()
+
+
+def git_commit() -> Tuple[Optional[str], Optional[bool]]:
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=repo, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+        dirty = bool(subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=repo, text=True, stderr=subprocess.DEVNULL,
+        ).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Print median time ratios against a baseline and return the regressed benchmarks."""
+    regressions = []
+    print(f"\n{'benchmark':<36} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for name, result in current['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before or 'median_s' not in before or 'median_s' not in result:
+            continue
+        ratio = result['median_s'] / before['median_s'] if before['median_s'] else float('inf')
+        flag = '  REGRESSION' if ratio > threshold else ''
+        print(f"{name:<36} {before['median_s'] * 1000:>10.3f}ms {result['median_s'] * 1000:>10.3f}ms {ratio:>6.2f}x{flag}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark parsing, loading, lookups and API endpoints")
+    parser.add_argument('--nodes', type=int, default=100000, help="synthetic network size (default: 100000)")
+    parser.add_argument('--parse-nodes', type=int, default=100000,
+                        help="cap for the in-memory parse benchmark (default: 100000)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--points', type=int, default=1000, help="query points for lookup benchmarks")
+    parser.add_argument('--database-url', default=None,
+                        help="scratch PostGIS database; its network and probe tables are TRUNCATED. "
+                             "Database and endpoint benchmarks are skipped without it.")
+    parser.add_argument('--lookup-backend', choices=('sql', 'memory'), default='sql',
+                        help="LOOKUP_BACKEND for the endpoint benchmarks")
+    parser.add_argument('--output', default=None,
+                        help="result file (default: benchmark-results/<time>-<commit>.json)")
+    parser.add_argument('--compare', default=None, help="baseline result file to compare against")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help="median time ratio reported as a regression (default: 1.2)")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+
+    commit, dirty = git_commit()
+    results: Dict[str, Any] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        osm_path = os.path.join(tmp, 'synthetic.osm')
+        started = time.perf_counter()
+        node_count, way_count = generate_osm_file(osm_path, args.nodes, args.seed)
+        print(f"Generated {node_count} nodes, {way_count} ways in {time.perf_counter() - started:.1f}s")
+
+        print("Parsing benchmarks...")
+        nodes = bench_parsing(args, results, osm_path)
+        if args.database_url:
+            print("Database benchmarks...")
+            bench_database(args, results, osm_path, nodes)
+            print("Endpoint benchmarks...")
+            bench_endpoints(args, results, nodes)
+        else:
+            print("No --database-url: skipping database and endpoint benchmarks")
+
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'created_at': datetime.utcnow().isoformat() + 'Z',
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {
+            'nodes': node_count,
+            'ways': way_count,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'points': args.points,
+            'lookup_backend': args.lookup_backend,
+        },
+        'results': results,
+    }
+
+    output = args.output
+    if output is None:
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        output = os.path.join('benchmark-results', f"{stamp}-{(commit or 'unknown')[:10]}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    for name, result in results.items():
+        if 'median_s' in result:
+            rate = f"  {result['items_per_second']:.0f}/s" if result.get('items_per_second') else ''
+            print(f"{name:<36} {result['median_s'] * 1000:>10.3f}ms{rate}")
+        else:
+            print(f"{name:<36} {result.get('error')}")
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmarks regressed by more than {args.threshold:.2f}x")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
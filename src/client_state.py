@@ -0,0 +1,256 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+# Number of recent coordinates kept per client
+DEFAULT_HISTORY = 15
+DEFAULT_MAX_CLIENTS = 100000
+# Clients unseen for this many seconds start over with an empty history
+DEFAULT_IDLE_TTL = 900.0
+
+# Average (lat, lon) change per request over a client's recent history
+Motion = Tuple[float, float]
+
+
+def _average_step(newest: Tuple[float, float], oldest: Tuple[float, float], count: int) -> Motion:
+    # The mean of consecutive differences telescopes to (newest - oldest) / (n - 1)
+    steps = count - 1
+    return (newest[0] - oldest[0]) / steps, (newest[1] - oldest[1]) / steps
+
+
+class MemoryClientStateStore:
+    """
+    Per-process client history with an LRU capacity limit and idle TTL.
+
+    ``record`` appends a coordinate to the client's window and returns the
+    average step over the window in O(1).
+    """
+
+    def __init__(
+        self,
+        max_clients: int = DEFAULT_MAX_CLIENTS,
+        idle_ttl: float = DEFAULT_IDLE_TTL,
+        history: int = DEFAULT_HISTORY,
+    ):
+        self.max_clients = max_clients
+        self.idle_ttl = idle_ttl
+        self.history = history
+        # client_id -> (last_seen, deque of (lat, lon)), least recently seen first
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def record(self, client_id: str, lat: float, lon: float) -> Optional[Motion]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._clients.pop(client_id, None)
+            if entry is None or now - entry[0] > self.idle_ttl:
+                coords = deque(maxlen=self.history)
+            else:
+                coords = entry[1]
+            coords.append((lat, lon))
+            self._clients[client_id] = (now, coords)
+            self._evict(now)
+            # Another request from the same client may append once the lock is released
+            if len(coords) < 2:
+                return None
+            return _average_step(coords[-1], coords[0], len(coords))
+
+    def _evict(self, now: float) -> None:
+        # Entries are ordered by last access, so idle ones sit at the front
+        while self._clients:
+            _, (last_seen, _) = next(iter(self._clients.items()))
+            if len(self._clients) <= self.max_clients and now - last_seen <= self.idle_ttl:
+                break
+            self._clients.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'clients': len(self._clients),
+                'max_clients': self.max_clients,
+                'evictions': self.evictions,
+            }
+
+
+class SharedClientStateStore:
+    """
+    Client history in a memory-mapped file shared by all worker processes.
+
+    The file holds a fixed-size open-addressing hash table of per-client
+    ring buffers. Updates are serialized with ``flock``, so every gunicorn
+    worker on the host sees the same history. A client whose probe window
+    is full replaces the least recently seen entry in the window, which
+    bounds the table at ``max_clients`` entries. Put the file on tmpfs
+    (e.g. ``/dev/shm``) to keep it in memory.
+    """
+
+    MAGIC = b'OSMCS001'
+    HEADER_SIZE = 64
+    # Slots probed per client before the least recently seen one is reused
+    PROBE_LENGTH = 16
+
+    def __init__(
+        self,
+        path: str,
+        max_clients: int = DEFAULT_MAX_CLIENTS,
+        idle_ttl: float = DEFAULT_IDLE_TTL,
+        history: int = DEFAULT_HISTORY,
+    ):
+        self.path = path
+        self.max_clients = max_clients
+        self.idle_ttl = idle_ttl
+        self.history = history
+        self.dtype = np.dtype([
+            ('key', '<u8'),
+            ('last_seen', '<f8'),
+            ('count', '<u4'),
+            ('head', '<u4'),
+            ('lat', '<f8', (history,)),
+            ('lon', '<f8', (history,)),
+        ])
+        self._lock = threading.Lock()
+        self._pid = None
+        self._open()
+
+    def _open(self) -> None:
+        # flock locks belong to the open file, so every process needs its own
+        size = self.HEADER_SIZE + self.max_clients * self.dtype.itemsize
+        header = (
+            self.MAGIC
+            + self.max_clients.to_bytes(4, 'little')
+            + self.history.to_bytes(4, 'little')
+        )
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            reopen = False
+            try:
+                if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                    # Replaced by another process while we waited for the lock
+                    reopen = True
+                elif os.fstat(fd).st_size == 0:
+                    # Just created, so nothing maps it yet
+                    os.ftruncate(fd, size)
+                    os.pwrite(fd, header, 0)
+                elif os.fstat(fd).st_size != size or os.pread(fd, len(header), 0) != header:
+                    # Written with another layout. Workers may still map it, and
+                    # shrinking it under them would crash them with SIGBUS, so a
+                    # new empty file takes its place and they keep the old one
+                    self._replace(size, header)
+                    reopen = True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            if not reopen:
+                break
+            os.close(fd)
+        self._fd = fd
+        self._mmap = mmap.mmap(fd, size)
+        self._slots = np.ndarray(
+            (self.max_clients,), dtype=self.dtype, buffer=self._mmap, offset=self.HEADER_SIZE
+        )
+        self._pid = os.getpid()
+
+    def _replace(self, size: int, header: bytes) -> None:
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            os.pwrite(fd, header, 0)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, self.path)
+        print(f"Client state file {self.path} had another layout; started a new one")
+
+    def _key(self, client_id: str) -> int:
+        digest = hashlib.blake2b(client_id.encode('utf-8'), digest_size=8).digest()
+        # Zero marks an empty slot
+        return int.from_bytes(digest, 'little') | 1
+
+    def _find_slot(self, key: int, now: float) -> Tuple[int, bool]:
+        """Return (slot, is_existing) for ``key``, reusing a free or stale slot if new."""
+        slots = self._slots
+        positions = (key % self.max_clients + np.arange(self.PROBE_LENGTH)) % self.max_clients
+        keys = slots['key'][positions]
+        last_seen = slots['last_seen'][positions]
+        live = (keys != 0) & (now - last_seen <= self.idle_ttl)
+
+        match = np.flatnonzero(live & (keys == key))
+        if len(match):
+            return int(positions[match[0]]), True
+        free = np.flatnonzero(~live)
+        if len(free):
+            return int(positions[free[0]]), False
+        return int(positions[np.argmin(last_seen)]), False
+
+    def record(self, client_id: str, lat: float, lon: float) -> Optional[Motion]:
+        if self._pid != os.getpid():
+            # Forked after opening (e.g. gunicorn --preload): reopen in this process
+            self._open()
+        key = self._key(client_id)
+        now = time.time()
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                index, existing = self._find_slot(key, now)
+                slot = self._slots[index]
+                if not existing:
+                    slot['key'] = key
+                    slot['count'] = 0
+                    slot['head'] = 0
+                head = int(slot['head'])
+                slot['lat'][head] = lat
+                slot['lon'][head] = lon
+                slot['head'] = (head + 1) % self.history
+                count = min(int(slot['count']) + 1, self.history)
+                slot['count'] = count
+                slot['last_seen'] = now
+                oldest = (head + 1 - count) % self.history
+                first = (float(slot['lat'][oldest]), float(slot['lon'][oldest]))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        if count < 2:
+            return None
+        return _average_step((lat, lon), first, count)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        slots = self._slots
+        live = (slots['key'] != 0) & (now - slots['last_seen'] <= self.idle_ttl)
+        return {
+            'backend': 'shared',
+            'path': self.path,
+            'clients': int(live.sum()),
+            'max_clients': self.max_clients,
+        }
+
+
+def create_client_state_store():
+    """
+    Build the client state store configured by the environment.
+
+    CLIENT_STATE_BACKEND selects 'memory' (default, per process) or
+    'shared' (memory-mapped file at CLIENT_STATE_PATH, shared by all
+    workers on the host).
+    """
+    backend = os.getenv('CLIENT_STATE_BACKEND', 'memory')
+    max_clients = int(os.getenv('CLIENT_STATE_MAX_CLIENTS', DEFAULT_MAX_CLIENTS))
+    idle_ttl = float(os.getenv('CLIENT_STATE_TTL', DEFAULT_IDLE_TTL))
+    if backend == 'shared':
+        default_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        path = os.getenv('CLIENT_STATE_PATH', os.path.join(default_dir, 'osm_lanes_client_state'))
+        return SharedClientStateStore(path, max_clients=max_clients, idle_ttl=idle_ttl)
+    if backend != 'memory':
+        raise ValueError(f"Unknown CLIENT_STATE_BACKEND: {backend}")
+    return MemoryClientStateStore(max_clients=max_clients, idle_ttl=idle_ttl)
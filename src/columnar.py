@@ -0,0 +1,174 @@
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Integer tag columns (lanes, lanes_forward, lanes_backward) use this for "not tagged"
+MISSING = -1
+
+# Every array of a batch, in constructor order
+DTYPES = {
+    'node_id': np.dtype(np.int64),
+    'lat': np.dtype(np.float64),
+    'lon': np.dtype(np.float64),
+    'node_version': np.dtype(np.int32),
+    'node_timestamp': np.dtype('datetime64[s]'),
+    'way_id': np.dtype(np.int64),
+    'way_version': np.dtype(np.int32),
+    'way_timestamp': np.dtype('datetime64[s]'),
+    'lanes': np.dtype(np.int32),
+    'lanes_forward': np.dtype(np.int32),
+    'lanes_backward': np.dtype(np.int32),
+    'highway_type': np.dtype(object),
+    'name': np.dtype(object),
+    'maxspeed': np.dtype(object),
+    'way_node_offsets': np.dtype(np.int64),
+    'way_node_ids': np.dtype(np.int64),
+}
+
+
+class OSMColumns:
+    """
+    Columnar batch of parsed OSM data.
+
+    Nodes are parallel arrays ``node_id``, ``lat``, ``lon``, ``node_version``
+    and ``node_timestamp`` (datetime64[s]). Ways are parallel arrays
+    ``way_id``, ``way_version``, ``way_timestamp`` and one array per tag
+    column: ``lanes``, ``lanes_forward`` and ``lanes_backward`` are int32
+    with ``MISSING`` for untagged ways, ``highway_type``, ``name`` and
+    ``maxspeed`` are object arrays of str or None. Way node sequences are in
+    CSR layout: the node IDs of way ``i`` are
+    ``way_node_ids[way_node_offsets[i]:way_node_offsets[i + 1]]``.
+
+    Accepted wherever (nodes, ways, way_nodes) batches of dicts are, by
+    ``DatabaseManager.bulk_store_osm_data`` and ``SpatialIndex.load_columns``.
+    """
+
+    def __init__(
+        self,
+        node_id: np.ndarray,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        node_version: np.ndarray,
+        node_timestamp: np.ndarray,
+        way_id: np.ndarray,
+        way_version: np.ndarray,
+        way_timestamp: np.ndarray,
+        lanes: np.ndarray,
+        lanes_forward: np.ndarray,
+        lanes_backward: np.ndarray,
+        highway_type: np.ndarray,
+        name: np.ndarray,
+        maxspeed: np.ndarray,
+        way_node_offsets: np.ndarray,
+        way_node_ids: np.ndarray,
+    ):
+        self.node_id = node_id
+        self.lat = lat
+        self.lon = lon
+        self.node_version = node_version
+        self.node_timestamp = node_timestamp
+        self.way_id = way_id
+        self.way_version = way_version
+        self.way_timestamp = way_timestamp
+        self.lanes = lanes
+        self.lanes_forward = lanes_forward
+        self.lanes_backward = lanes_backward
+        self.highway_type = highway_type
+        self.name = name
+        self.maxspeed = maxspeed
+        self.way_node_offsets = way_node_offsets
+        self.way_node_ids = way_node_ids
+
+    @classmethod
+    def empty(cls) -> 'OSMColumns':
+        return concat_columns([])
+
+    @property
+    def node_count(self) -> int:
+        return len(self.node_id)
+
+    @property
+    def way_count(self) -> int:
+        return len(self.way_id)
+
+    @property
+    def rows(self) -> int:
+        """Rows this batch stages: nodes + ways + way_nodes."""
+        return len(self.node_id) + len(self.way_id) + len(self.way_node_ids)
+
+    def way_node_counts(self) -> np.ndarray:
+        return np.diff(self.way_node_offsets)
+
+    def way_node_way_ids(self) -> np.ndarray:
+        """``way_id`` of every entry of ``way_node_ids``."""
+        return np.repeat(self.way_id, self.way_node_counts())
+
+    def way_node_sequences(self) -> np.ndarray:
+        """Position of every entry of ``way_node_ids`` within its way."""
+        counts = self.way_node_counts()
+        starts = np.repeat(self.way_node_offsets[:-1], counts)
+        return np.arange(len(self.way_node_ids), dtype=np.int64) - starts
+
+    def way_rows(self) -> List[Tuple[Any, ...]]:
+        """(way_id, lanes, lanes_forward, lanes_backward, highway_type, name, maxspeed) tuples."""
+        def nullable(values: np.ndarray) -> List[Optional[int]]:
+            return [None if v == MISSING else v for v in values.tolist()]
+
+        return list(zip(
+            self.way_id.tolist(),
+            nullable(self.lanes),
+            nullable(self.lanes_forward),
+            nullable(self.lanes_backward),
+            self.highway_type.tolist(),
+            self.name.tolist(),
+            self.maxspeed.tolist(),
+        ))
+
+    def node_positions(self, node_ids: np.ndarray) -> np.ndarray:
+        """Index into the node arrays for each of ``node_ids``, or -1 where absent."""
+        if not len(self.node_id):
+            return np.full(len(node_ids), -1, dtype=np.int64)
+        order = np.argsort(self.node_id, kind='stable')
+        sorted_ids = self.node_id[order]
+        found = np.searchsorted(sorted_ids, node_ids)
+        found = np.minimum(found, len(sorted_ids) - 1)
+        return np.where(sorted_ids[found] == node_ids, order[found], -1)
+
+    def segments(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Consecutive node pairs of every way, like the ``way_segments`` table.
+
+        Returns (way position, lat1, lon1, lat2, lon2) arrays, where way
+        position indexes the way arrays. Pairs with a node missing from this
+        batch are skipped.
+        """
+        ids = self.way_node_ids
+        if len(ids) < 2:
+            empty = np.empty(0, dtype=np.float64)
+            return np.empty(0, dtype=np.int64), empty, empty, empty, empty
+        owner = np.repeat(np.arange(len(self.way_id), dtype=np.int64), self.way_node_counts())
+        positions = self.node_positions(ids)
+        # A pair is valid when both ends belong to the same way and are known
+        keep = (owner[:-1] == owner[1:]) & (positions[:-1] >= 0) & (positions[1:] >= 0)
+        start = positions[:-1][keep]
+        end = positions[1:][keep]
+        return owner[:-1][keep], self.lat[start], self.lon[start], self.lat[end], self.lon[end]
+
+
+def concat_columns(batches: Iterable[OSMColumns]) -> OSMColumns:
+    """Join batches into one, e.g. so ways can find nodes parsed in earlier batches."""
+    batches = list(batches)
+    arrays = {}
+    for name, dtype in DTYPES.items():
+        if name == 'way_node_offsets':
+            continue
+        parts = [getattr(batch, name) for batch in batches]
+        arrays[name] = np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+
+    offsets = [np.zeros(1, dtype=np.int64)]
+    base = 0
+    for batch in batches:
+        offsets.append(batch.way_node_offsets[1:] + base)
+        base += len(batch.way_node_ids)
+    arrays['way_node_offsets'] = np.concatenate(offsets)
+    return OSMColumns(**arrays)
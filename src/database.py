@@ -1,77 +1,905 @@
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.dialects.postgresql import insert
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional, Sequence, Set, Tuple, Union
+from datetime import datetime
+from io import StringIO
 import os
+import time
 from dotenv import load_dotenv
-from models import Base, Node, Way, WayNode, UserData
+import numpy as np
+from models import Base
+from polyline import ZOOM_BANDS, FULL_RESOLUTION_BAND
+from columnar import MISSING, OSMColumns
+from speed_rollups import SPEED_BIN_WIDTH, SPEED_BINS, ALL_TIME_BUCKET, aggregate
 
 load_dotenv()
 
+NODE_COLUMNS = ('node_id', 'lat', 'lon', 'version', 'timestamp')
+WAY_COLUMNS = (
+    'way_id', 'lanes', 'lanes_forward', 'lanes_backward',
+    'highway_type', 'name', 'maxspeed', 'version', 'timestamp',
+)
+WAY_NODE_COLUMNS = ('way_id', 'node_id', 'sequence')
+USER_DATA_COLUMNS = (
+    'lat', 'lon', 'timestamp', 'speed', 'lane_index', 'segment_id', 'device_id', 'created_at',
+)
+
+# Staging tables live for the duration of one bulk load transaction
+STAGING_DDL = """
+CREATE TEMP TABLE staging_nodes (
+    node_id bigint, lat double precision, lon double precision,
+    version integer, timestamp timestamp
+) ON COMMIT DROP;
+CREATE TEMP TABLE staging_ways (
+    way_id bigint, lanes integer, lanes_forward integer, lanes_backward integer,
+    highway_type varchar(50), name varchar(255), maxspeed varchar(20),
+    version integer, timestamp timestamp
+) ON COMMIT DROP;
+CREATE TEMP TABLE staging_way_nodes (
+    way_id bigint, node_id bigint, sequence integer
+) ON COMMIT DROP;
+CREATE TEMP TABLE changed_nodes (node_id bigint PRIMARY KEY) ON COMMIT DROP;
+CREATE TEMP TABLE changed_ways (way_id bigint PRIMARY KEY) ON COMMIT DROP;
+CREATE TEMP TABLE affected_ways (way_id bigint PRIMARY KEY) ON COMMIT DROP;
+"""
+
+# (xmax = 0) is true for freshly inserted rows and false for updated ones
+MERGE_NODES_SQL = """
+WITH merged AS (
+    INSERT INTO nodes (node_id, lat, lon, version, timestamp, geom)
+    SELECT DISTINCT ON (node_id)
+           node_id, lat, lon, version, timestamp,
+           ST_SetSRID(ST_MakePoint(lon, lat), 4326)
+    FROM staging_nodes s
+    {source_filter}
+    ORDER BY node_id, version DESC NULLS LAST
+    ON CONFLICT (node_id) DO UPDATE SET
+        lat = EXCLUDED.lat,
+        lon = EXCLUDED.lon,
+        version = EXCLUDED.version,
+        timestamp = EXCLUDED.timestamp,
+        geom = EXCLUDED.geom
+    WHERE {version_check}
+    RETURNING node_id, (xmax = 0) AS inserted
+), recorded AS (
+    INSERT INTO changed_nodes (node_id) SELECT node_id FROM merged
+)
+SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted)
+FROM merged
+"""
+
+# Version checks for the merges: any change (full loads) or only newer (diffs)
+VERSION_CHANGED = "{table}.version IS DISTINCT FROM EXCLUDED.version"
+VERSION_NEWER = "{table}.version IS NULL OR EXCLUDED.version > {table}.version"
+
+# Diffs carry nodes from everywhere; keep only nodes we store or now reference
+TRACKED_NODES_FILTER = """
+    WHERE EXISTS (SELECT 1 FROM nodes n WHERE n.node_id = s.node_id)
+       OR EXISTS (SELECT 1 FROM staging_way_nodes wn WHERE wn.node_id = s.node_id)
+"""
+
+MERGE_WAYS_SQL = """
+WITH merged AS (
+    INSERT INTO ways (way_id, lanes, lanes_forward, lanes_backward,
+                      highway_type, name, maxspeed, version, timestamp)
+    SELECT DISTINCT ON (way_id)
+           way_id, lanes, lanes_forward, lanes_backward,
+           highway_type, name, maxspeed, version, timestamp
+    FROM staging_ways
+    ORDER BY way_id, version DESC NULLS LAST
+    ON CONFLICT (way_id) DO UPDATE SET
+        lanes = EXCLUDED.lanes,
+        lanes_forward = EXCLUDED.lanes_forward,
+        lanes_backward = EXCLUDED.lanes_backward,
+        highway_type = EXCLUDED.highway_type,
+        name = EXCLUDED.name,
+        maxspeed = EXCLUDED.maxspeed,
+        version = EXCLUDED.version,
+        timestamp = EXCLUDED.timestamp
+    WHERE {version_check}
+    RETURNING way_id, (xmax = 0) AS inserted
+), recorded AS (
+    INSERT INTO changed_ways (way_id) SELECT way_id FROM merged
+)
+SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted)
+FROM merged
+"""
+
+# Deletions from osmChange files, applied only when not older than the stored row
+CHANGE_STAGING_DDL = """
+CREATE TEMP TABLE staging_deleted_nodes (node_id bigint, version integer) ON COMMIT DROP;
+CREATE TEMP TABLE staging_deleted_ways (way_id bigint, version integer) ON COMMIT DROP;
+CREATE TEMP TABLE deleted_ways (way_id bigint PRIMARY KEY) ON COMMIT DROP;
+"""
+
+DELETE_WAYS_SQL = """
+INSERT INTO deleted_ways (way_id)
+SELECT DISTINCT w.way_id
+FROM ways w
+JOIN staging_deleted_ways d ON d.way_id = w.way_id
+WHERE w.version IS NULL OR d.version IS NULL OR w.version <= d.version;
+DELETE FROM way_shapes t USING deleted_ways d WHERE t.way_id = d.way_id;
+DELETE FROM way_segments t USING deleted_ways d WHERE t.way_id = d.way_id;
+DELETE FROM way_nodes t USING deleted_ways d WHERE t.way_id = d.way_id;
+DELETE FROM ways t USING deleted_ways d WHERE t.way_id = d.way_id;
+"""
+
+# A way created or modified and then deleted in the same diff is dropped from
+# staging, so the merge does not bring it back after DELETE_WAYS_SQL
+PRUNE_DELETED_WAYS_SQL = """
+DELETE FROM staging_ways s
+USING staging_deleted_ways d
+WHERE d.way_id = s.way_id
+  AND (s.version IS NULL OR d.version IS NULL OR s.version <= d.version);
+DELETE FROM staging_way_nodes wn
+WHERE EXISTS (SELECT 1 FROM staging_deleted_ways d WHERE d.way_id = wn.way_id)
+  AND NOT EXISTS (SELECT 1 FROM staging_ways s WHERE s.way_id = wn.way_id);
+"""
+
+# Nodes still used by a stored way are kept
+DELETE_NODES_SQL = """
+DELETE FROM nodes n
+USING staging_deleted_nodes d
+WHERE n.node_id = d.node_id
+  AND (n.version IS NULL OR d.version IS NULL OR n.version <= d.version)
+  AND NOT EXISTS (SELECT 1 FROM way_nodes wn WHERE wn.node_id = n.node_id)
+"""
+
+# Nodes referenced by changed ways that are neither stored nor in the diff
+MISSING_NODES_SQL = """
+SELECT DISTINCT wn.node_id
+FROM staging_way_nodes wn
+WHERE NOT EXISTS (SELECT 1 FROM nodes n WHERE n.node_id = wn.node_id)
+  AND NOT EXISTS (SELECT 1 FROM staging_nodes s WHERE s.node_id = wn.node_id)
+"""
+
+UPDATE_REPLICATION_STATE_SQL = """
+INSERT INTO replication_state (id, sequence_number, applied_at)
+VALUES (1, %(sequence)s, now())
+ON CONFLICT (id) DO UPDATE SET
+    sequence_number = EXCLUDED.sequence_number,
+    applied_at = EXCLUDED.applied_at
+"""
+
+RECORD_IMPORTED_FILE_SQL = """
+INSERT INTO imported_files (sha256, path, size, imported_at)
+VALUES (%(sha256)s, %(path)s, %(size)s, now())
+ON CONFLICT (sha256) DO UPDATE SET
+    path = EXCLUDED.path,
+    imported_at = EXCLUDED.imported_at
+"""
+
+USER_DATA_POINTS_SQL = """
+SELECT id, device_id, timestamp, lat, lon
+FROM user_data
+WHERE lat IS NOT NULL AND lon IS NOT NULL AND timestamp IS NOT NULL
+  AND (CAST(:since AS timestamp) IS NULL OR timestamp >= CAST(:since AS timestamp))
+  AND (CAST(:until AS timestamp) IS NULL OR timestamp < CAST(:until AS timestamp))
+ORDER BY device_id NULLS LAST, timestamp, id
+"""
+
+UPDATE_SEGMENT_IDS_SQL = """
+UPDATE user_data u
+SET segment_id = s.segment_id
+FROM staging_segment_ids s
+WHERE u.id = s.id
+  AND u.segment_id IS DISTINCT FROM s.segment_id
+"""
+
+# Partial rollups of one batch are merged with Chan et al.'s parallel
+# mean/variance update and an element-wise histogram sum
+MERGE_SPEED_ROLLUPS_SQL = """
+INSERT INTO speed_rollups AS r
+    (segment_id, lane_index, bucket, count, mean, m2, histogram, updated_at)
+SELECT segment_id, lane_index, bucket, count, mean, m2, histogram, now()
+FROM staging_speed_rollups
+-- Lock rows in key order so concurrent writers cannot deadlock
+ORDER BY segment_id, lane_index, bucket
+ON CONFLICT (segment_id, lane_index, bucket) DO UPDATE SET
+    count = r.count + EXCLUDED.count,
+    mean = r.mean + (EXCLUDED.mean - r.mean) * EXCLUDED.count / (r.count + EXCLUDED.count),
+    m2 = r.m2 + EXCLUDED.m2
+        + (EXCLUDED.mean - r.mean) * (EXCLUDED.mean - r.mean)
+          * r.count * EXCLUDED.count / (r.count + EXCLUDED.count),
+    histogram = ARRAY(
+        SELECT a + b FROM unnest(r.histogram, EXCLUDED.histogram) WITH ORDINALITY AS h(a, b, i)
+        ORDER BY i
+    ),
+    updated_at = now()
+"""
+
+# Full rebuild from user_data; buckets match speed_rollups.time_bucket
+REBUILD_SPEED_ROLLUPS_SQL = """
+INSERT INTO speed_rollups (segment_id, lane_index, bucket, count, mean, m2, histogram, updated_at)
+WITH probes AS (
+    SELECT u.segment_id, u.lane_index, b.bucket, u.speed,
+           LEAST(GREATEST(floor(u.speed / {bin_width})::int, 0), {last_bin}) AS bin
+    FROM user_data u
+    CROSS JOIN LATERAL (VALUES
+        ((EXTRACT(ISODOW FROM u.timestamp)::int - 1) * 24 + EXTRACT(HOUR FROM u.timestamp)::int),
+        ({all_time})
+    ) AS b(bucket)
+    WHERE u.segment_id IS NOT NULL AND u.lane_index IS NOT NULL
+      AND u.speed IS NOT NULL AND u.timestamp IS NOT NULL
+),
+stats AS (
+    SELECT segment_id, lane_index, bucket, count(*) AS count, avg(speed) AS mean,
+           var_pop(speed) * count(*) AS m2
+    FROM probes
+    GROUP BY segment_id, lane_index, bucket
+),
+bins AS (
+    SELECT segment_id, lane_index, bucket, bin, count(*)::int AS n
+    FROM probes
+    GROUP BY segment_id, lane_index, bucket, bin
+),
+histograms AS (
+    SELECT s.segment_id, s.lane_index, s.bucket,
+           array_agg(COALESCE(b.n, 0) ORDER BY g.bin) AS histogram
+    FROM stats s
+    CROSS JOIN generate_series(0, {last_bin}) AS g(bin)
+    LEFT JOIN bins b
+      ON b.segment_id = s.segment_id AND b.lane_index = s.lane_index
+     AND b.bucket = s.bucket AND b.bin = g.bin
+    GROUP BY s.segment_id, s.lane_index, s.bucket
+)
+SELECT s.segment_id, s.lane_index, s.bucket, s.count, s.mean, s.m2, h.histogram, now()
+FROM stats s
+JOIN histograms h USING (segment_id, lane_index, bucket)
+""".format(bin_width=SPEED_BIN_WIDTH, last_bin=SPEED_BINS - 1, all_time=ALL_TIME_BUCKET)
+
+SPEED_ROLLUPS_SQL = """
+SELECT r.segment_id, r.lane_index, r.bucket, r.count, r.mean, r.m2, r.histogram
+FROM unnest(
+    CAST(:segment_ids AS varchar[]), CAST(:lane_indexes AS integer[]), CAST(:buckets AS integer[])
+) AS k(segment_id, lane_index, bucket)
+JOIN speed_rollups r USING (segment_id, lane_index, bucket)
+"""
+
+# Node sequences of changed ways are replaced wholesale
+REPLACE_WAY_NODES_SQL = """
+DELETE FROM way_nodes wn USING changed_ways c WHERE wn.way_id = c.way_id
+"""
+
+INSERT_WAY_NODES_SQL = """
+INSERT INTO way_nodes (way_id, node_id, sequence)
+SELECT DISTINCT s.way_id, s.node_id, s.sequence
+FROM staging_way_nodes s
+JOIN changed_ways c ON c.way_id = s.way_id
+JOIN nodes n ON n.node_id = s.node_id
+ON CONFLICT DO NOTHING
+"""
+
+# Ways whose geometry must be rebuilt: changed ways and ways using moved nodes
+AFFECTED_WAYS_SQL = """
+INSERT INTO affected_ways (way_id)
+SELECT way_id FROM changed_ways
+UNION
+SELECT wn.way_id FROM way_nodes wn JOIN changed_nodes c ON c.node_id = wn.node_id
+"""
+
+BUILD_WAY_SEGMENTS_SQL = """
+INSERT INTO way_segments (way_id, sequence, geom)
+SELECT way_id, sequence, ST_MakeLine(geom, COALESCE(next_geom, geom))
+FROM (
+    SELECT wn.way_id, wn.sequence, n.geom,
+           LEAD(n.geom) OVER (PARTITION BY wn.way_id ORDER BY wn.sequence) AS next_geom,
+           count(*) OVER (PARTITION BY wn.way_id) AS node_count
+    FROM way_nodes wn
+    JOIN nodes n ON n.node_id = wn.node_id
+    {where}
+) s
+WHERE next_geom IS NOT NULL OR node_count = 1
+"""
+
+REPLACE_AFFECTED_SEGMENTS_SQL = (
+    "DELETE FROM way_segments s USING affected_ways a WHERE s.way_id = a.way_id;\n"
+    + BUILD_WAY_SEGMENTS_SQL.format(
+        where="WHERE wn.way_id IN (SELECT way_id FROM affected_ways)"
+    )
+)
+
+# Zoom band shapes: the full line per way, simplified once per band tolerance
+BUILD_WAY_SHAPES_SQL = """
+INSERT INTO way_shapes (way_id, band, geom)
+SELECT l.way_id, b.band,
+       CASE WHEN b.tolerance > 0
+            THEN ST_SimplifyPreserveTopology(l.geom, b.tolerance)
+            ELSE l.geom END
+FROM (
+    SELECT wn.way_id, ST_MakeLine(n.geom ORDER BY wn.sequence) AS geom
+    FROM way_nodes wn
+    JOIN nodes n ON n.node_id = wn.node_id
+    {where}
+    GROUP BY wn.way_id
+    HAVING count(*) > 1
+) l
+CROSS JOIN (VALUES {bands}) AS b(band, tolerance)
+"""
+
+ZOOM_BAND_VALUES = ', '.join(
+    f"({band}, {float(tolerance)})" for band, (_, tolerance) in enumerate(ZOOM_BANDS)
+)
+
+REPLACE_AFFECTED_SHAPES_SQL = (
+    "DELETE FROM way_shapes s USING affected_ways a WHERE s.way_id = a.way_id;\n"
+    + BUILD_WAY_SHAPES_SQL.format(
+        where="WHERE wn.way_id IN (SELECT way_id FROM affected_ways)",
+        bands=ZOOM_BAND_VALUES,
+    )
+)
+
+BUMP_REVISION_SQL = """
+INSERT INTO network_revision (id, revision, updated_at)
+VALUES (1, 1, now())
+ON CONFLICT (id) DO UPDATE SET
+    revision = network_revision.revision + 1,
+    updated_at = now()
+"""
+
+# Index-ordered KNN (<->) over segment lines; the point must be
+# inlined in ORDER BY for the GiST index to drive the scan
+NEAREST_WAY_SQL = """
+SELECT w.way_id, w.lanes, w.lanes_forward, w.lanes_backward,
+       w.highway_type, w.name, w.maxspeed, nearest.distance
+FROM (
+    SELECT s.way_id,
+           s.geom <-> ST_SetSRID(ST_MakePoint(:lon, :lat), 4326) AS distance
+    FROM way_segments s
+    ORDER BY s.geom <-> ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)
+    LIMIT 1
+) nearest
+JOIN ways w ON w.way_id = nearest.way_id
+WHERE nearest.distance <= :max_distance
+"""
+
+# One KNN probe per input point; ORDINALITY keeps results in input order
+NEAREST_WAYS_SQL = """
+SELECT q.idx, w.way_id, w.lanes, w.lanes_forward, w.lanes_backward,
+       w.highway_type, w.name, w.maxspeed, nearest.distance
+FROM unnest(
+    CAST(:lats AS double precision[]),
+    CAST(:lons AS double precision[]),
+    CAST(:max_distances AS double precision[])
+) WITH ORDINALITY AS q(lat, lon, max_distance, idx)
+LEFT JOIN LATERAL (
+    SELECT s.way_id,
+           s.geom <-> ST_SetSRID(ST_MakePoint(q.lon, q.lat), 4326) AS distance
+    FROM way_segments s
+    ORDER BY s.geom <-> ST_SetSRID(ST_MakePoint(q.lon, q.lat), 4326)
+    LIMIT 1
+) nearest ON nearest.distance <= q.max_distance
+LEFT JOIN ways w ON w.way_id = nearest.way_id
+ORDER BY q.idx
+"""
+
+# Up to :limit nearest segments per point, with their endpoints, for the lookup cache
+NEARBY_SEGMENTS_SQL = """
+SELECT q.idx, w.way_id, w.lanes, w.lanes_forward, w.lanes_backward,
+       w.highway_type, w.name, w.maxspeed,
+       ST_Y(ST_StartPoint(near.geom)) AS lat1, ST_X(ST_StartPoint(near.geom)) AS lon1,
+       ST_Y(ST_EndPoint(near.geom)) AS lat2, ST_X(ST_EndPoint(near.geom)) AS lon2,
+       near.distance
+FROM unnest(
+    CAST(:lats AS double precision[]),
+    CAST(:lons AS double precision[]),
+    CAST(:radii AS double precision[])
+) WITH ORDINALITY AS q(lat, lon, radius, idx)
+JOIN LATERAL (
+    SELECT s.way_id, s.geom,
+           s.geom <-> ST_SetSRID(ST_MakePoint(q.lon, q.lat), 4326) AS distance
+    FROM way_segments s
+    ORDER BY s.geom <-> ST_SetSRID(ST_MakePoint(q.lon, q.lat), 4326)
+    LIMIT CAST(:limit AS integer)
+) near ON near.distance <= q.radius
+JOIN ways w ON w.way_id = near.way_id
+ORDER BY q.idx, near.distance
+"""
+
+ROAD_SEGMENTS_SQL = """
+SELECT way_id,
+       ST_Y(ST_StartPoint(geom)) AS lat1, ST_X(ST_StartPoint(geom)) AS lon1,
+       ST_Y(ST_EndPoint(geom)) AS lat2, ST_X(ST_EndPoint(geom)) AS lon2
+FROM way_segments
+"""
+
+
+def _copy_value(value: Any) -> str:
+    """Format a value for PostgreSQL COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+
+def _copy_rows(cursor, table: str, columns: Sequence[str], rows: Iterable[Dict[str, Any]]) -> None:
+    """Stream dict rows into ``table`` with COPY ... FROM STDIN."""
+    buffer = StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(row.get(column)) for column in columns))
+        buffer.write('\n')
+    if not buffer.tell():
+        return
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer
+    )
+
+def get_database_url() -> str:
+    """DATABASE_URL, defaulting to the local osm_data database of the current user."""
+    # Use system username instead of 'postgres'
+    return os.getenv('DATABASE_URL', f'postgresql://{os.getenv("USER")}@localhost:5432/osm_data')
+
+def segment_polylines_query(
+    name: Optional[str] = None,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+    after: Optional[int] = None,
+    limit: Optional[int] = None,
+    band: int = FULL_RESOLUTION_BAND,
+) -> Tuple[str, Dict[str, Any]]:
+    """Build the SQL and named parameters for ``DatabaseManager.get_segment_polylines``."""
+    conditions = []
+    params = {}
+    if name:
+        conditions.append("w.name ILIKE :name")
+        params['name'] = f"%{name}%"
+    if bbox is not None:
+        conditions.append("""EXISTS (
+            SELECT 1 FROM way_segments s
+            WHERE s.way_id = w.way_id
+              AND s.geom && ST_MakeEnvelope(:min_lon, :min_lat, :max_lon, :max_lat, 4326)
+        )""")
+        params.update(zip(('min_lon', 'min_lat', 'max_lon', 'max_lat'), bbox))
+    if after is not None:
+        conditions.append("w.way_id > :after")
+        params['after'] = after
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    limit_clause = ""
+    if limit is not None:
+        limit_clause = "LIMIT :limit"
+        params['limit'] = limit
+
+    query = f"""
+    WITH page AS (
+        SELECT w.way_id, w.name
+        FROM ways w
+        {where}
+        ORDER BY w.way_id
+        {limit_clause}
+    )
+    SELECT p.way_id, p.name,
+           CAST(ST_AsGeoJSON(ST_FlipCoordinates(ws.geom)) AS json) -> 'coordinates' AS polyline
+    FROM page p
+    JOIN way_shapes ws ON ws.way_id = p.way_id AND ws.band = :band
+    ORDER BY p.way_id
+    """
+    params['band'] = band
+    return query, params
+
+def _copy_array(values: np.ndarray, nullable: bool = False) -> List[str]:
+    """Format a column array for COPY text format. ``nullable`` int columns map MISSING to NULL."""
+    if values.dtype.kind == 'M':
+        text = np.datetime_as_string(values, unit='s')
+        return np.where(np.isnat(values), '\\N', text).tolist()
+    if values.dtype == object:
+        return [_copy_value(value) for value in values.tolist()]
+    text = values.astype(str)
+    if nullable:
+        text = np.where(values == MISSING, '\\N', text)
+    return text.tolist()
+
+def _copy_columns(cursor, table: str, columns: Sequence[str], arrays: Sequence[List[str]]) -> None:
+    """Stream pre-formatted column values into ``table`` with COPY ... FROM STDIN."""
+    if not arrays or not len(arrays[0]):
+        return
+    buffer = StringIO()
+    buffer.writelines('\t'.join(values) + '\n' for values in zip(*arrays))
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+def _copy_osm_columns(cursor, batch: OSMColumns) -> None:
+    """Stage a columnar batch without building a row object per element."""
+    _copy_columns(cursor, 'staging_nodes', NODE_COLUMNS, [
+        _copy_array(batch.node_id), _copy_array(batch.lat), _copy_array(batch.lon),
+        _copy_array(batch.node_version), _copy_array(batch.node_timestamp),
+    ])
+    _copy_columns(cursor, 'staging_ways', WAY_COLUMNS, [
+        _copy_array(batch.way_id),
+        _copy_array(batch.lanes, nullable=True),
+        _copy_array(batch.lanes_forward, nullable=True),
+        _copy_array(batch.lanes_backward, nullable=True),
+        _copy_array(batch.highway_type), _copy_array(batch.name), _copy_array(batch.maxspeed),
+        _copy_array(batch.way_version), _copy_array(batch.way_timestamp),
+    ])
+    _copy_columns(cursor, 'staging_way_nodes', WAY_NODE_COLUMNS, [
+        _copy_array(batch.way_node_way_ids()), _copy_array(batch.way_node_ids),
+        _copy_array(batch.way_node_sequences()),
+    ])
+
+def segment_id_for_way(way_id: int) -> str:
+    """Return the ``user_data.segment_id`` value for probes matched to a way."""
+    return f"680N-{way_id}"
+
+def _finish_stats(stats: Dict[str, Any], started: float) -> Dict[str, Any]:
+    """Add row totals and throughput to load stats."""
+    elapsed = time.perf_counter() - started
+    rows = sum(stats[table]['staged'] for table in ('nodes', 'ways', 'way_nodes'))
+    stats['rows'] = rows
+    stats['seconds'] = elapsed
+    stats['rows_per_second'] = rows / elapsed if elapsed > 0 else float(rows)
+    return stats
+
 class DatabaseManager:
     def __init__(self):
-        # Use system username instead of 'postgres'
-        database_url = os.getenv('DATABASE_URL', f'postgresql://{os.getenv("USER")}@localhost:5432/osm_data')
-        self.engine = create_engine(database_url)
+        self.engine = create_engine(get_database_url())
         self.Session = sessionmaker(bind=self.engine)
+        self._change_listeners = []
         
+    def add_change_listener(self, callback: Callable[[Optional[Set[int]]], None]) -> None:
+        """
+        Register a callback invoked after the road network has changed.
+        
+        The callback receives the set of way IDs whose attributes or geometry
+        changed, or None when the whole network was rebuilt.
+        """
+        self._change_listeners.append(callback)
+
+    def _notify_change(self, way_ids: Optional[Set[int]]) -> None:
+        for callback in self._change_listeners:
+            try:
+                callback(way_ids)
+            except Exception as e:
+                print(f"Change listener failed: {e}")
+
     def init_db(self):
         Base.metadata.create_all(self.engine)
+        with self.engine.begin() as conn:
+            # create_all does not add columns to tables created by older versions
+            conn.execute(text(
+                "ALTER TABLE user_data ADD COLUMN IF NOT EXISTS device_id varchar(64)"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_user_data_device_id ON user_data (device_id)"
+            ))
+        with self.engine.connect() as conn:
+            needs_geometry = conn.execute(text(
+                "SELECT (NOT EXISTS (SELECT 1 FROM way_segments) "
+                "OR NOT EXISTS (SELECT 1 FROM way_shapes)) "
+                "AND EXISTS (SELECT 1 FROM way_nodes)"
+            )).scalar()
+        if needs_geometry:
+            self.rebuild_way_geometry()
+
+    def rebuild_way_geometry(self) -> None:
+        """Rebuild ``way_segments`` and ``way_shapes`` from ``way_nodes`` and ``nodes``."""
+        with self.engine.begin() as conn:
+            conn.execute(text("TRUNCATE way_segments, way_shapes"))
+            conn.execute(text(BUILD_WAY_SEGMENTS_SQL.format(where="")))
+            conn.execute(text(BUILD_WAY_SHAPES_SQL.format(where="", bands=ZOOM_BAND_VALUES)))
+            conn.execute(text(BUMP_REVISION_SQL))
+        self._notify_change(None)
         
-    def store_osm_data(self, nodes: List[Dict[str, Any]], ways: List[Dict[str, Any]], way_nodes: List[Dict[str, Any]]):
-        session = self.Session()
+    def store_osm_data(
+        self,
+        nodes: Union[List[Dict[str, Any]], OSMColumns],
+        ways: Optional[List[Dict[str, Any]]] = None,
+        way_nodes: Optional[List[Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Store one parsed batch: (nodes, ways, way_nodes) lists, or an
+        ``OSMColumns`` batch passed alone. See ``bulk_store_osm_data``.
+        """
+        if isinstance(nodes, OSMColumns):
+            return self.bulk_store_osm_data([nodes])
+        return self.bulk_store_osm_data([(nodes, ways or [], way_nodes or [])])
+
+    def bulk_store_osm_data(
+        self,
+        batches: Iterable[Union[Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]], OSMColumns]],
+        source: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Bulk load parsed OSM batches in a single transaction.
+        
+        Each batch is streamed into temporary staging tables with COPY, then
+        merged into ``nodes``/``ways``/``way_nodes`` with set-based upserts.
+        Rows whose OSM version is unchanged are skipped, node geometries are
+        built on the server, and the node sequence of every inserted or
+        updated way is replaced.
+        
+        Args:
+            batches: Iterable of (nodes, ways, way_nodes) tuples as produced
+                by ``parse_osm_xml`` or ``iter_osm_xml``, or of ``OSMColumns``
+                batches from ``iter_osm_xml_columnar``. A ``geom`` key on
+                node dicts is ignored.
+            source: Fingerprint of the file being loaded (see
+                ``snapshot.source_fingerprint``). It is recorded in
+                ``imported_files`` in the same transaction, for
+                ``is_file_imported``.
+            
+        Returns:
+            Dict[str, Any]: Per-table ``staged``/``inserted``/``updated``/
+            ``skipped`` counts under ``nodes``, ``ways`` and ``way_nodes``,
+            plus the total ``rows`` staged, elapsed ``seconds`` and
+            ``rows_per_second``.
+        """
+        started = time.perf_counter()
+        conn = self.engine.raw_connection()
         try:
-            # Store nodes
-            for node_data in nodes:
-                stmt = insert(Node).values(**node_data)
-                stmt = stmt.on_conflict_do_update(
-                    index_elements=['node_id'],
-                    set_=node_data
-                )
-                session.execute(stmt)
-            
-            # Store ways
-            for way_data in ways:
-                stmt = insert(Way).values(**way_data)
-                stmt = stmt.on_conflict_do_update(
-                    index_elements=['way_id'],
-                    set_=way_data
-                )
-                session.execute(stmt)
-            
-            # Store way_nodes
-            for way_node_data in way_nodes:
-                stmt = insert(WayNode).values(**way_node_data)
-                stmt = stmt.on_conflict_do_nothing()
-                session.execute(stmt)
-            
-            session.commit()
+            cursor = conn.cursor()
+            cursor.execute(STAGING_DDL)
+            
+            for batch in batches:
+                if isinstance(batch, OSMColumns):
+                    _copy_osm_columns(cursor, batch)
+                    continue
+                nodes, ways, way_nodes = batch
+                _copy_rows(cursor, 'staging_nodes', NODE_COLUMNS, nodes)
+                _copy_rows(cursor, 'staging_ways', WAY_COLUMNS, ways)
+                _copy_rows(cursor, 'staging_way_nodes', WAY_NODE_COLUMNS, way_nodes)
+            
+            stats, affected_way_ids = self._merge_staged(cursor)
+            if source is not None:
+                cursor.execute(RECORD_IMPORTED_FILE_SQL, source)
+            conn.commit()
         except Exception as e:
-            session.rollback()
+            conn.rollback()
             raise e
+        finally:
+            conn.close()
+        
+        if affected_way_ids:
+            self._notify_change(affected_way_ids)
+        
+        return _finish_stats(stats, started)
+    
+    def _merge_staged(
+        self, cursor, newer_only: bool = False, tracked_nodes_only: bool = False
+    ) -> Tuple[Dict[str, Any], Set[int]]:
+        """
+        Merge the staging tables into the network tables and rebuild geometry.
+        
+        Returns the per-table stats and the IDs of ways whose data or
+        geometry changed (empty if nothing changed).
+        """
+        version_check = VERSION_NEWER if newer_only else VERSION_CHANGED
+        merge_nodes_sql = MERGE_NODES_SQL.format(
+            source_filter=TRACKED_NODES_FILTER if tracked_nodes_only else "",
+            version_check=version_check.format(table='nodes'),
+        )
+        merge_ways_sql = MERGE_WAYS_SQL.format(version_check=version_check.format(table='ways'))
+        
+        stats = {}
+        for table, count_sql, merge_sql in (
+            ('nodes', 'SELECT count(DISTINCT node_id) FROM staging_nodes', merge_nodes_sql),
+            ('ways', 'SELECT count(DISTINCT way_id) FROM staging_ways', merge_ways_sql),
+        ):
+            cursor.execute(count_sql)
+            staged = cursor.fetchone()[0]
+            cursor.execute(merge_sql)
+            inserted, updated = cursor.fetchone()
+            stats[table] = {
+                'staged': staged,
+                'inserted': inserted,
+                'updated': updated,
+                'skipped': staged - inserted - updated,
+            }
+        
+        cursor.execute('SELECT count(*) FROM staging_way_nodes')
+        staged = cursor.fetchone()[0]
+        cursor.execute(REPLACE_WAY_NODES_SQL)
+        cursor.execute(INSERT_WAY_NODES_SQL)
+        inserted = cursor.rowcount
+        stats['way_nodes'] = {
+            'staged': staged,
+            'inserted': inserted,
+            'updated': 0,
+            'skipped': staged - inserted,
+        }
+        
+        cursor.execute(AFFECTED_WAYS_SQL)
+        cursor.execute(REPLACE_AFFECTED_SEGMENTS_SQL)
+        cursor.execute(REPLACE_AFFECTED_SHAPES_SQL)
+        
+        if not any(stats[table]['inserted'] or stats[table]['updated'] for table in stats):
+            return stats, set()
+        cursor.execute(BUMP_REVISION_SQL)
+        cursor.execute('SELECT way_id FROM affected_ways')
+        return stats, {row[0] for row in cursor.fetchall()}
+    
+    def get_replication_sequence(self) -> Optional[int]:
+        """Return the sequence number of the last applied osmChange file, if any."""
+        session = self.Session()
+        try:
+            return session.execute(
+                text("SELECT sequence_number FROM replication_state WHERE id = 1")
+            ).scalar()
         finally:
             session.close()
     
-    def get_nearest_way(self, lat: float, lon: float, max_distance: float = 0.001):
+    def is_file_imported(self, sha256: str) -> bool:
+        """Return True if a file with this SHA-256 was loaded by ``bulk_store_osm_data``."""
         session = self.Session()
         try:
-            query = text("""
-            SELECT w.way_id, w.lanes, w.lanes_forward, w.lanes_backward,
-                   w.highway_type, w.name, w.maxspeed,
-                   ST_Distance(n.geom, ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)) as distance
-            FROM ways w
-            JOIN way_nodes wn ON w.way_id = wn.way_id
-            JOIN nodes n ON wn.node_id = n.node_id
-            WHERE ST_DWithin(
-                n.geom,
-                ST_SetSRID(ST_MakePoint(:lon, :lat), 4326),
-                :max_distance
+            return session.execute(
+                text("SELECT 1 FROM imported_files WHERE sha256 = :sha256"), {'sha256': sha256}
+            ).scalar() is not None
+        finally:
+            session.close()
+    
+    def apply_osm_change(
+        self,
+        batches: Iterable[Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]],
+                                List[Dict[str, Any]], List[Dict[str, Any]]]],
+        sequence: Optional[int] = None,
+        fetch_nodes: Optional[Callable[[List[int]], List[Dict[str, Any]]]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Apply an osmChange diff in a single transaction.
+        
+        Created and modified elements are merged like ``bulk_store_osm_data``
+        but only when their version is newer than the stored one, and only
+        nodes that are already stored or referenced by a changed way are
+        kept. Deletions apply when the stored version is not newer; nodes
+        still used by a way are kept. A way changed and then deleted within
+        the diff is not stored. Geometry is rebuilt for affected ways
+        only and change listeners are notified.
+        
+        Args:
+            batches: Iterable of (nodes, ways, way_nodes, deleted_nodes,
+                deleted_ways) tuples as produced by ``iter_osm_change``;
+                deletions are dicts with ``node_id``/``way_id`` and ``version``
+            sequence: Replication sequence number of the diff. Diffs at or
+                below the last applied sequence are skipped.
+            fetch_nodes: Optional callback returning node dicts for node IDs
+                that changed ways reference but that are neither stored nor
+                part of the diff
+            
+        Returns:
+            Optional[Dict[str, Any]]: Stats as returned by
+            ``bulk_store_osm_data`` plus ``deleted`` node/way counts, or None
+            if the diff was already applied
+        """
+        if sequence is not None:
+            last_sequence = self.get_replication_sequence()
+            if last_sequence is not None and sequence <= last_sequence:
+                return None
+        
+        started = time.perf_counter()
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(STAGING_DDL)
+            cursor.execute(CHANGE_STAGING_DDL)
+            
+            for nodes, ways, way_nodes, deleted_nodes, deleted_ways in batches:
+                _copy_rows(cursor, 'staging_nodes', NODE_COLUMNS, nodes)
+                _copy_rows(cursor, 'staging_ways', WAY_COLUMNS, ways)
+                _copy_rows(cursor, 'staging_way_nodes', WAY_NODE_COLUMNS, way_nodes)
+                _copy_rows(cursor, 'staging_deleted_nodes', ('node_id', 'version'), deleted_nodes)
+                _copy_rows(cursor, 'staging_deleted_ways', ('way_id', 'version'), deleted_ways)
+            cursor.execute(PRUNE_DELETED_WAYS_SQL)
+            
+            if fetch_nodes is not None:
+                cursor.execute(MISSING_NODES_SQL)
+                missing = [row[0] for row in cursor.fetchall()]
+                if missing:
+                    _copy_rows(cursor, 'staging_nodes', NODE_COLUMNS, fetch_nodes(missing))
+            
+            cursor.execute(DELETE_WAYS_SQL)
+            cursor.execute('SELECT way_id FROM deleted_ways')
+            deleted_way_ids = {row[0] for row in cursor.fetchall()}
+            
+            stats, affected_way_ids = self._merge_staged(
+                cursor, newer_only=True, tracked_nodes_only=True
             )
-            ORDER BY distance
-            LIMIT 1
-            """)
             
-            result = session.execute(query, {
+            cursor.execute(DELETE_NODES_SQL)
+            stats['deleted'] = {'nodes': cursor.rowcount, 'ways': len(deleted_way_ids)}
+            
+            if deleted_way_ids and not affected_way_ids:
+                cursor.execute(BUMP_REVISION_SQL)
+            if sequence is not None:
+                cursor.execute(UPDATE_REPLICATION_STATE_SQL, {'sequence': sequence})
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            conn.close()
+        
+        changed_way_ids = affected_way_ids | deleted_way_ids
+        if changed_way_ids:
+            self._notify_change(changed_way_ids)
+        
+        return _finish_stats(stats, started)
+    
+    def get_network_revision(self) -> int:
+        """Return the road network revision, bumped by every load that changes it."""
+        session = self.Session()
+        try:
+            revision = session.execute(
+                text("SELECT revision FROM network_revision WHERE id = 1")
+            ).scalar()
+            return revision or 0
+        finally:
+            session.close()
+
+    def get_road_network(self) -> Tuple[List[Any], List[Any]]:
+        """
+        Load the road network for in-memory indexing.
+        
+        Returns:
+            Tuple[List[Any], List[Any]]: Way rows (way_id, lanes,
+            lanes_forward, lanes_backward, highway_type, name, maxspeed) and
+            segment rows (way_id, lat1, lon1, lat2, lon2), one per pair of
+            consecutive way nodes.
+        """
+        session = self.Session()
+        try:
+            ways = session.execute(text("""
+            SELECT way_id, lanes, lanes_forward, lanes_backward,
+                   highway_type, name, maxspeed
+            FROM ways
+            """)).fetchall()
+            segments = session.execute(text(ROAD_SEGMENTS_SQL)).fetchall()
+            return ways, segments
+        finally:
+            session.close()
+    
+    def get_way_topology(
+        self, way_ids: Optional[Iterable[int]] = None
+    ) -> Tuple[List[Any], List[Any]]:
+        """
+        Load ways and their node sequences for building a road graph.
+        
+        Args:
+            way_ids: Ways to load (default: all). Ways that no longer exist
+                are simply absent from the result.
+        
+        Returns:
+            Tuple[List[Any], List[Any]]: Way rows (way_id, lanes,
+            lanes_forward, lanes_backward, highway_type, name, maxspeed) and
+            way node rows (way_id, node_id, lat, lon) ordered by way and
+            sequence.
+        """
+        where = ""
+        params = {}
+        if way_ids is not None:
+            where = "WHERE {column} = ANY(:way_ids)"
+            params['way_ids'] = [int(way_id) for way_id in way_ids]
+            if not params['way_ids']:
+                return [], []
+        session = self.Session()
+        try:
+            ways = session.execute(text(f"""
+            SELECT way_id, lanes, lanes_forward, lanes_backward,
+                   highway_type, name, maxspeed
+            FROM ways
+            {where.format(column='way_id')}
+            """), params).fetchall()
+            way_nodes = session.execute(text(f"""
+            SELECT wn.way_id, wn.node_id, n.lat, n.lon
+            FROM way_nodes wn
+            JOIN nodes n ON n.node_id = wn.node_id
+            {where.format(column='wn.way_id')}
+            ORDER BY wn.way_id, wn.sequence
+            """), params).fetchall()
+            return ways, way_nodes
+        finally:
+            session.close()
+    
+    def get_nearest_way(self, lat: float, lon: float, max_distance: float = 0.001):
+        session = self.Session()
+        try:
+            result = session.execute(text(NEAREST_WAY_SQL), {
                 'lat': lat,
                 'lon': lon,
                 'max_distance': max_distance
@@ -112,16 +940,278 @@ class DatabaseManager:
             result.distance,
         )
 
-    def store_user_data(self, data: Dict[str, Any]) -> None:
-        """Store user-submitted speed data."""
+    def get_nearest_ways(
+        self,
+        points: Sequence[Tuple[float, float]],
+        max_distance: Union[float, Sequence[float]] = 0.001,
+    ) -> List[Optional[Any]]:
+        """
+        Find the nearest way for many coordinates in a single query.
+        
+        Args:
+            points: Sequence of (lat, lon) tuples
+            max_distance: Maximum search distance in degrees, either one value
+                for all points or one value per point
+            
+        Returns:
+            List[Optional[Any]]: One row per input point, in input order, with
+            the same fields as ``get_nearest_way`` (None where no way is found)
+        """
+        if not points:
+            return []
+        if isinstance(max_distance, (int, float)):
+            max_distances = [float(max_distance)] * len(points)
+        else:
+            max_distances = [float(d) for d in max_distance]
+            if len(max_distances) != len(points):
+                raise ValueError("max_distance must have one value per point")
+
+        session = self.Session()
+        try:
+            rows = session.execute(text(NEAREST_WAYS_SQL), {
+                'lats': [float(lat) for lat, _ in points],
+                'lons': [float(lon) for _, lon in points],
+                'max_distances': max_distances,
+            }).fetchall()
+            return [row if row.way_id is not None else None for row in rows]
+        finally:
+            session.close()
+
+    def get_nearby_segments(
+        self,
+        points: Sequence[Tuple[float, float]],
+        radii: Sequence[float],
+        limit: int,
+    ) -> List[List[Any]]:
+        """
+        Find the nearest way segments around many coordinates in a single query.
+        
+        Args:
+            points: Sequence of (lat, lon) tuples
+            radii: Search distance in degrees for each point
+            limit: Maximum segments per point
+            
+        Returns:
+            List[List[Any]]: For each input point, its segments nearest
+            first, with the fields of ``get_nearest_way`` plus the segment
+            endpoints ``lat1``, ``lon1``, ``lat2`` and ``lon2``
+        """
+        if not points:
+            return []
         session = self.Session()
         try:
-            stmt = insert(UserData).values(**data)
-            session.execute(stmt)
-            session.commit()
+            rows = session.execute(text(NEARBY_SEGMENTS_SQL), {
+                'lats': [float(lat) for lat, _ in points],
+                'lons': [float(lon) for _, lon in points],
+                'radii': [float(radius) for radius in radii],
+                'limit': int(limit),
+            }).fetchall()
+        finally:
+            session.close()
+        segments = [[] for _ in points]
+        for row in rows:
+            segments[row.idx - 1].append(row)
+        return segments
+
+    def get_lanes_at_coordinates(
+        self,
+        points: Sequence[Tuple[float, float]],
+        max_distance: Union[float, Sequence[float]] = 0.001,
+    ) -> List[Tuple[Optional[int], Optional[int], Optional[int], Optional[float]]]:
+        """Bulk version of ``get_lanes_at_coordinate``, one tuple per point."""
+        return [
+            (None, None, None, None) if result is None else (
+                result.lanes,
+                result.lanes_forward,
+                result.lanes_backward,
+                result.distance,
+            )
+            for result in self.get_nearest_ways(points, max_distance)
+        ]
+
+    def get_segment_polylines(
+        self,
+        name: Optional[str] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        after: Optional[int] = None,
+        limit: Optional[int] = None,
+        band: int = FULL_RESOLUTION_BAND,
+    ) -> List[Any]:
+        """
+        Fetch ordered polylines for a page of ways in one query.
+        
+        Args:
+            name: Only include ways whose name contains this text (case-insensitive)
+            bbox: Only include ways with a segment intersecting
+                (min_lon, min_lat, max_lon, max_lat)
+            after: Only include ways with a way_id greater than this (keyset paging)
+            limit: Maximum number of ways to return
+            band: Zoom band whose precomputed, simplified shape is returned
+                (see ``polyline.ZOOM_BANDS``); defaults to full resolution
+            
+        Returns:
+            List[Any]: Rows of (way_id, name, polyline) ordered by way_id, where
+            polyline is a list of [lat, lon] pairs in node order
+        """
+        query, params = segment_polylines_query(name, bbox, after, limit, band)
+        session = self.Session()
+        try:
+            return session.execute(text(query), params).fetchall()
+        finally:
+            session.close()
+
+    def store_user_data(self, data: Dict[str, Any]) -> None:
+        """Store user-submitted speed data and update its speed rollups."""
+        self.store_user_data_batch([data])
+
+    def store_user_data_batch(self, rows: Sequence[Dict[str, Any]]) -> int:
+        """
+        Store many user speed records with a single COPY.
+        
+        Speed rollups of the stored rows are updated in the same transaction.
+        
+        Args:
+            rows: Dicts with the same keys as ``store_user_data``; a missing
+                ``created_at`` is set to the current time
+            
+        Returns:
+            int: Number of rows written
+        """
+        if not rows:
+            return 0
+        now = datetime.utcnow()
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            _copy_rows(
+                cursor, 'user_data', USER_DATA_COLUMNS,
+                (row if row.get('created_at') else {**row, 'created_at': now} for row in rows),
+            )
+            self._merge_speed_rollups(cursor, rows)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            conn.close()
+        return len(rows)
+    
+    def iter_user_data_points(
+        self,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        batch_size: int = 10000,
+    ) -> Iterator[Tuple[int, Optional[str], datetime, float, float]]:
+        """
+        Stream (id, device_id, timestamp, lat, lon) for stored probes.
+        
+        Rows are ordered by device and time, so each device's trajectory is
+        contiguous; probes without a device come last. A server-side cursor
+        keeps memory bounded.
+        """
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(
+                text(USER_DATA_POINTS_SQL), {'since': since, 'until': until}
+            )
+            for row in result:
+                yield tuple(row)
+    
+    def update_user_data_segments(self, assignments: Iterable[Tuple[int, str]]) -> int:
+        """
+        Set ``segment_id`` for many probes at once.
+        
+        Args:
+            assignments: (user_data id, segment_id) pairs
+            
+        Returns:
+            int: Number of rows whose segment_id changed
+        """
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "CREATE TEMP TABLE staging_segment_ids "
+                "(id integer PRIMARY KEY, segment_id varchar(50)) ON COMMIT DROP"
+            )
+            _copy_rows(
+                cursor, 'staging_segment_ids', ('id', 'segment_id'),
+                ({'id': row_id, 'segment_id': segment_id} for row_id, segment_id in assignments),
+            )
+            cursor.execute(UPDATE_SEGMENT_IDS_SQL)
+            updated = cursor.rowcount
+            conn.commit()
         except Exception as e:
-            session.rollback()
+            conn.rollback()
             raise e
+        finally:
+            conn.close()
+        return updated
+    
+    def _merge_speed_rollups(self, cursor, rows: Iterable[Dict[str, Any]]) -> None:
+        """Fold probe rows into ``speed_rollups`` within the caller's transaction."""
+        partials = aggregate(rows)
+        if not partials:
+            return
+        cursor.execute(
+            "CREATE TEMP TABLE staging_speed_rollups ("
+            "segment_id varchar(50), lane_index integer, bucket integer, "
+            "count bigint, mean double precision, m2 double precision, histogram integer[]"
+            ") ON COMMIT DROP"
+        )
+        _copy_rows(
+            cursor, 'staging_speed_rollups',
+            ('segment_id', 'lane_index', 'bucket', 'count', 'mean', 'm2', 'histogram'),
+            (
+                {
+                    'segment_id': segment_id,
+                    'lane_index': lane_index,
+                    'bucket': bucket,
+                    'count': count,
+                    'mean': mean,
+                    'm2': m2,
+                    'histogram': '{' + ','.join(str(n) for n in histogram) + '}',
+                }
+                for (segment_id, lane_index, bucket), (count, mean, m2, histogram) in partials.items()
+            ),
+        )
+        cursor.execute(MERGE_SPEED_ROLLUPS_SQL)
+    
+    def rebuild_speed_rollups(self) -> int:
+        """
+        Recompute ``speed_rollups`` from all of ``user_data``.
+        
+        Use after loading probes outside the API or after map matching
+        rewrote segment IDs. Returns the number of rollup rows.
+        """
+        with self.engine.begin() as conn:
+            conn.execute(text("LOCK TABLE speed_rollups IN EXCLUSIVE MODE"))
+            conn.execute(text("DELETE FROM speed_rollups"))
+            return conn.execute(text(REBUILD_SPEED_ROLLUPS_SQL)).rowcount
+    
+    def get_speed_rollups(
+        self, keys: Sequence[Tuple[str, int, int]]
+    ) -> Dict[Tuple[str, int, int], Tuple[int, float, float, List[int]]]:
+        """
+        Fetch rollups by primary key.
+        
+        Args:
+            keys: (segment_id, lane_index, bucket) tuples
+            
+        Returns:
+            Dict mapping each found key to (count, mean, m2, histogram)
+        """
+        if not keys:
+            return {}
+        session = self.Session()
+        try:
+            rows = session.execute(text(SPEED_ROLLUPS_SQL), {
+                'segment_ids': [key[0] for key in keys],
+                'lane_indexes': [key[1] for key in keys],
+                'buckets': [key[2] for key in keys],
+            }).fetchall()
+            return {
+                (row[0], row[1], row[2]): (row[3], row[4], row[5], list(row[6]))
+                for row in rows
+            }
         finally:
             session.close()
-
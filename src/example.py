@@ -14,10 +14,11 @@ def main():
     print("Checking number of lanes at various coordinates:")
     print("-" * 50)
     
-    for lat, lon in coordinates:
-        lanes, distance = db.get_lanes_at_coordinate(lat, lon)
-        
-        if lanes is None:
+    # Resolve all coordinates in a single query
+    results = db.get_lanes_at_coordinates(coordinates)
+    
+    for (lat, lon), (lanes, _, _, distance) in zip(coordinates, results):
+        if distance is None:
             print(f"Coordinates ({lat}, {lon}): No road found within search radius")
         else:
             print(f"Coordinates ({lat}, {lon}):")
@@ -27,4 +28,4 @@ def main():
         print("-" * 50)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main() 
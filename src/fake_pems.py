@@ -0,0 +1,56 @@
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def make_handler(delay: float = 0.0, failure_rate: float = 0.0, lanes: int = 3):
+    """Build a request handler answering like PeMS: {'lanes': {'1': speed, ...}}."""
+    class FakePemsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if delay:
+                time.sleep(delay)
+            if random.random() < failure_rate:
+                self.send_error(503, 'Simulated PeMS outage')
+                return
+            query = parse_qs(urlparse(self.path).query)
+            station_id = int(query.get('station_id', ['0'])[0])
+            # Speeds drift slowly over time so history-based predictions have a trend
+            base = 40 + (station_id % 20) + 5 * ((time.time() / 60) % 4)
+            body = json.dumps({
+                'lanes': {
+                    str(lane): round(base + lane * 2 + random.uniform(-1, 1), 1)
+                    for lane in range(1, lanes + 1)
+                }
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakePemsHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve fake PeMS lane speeds for local testing")
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--delay', type=float, default=0.0, help="seconds to wait before answering")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument('--lanes', type=int, default=3)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(
+        ('127.0.0.1', args.port), make_handler(args.delay, args.failure_rate, args.lanes)
+    )
+    print(f"Fake PeMS on http://127.0.0.1:{args.port}/?station_id={{station_id}}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
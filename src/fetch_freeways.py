@@ -1,8 +1,19 @@
+import argparse
+import json
+import math
+import os
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import List, Optional, Set, Tuple
+
 import requests
-from parser import parse_osm_xml
+from columnar import OSMColumns, concat_columns
+from parser import iter_osm_xml_columnar
 from database import DatabaseManager
+from snapshot import current_snapshot, snapshot_path_for, source_fingerprint, write_snapshot
 
-OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+OVERPASS_URL = os.getenv("OVERPASS_URL", "https://overpass-api.de/api/interpreter")
 # Bounding box for California
 BBOX = (32.5343, -124.4096, 42.0095, -114.1315)
 
@@ -13,24 +24,214 @@ way["highway"~"motorway|trunk"]({south},{west},{north},{east});
 out body;
 """
 
-def fetch_freeways():
+DEFAULT_CHECKPOINT = "freeway_import.checkpoint.json"
+
+Tile = Tuple[float, float, float, float]
+
+def fetch_freeways(bbox: Tile = BBOX):
+    """Start the Overpass request and return the streaming response."""
     query = QUERY_TEMPLATE.format(
-        south=BBOX[0], west=BBOX[1], north=BBOX[2], east=BBOX[3]
+        south=bbox[0], west=bbox[1], north=bbox[2], east=bbox[3]
     )
-    response = requests.post(OVERPASS_URL, data={"data": query})
+    response = requests.post(OVERPASS_URL, data={"data": query}, stream=True)
     response.raise_for_status()
-    return response.text
+    # Let urllib3 undo any Content-Encoding while the parser reads
+    response.raw.decode_content = True
+    return response
+
+
+def print_load_stats(stats):
+    for table in ('nodes', 'ways', 'way_nodes'):
+        counts = stats[table]
+        print(
+            f"  {table}: {counts['inserted']} inserted, "
+            f"{counts['updated']} updated, {counts['skipped']} skipped"
+        )
+    print(f"  {stats['rows']} rows in {stats['seconds']:.1f}s "
+          f"({stats['rows_per_second']:.0f} rows/s)")
+
+
+def tile_bbox(bbox: Tile, tile_size: float) -> List[Tile]:
+    """Split (south, west, north, east) into a grid of tiles at most ``tile_size`` degrees wide."""
+    south, west, north, east = bbox
+    rows = max(1, math.ceil((north - south) / tile_size))
+    cols = max(1, math.ceil((east - west) / tile_size))
+    lat_step = (north - south) / rows
+    lon_step = (east - west) / cols
+    # Rounding keeps tile keys stable across runs for checkpointing
+    return [
+        (
+            round(south + r * lat_step, 7),
+            round(west + c * lon_step, 7),
+            round(south + (r + 1) * lat_step, 7) if r < rows - 1 else north,
+            round(west + (c + 1) * lon_step, 7) if c < cols - 1 else east,
+        )
+        for r in range(rows)
+        for c in range(cols)
+    ]
+
+
+def fetch_tile(tile: Tile, max_retries: int = 5, backoff: float = 30.0) -> Tuple[Tile, OSMColumns]:
+    """
+    Fetch and parse one tile. Runs in a worker process.
+
+    The tile comes back as one ``OSMColumns`` batch, which pickles as a few
+    NumPy arrays instead of a dict per node and way.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            with fetch_freeways(tile) as response:
+                return tile, concat_columns(iter_osm_xml_columnar(response.raw))
+        except Exception:
+            # Overpass answers 429/504 when busy; back off and retry
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff * (2 ** attempt) * (1 + random.random()))
+
+
+def load_checkpoint(path: str, bbox: Tile, tile_size: float) -> Set[Tile]:
+    """Return the tiles already completed by a previous run over the same grid."""
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if tuple(checkpoint.get('bbox', ())) != tuple(bbox) or checkpoint.get('tile_size') != tile_size:
+        print(f"Ignoring checkpoint {path}: it was written for a different grid")
+        return set()
+    return {tuple(tile) for tile in checkpoint.get('completed', [])}
+
+
+def save_checkpoint(path: str, bbox: Tile, tile_size: float, completed: Set[Tile]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({
+            'bbox': list(bbox),
+            'tile_size': tile_size,
+            'completed': sorted(list(tile) for tile in completed),
+        }, f)
+    # Atomic rename so an interrupted write never corrupts the checkpoint
+    os.replace(tmp_path, path)
+
+
+def import_tiled(
+    db: DatabaseManager,
+    bbox: Tile = BBOX,
+    tile_size: float = 1.0,
+    workers: int = 2,
+    checkpoint_path: str = DEFAULT_CHECKPOINT,
+) -> None:
+    """
+    Import a bounding box tile by tile with parallel fetch/parse processes.
+
+    Every tile is stored in its own transaction and recorded in the
+    checkpoint file, so an interrupted import resumes with the tiles that
+    are still missing. At most two tiles per worker are fetched ahead of
+    the writer, so parsed tiles do not pile up in memory. Nodes and ways
+    shared by neighbouring tiles arrive with every tile; the
+    version-checked upserts skip the repeats.
+    """
+    tiles = tile_bbox(bbox, tile_size)
+    completed = load_checkpoint(checkpoint_path, bbox, tile_size)
+    remaining = [tile for tile in tiles if tile not in completed]
+    print(f"{len(tiles)} tiles, {len(completed)} already imported, {len(remaining)} to go")
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = iter(remaining)
+        futures = {}
+        while True:
+            # At most two tiles per worker wait for the single writer
+            for tile in pending:
+                futures[executor.submit(fetch_tile, tile)] = tile
+                if len(futures) >= workers * 2:
+                    break
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Popping releases the parsed tile once it is stored
+                tile = futures.pop(future)
+                try:
+                    _, batch = future.result()
+                except Exception as e:
+                    print(f"Tile {tile} failed: {e}")
+                    failed.append(tile)
+                    continue
+                stats = db.store_osm_data(batch)
+                completed.add(tile)
+                save_checkpoint(checkpoint_path, bbox, tile_size, completed)
+                print(f"Tile {tile} done ({len(completed)}/{len(tiles)})")
+                print_load_stats(stats)
+
+    if failed:
+        print(f"{len(failed)} tiles failed; run again to resume")
+
+
+def import_file(db: DatabaseManager, path: str, snapshot_path: Optional[str] = None, force: bool = False) -> None:
+    """
+    Import a saved Overpass/OSM XML file, skipping it if it was already imported.
+
+    Completed imports are recorded in the ``imported_files`` table by
+    content hash, in the same transaction as the data, so the check follows
+    the database rather than local files. A current snapshot is reused
+    instead of parsing, and a new one tagged with the resulting network
+    revision is written after the data is stored, for LOOKUP_SNAPSHOT.
+    """
+    snapshot_path = snapshot_path or snapshot_path_for(path)
+    fingerprint = source_fingerprint(path)
+    if not force and db.is_file_imported(fingerprint['sha256']):
+        print(f"{path} was already imported into this database; nothing to do")
+        return
+
+    snapshot = current_snapshot(path, snapshot_path)
+    network = snapshot.columns if snapshot is not None else concat_columns(iter_osm_xml_columnar(path))
+    stats = db.bulk_store_osm_data([network], source=fingerprint)
+    print(f"Stored {stats['ways']['staged']} ways and {stats['nodes']['staged']} nodes")
+    print_load_stats(stats)
+    # Rewritten even if it was current, to record the revision it matches
+    write_snapshot(snapshot_path, network, fingerprint, db.get_network_revision())
+    print(f"Wrote snapshot {snapshot_path}")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Import motorway and trunk roads from Overpass")
+    parser.add_argument(
+        '--bbox', type=lambda value: tuple(float(v) for v in value.split(',')),
+        default=BBOX, help="south,west,north,east (default: California)",
+    )
+    parser.add_argument(
+        '--tile-size', type=float, default=None,
+        help="import in tiles of this many degrees, in parallel and resumable",
+    )
+    parser.add_argument('--workers', type=int, default=2, help="parallel tile fetch processes")
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT, help="tile checkpoint file")
+    parser.add_argument('--restart', action='store_true', help="ignore an existing checkpoint")
+    parser.add_argument('--input', default=None, help="import a saved OSM XML file instead of querying Overpass")
+    parser.add_argument('--snapshot', default=None, help="snapshot file for --input (default: <input>.snapshot)")
+    parser.add_argument('--force', action='store_true', help="import --input even if it is unchanged")
+    return parser.parse_args(argv)
 
 
 def main():
+    args = parse_args()
     db = DatabaseManager()
     db.init_db()
-    xml_data = fetch_freeways()
-    nodes, ways, way_nodes = parse_osm_xml(xml_data)
-    db.store_osm_data(nodes, ways, way_nodes)
-    print(f"Stored {len(ways)} ways and {len(nodes)} nodes")
+
+    if args.input:
+        import_file(db, args.input, args.snapshot, args.force)
+        return
+
+    if args.tile_size:
+        if args.restart and os.path.exists(args.checkpoint):
+            os.remove(args.checkpoint)
+        import_tiled(db, args.bbox, args.tile_size, args.workers, args.checkpoint)
+        return
+
+    with fetch_freeways(args.bbox) as response:
+        stats = db.bulk_store_osm_data(iter_osm_xml_columnar(response.raw))
+    print(f"Stored {stats['ways']['staged']} ways and {stats['nodes']['staged']} nodes")
+    print_load_stats(stats)
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,367 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from spatial_index import NearestWay
+
+# Default grid cell size in degrees (~11 m of latitude)
+DEFAULT_PRECISION = 1e-4
+# Way segments cached per cell
+DEFAULT_CANDIDATES = 32
+
+_MISSING = object()
+
+
+class LookupCache:
+    """
+    Thread-safe LRU cache with a per-entry time-to-live.
+
+    Entries are evicted least-recently-used first once ``max_size`` is
+    reached and are treated as missing once older than ``ttl`` seconds.
+    """
+
+    def __init__(self, max_size: int = 100000, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *args: Any) -> None:
+        """Drop every entry. Accepts and ignores change-listener arguments."""
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+class ThrottledRevision:
+    """
+    The network revision, read through ``fetch`` at most once every ``interval`` seconds.
+
+    Change listeners only fire in the process that wrote the change, so
+    other API workers learn about imports and diffs by polling the
+    ``network_revision`` row; this keeps that poll off the per-request path.
+    While one caller refreshes the value, concurrent callers get the
+    previous one. ``fetch`` may be a coroutine function if only
+    ``current_async`` is used.
+    """
+
+    def __init__(self, fetch: Callable[[], Any], interval: float = 1.0):
+        self.fetch = fetch
+        self.interval = interval
+        self.value = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.checks = 0
+
+    def _due(self) -> bool:
+        # Claims the refresh, so only one caller per interval reads the database
+        now = time.monotonic()
+        with self._lock:
+            if self.value is not None and now < self._next_check:
+                return False
+            self._next_check = now + self.interval
+            self.checks += 1
+            return True
+
+    def current(self) -> Optional[int]:
+        if self._due():
+            self.value = self.fetch()
+        return self.value
+
+    async def current_async(self) -> Optional[int]:
+        if self._due():
+            self.value = await self.fetch()
+        return self.value
+
+
+class _CellCandidates:
+    """
+    Segments near a cache cell, enough to answer lookups anywhere in it.
+
+    Holds the segments within the search radius of the cell centre (at
+    most ``limit`` of them, nearest first). If the limit cut the search
+    short, ``bound`` is the distance of the last one, beyond which segments
+    may be missing; otherwise every segment in range is here.
+    """
+
+    def __init__(self, segments: Sequence[Any], limit: int):
+        self.ways = [tuple(segment[:7]) for segment in segments]
+        self.y1 = np.array([segment.lat1 for segment in segments], dtype=np.float64)
+        self.x1 = np.array([segment.lon1 for segment in segments], dtype=np.float64)
+        self.y2 = np.array([segment.lat2 for segment in segments], dtype=np.float64)
+        self.x2 = np.array([segment.lon2 for segment in segments], dtype=np.float64)
+        self.bound = float('inf') if len(segments) < limit else float(segments[-1].distance)
+
+    def nearest(self, lat: float, lon: float, max_distance: float, reach: float) -> Any:
+        """
+        The nearest way to the point, None, or _MISSING if the candidates cannot tell.
+
+        ``reach`` is the largest distance from the cell centre to a point in
+        the cell, so a segment left out is at least ``bound - reach`` away.
+        """
+        best = None
+        distance = float('inf')
+        if len(self.ways):
+            # Planar distance in degrees, as PostGIS computes it for SRID 4326
+            dx = self.x2 - self.x1
+            dy = self.y2 - self.y1
+            length2 = dx * dx + dy * dy
+            with np.errstate(invalid='ignore', divide='ignore'):
+                t = np.where(length2 > 0, ((lon - self.x1) * dx + (lat - self.y1) * dy) / length2, 0.0)
+            t = np.clip(t, 0.0, 1.0)
+            distances = np.hypot(self.x1 + t * dx - lon, self.y1 + t * dy - lat)
+            best = int(np.argmin(distances))
+            distance = float(distances[best])
+        if distance > min(max_distance, self.bound - reach):
+            # Only a complete search proves there is nothing in range
+            return None if self.bound == float('inf') else _MISSING
+        return NearestWay(*self.ways[best], distance)
+
+
+class CachedLookup:
+    """
+    Nearest-way lookup backend fronted by a coordinate cache.
+
+    With a ``precision``, coordinates are snapped to a grid of that many
+    degrees and each cell caches the way segments around it (up to
+    ``candidates``), fetched once with ``get_nearby_segments``. Every
+    lookup in the cell then picks its own nearest way and distance from
+    those segments, so nearby lookups share one backend query without
+    sharing an answer; a point the cached segments cannot answer exactly
+    goes to the backend. Without a precision (for the in-memory index,
+    which is fast already), results are cached per exact coordinate.
+    Wraps either ``DatabaseManager`` or ``SpatialIndex`` and exposes the
+    same lookup methods.
+
+    The cache is cleared whenever the network revision changes: the
+    in-memory index reports its own, and for a database backend
+    ``revision_source`` polls the ``network_revision`` table.
+    """
+
+    def __init__(
+        self,
+        backend: Any,
+        cache: LookupCache,
+        precision: Optional[float] = DEFAULT_PRECISION,
+        revision_source: Optional[ThrottledRevision] = None,
+        candidates: int = DEFAULT_CANDIDATES,
+    ):
+        self.backend = backend
+        self.cache = cache
+        self.precision = precision
+        self.revision_source = revision_source
+        self.candidates = candidates
+        # Farthest a point can be from its cell centre
+        self.reach = precision * math.sqrt(2) / 2 if precision is not None else 0.0
+        self._revision = getattr(backend, 'revision', None)
+
+    def __getattr__(self, name: str) -> Any:
+        # Everything that is not cached is served by the wrapped backend
+        return getattr(self.backend, name)
+
+    def cell_key(self, lat: float, lon: float, max_distance: float) -> Tuple[Any, Any, float]:
+        if self.precision is None:
+            return float(lat), float(lon), float(max_distance)
+        return (
+            int(round(lat / self.precision)),
+            int(round(lon / self.precision)),
+            float(max_distance),
+        )
+
+    def _check_revision(self, revision: Any = _MISSING) -> None:
+        # A network that changed invalidates everything cached from it
+        if revision is _MISSING:
+            if self.revision_source is not None:
+                revision = self.revision_source.current()
+            else:
+                revision = getattr(self.backend, 'revision', None)
+        if revision != self._revision:
+            self._revision = revision
+            self.cache.invalidate()
+
+    def _plan(
+        self,
+        points: Sequence[Tuple[float, float]],
+        max_distance: Union[float, Sequence[float]],
+    ) -> Tuple[List[float], List[Hashable], Dict[Hashable, Any], List[Hashable], Tuple[list, list]]:
+        """Cache keys and entries per point, the keys to fetch, and the backend arguments for them."""
+        if isinstance(max_distance, (int, float)):
+            max_distances = [float(max_distance)] * len(points)
+        else:
+            max_distances = [float(d) for d in max_distance]
+            if len(max_distances) != len(points):
+                raise ValueError("max_distance must have one value per point")
+
+        keys = [self.cell_key(lat, lon, d) for (lat, lon), d in zip(points, max_distances)]
+        entries = {}
+        for key in keys:
+            if key not in entries:
+                entries[key] = self.cache.get(key, _MISSING)
+        missing = [key for key, entry in entries.items() if entry is _MISSING]
+        if self.precision is None:
+            request = ([key[:2] for key in missing], [key[2] for key in missing])
+        else:
+            # Cell centres, searched far enough to cover the whole cell
+            request = (
+                [(key[0] * self.precision, key[1] * self.precision) for key in missing],
+                [key[2] + self.reach for key in missing],
+            )
+        return max_distances, keys, entries, missing, request
+
+    def _store(self, entries: Dict[Hashable, Any], missing: List[Hashable], fetched: Sequence[Any]) -> None:
+        for key, value in zip(missing, fetched):
+            if self.precision is not None:
+                value = _CellCandidates(value, self.candidates)
+            self.cache.put(key, value)
+            entries[key] = value
+
+    def _answer(
+        self,
+        points: Sequence[Tuple[float, float]],
+        max_distances: List[float],
+        keys: List[Hashable],
+        entries: Dict[Hashable, Any],
+    ) -> Tuple[List[Any], List[int]]:
+        """Results per point, and the indexes of points the backend must resolve."""
+        if self.precision is None:
+            return [entries[key] for key in keys], []
+        results = [
+            entries[key].nearest(lat, lon, distance, self.reach)
+            for (lat, lon), distance, key in zip(points, max_distances, keys)
+        ]
+        unresolved = [i for i, result in enumerate(results) if result is _MISSING]
+        return results, unresolved
+
+    def _fetch(self, request: Tuple[list, list]) -> List[Any]:
+        if self.precision is None:
+            return self.backend.get_nearest_ways(*request)
+        return self.backend.get_nearby_segments(*request, self.candidates)
+
+    def get_nearest_way(self, lat: float, lon: float, max_distance: float = 0.001) -> Optional[Any]:
+        return self.get_nearest_ways([(lat, lon)], max_distance)[0]
+
+    def get_lanes_at_coordinate(
+        self, lat: float, lon: float, max_distance: float = 0.001
+    ) -> Tuple[Optional[int], Optional[int], Optional[int], Optional[float]]:
+        result = self.get_nearest_way(lat, lon, max_distance)
+
+        if result is None:
+            return None, None, None, None
+
+        return (
+            result.lanes,
+            result.lanes_forward,
+            result.lanes_backward,
+            result.distance,
+        )
+
+    def get_nearest_ways(
+        self,
+        points: Sequence[Tuple[float, float]],
+        max_distance: Union[float, Sequence[float]] = 0.001,
+    ) -> List[Optional[Any]]:
+        """Serve cached cells directly and fetch the rest in one backend call."""
+        self._check_revision()
+        max_distances, keys, entries, missing, request = self._plan(points, max_distance)
+        if missing:
+            self._store(entries, missing, self._fetch(request))
+        results, unresolved = self._answer(points, max_distances, keys, entries)
+        if unresolved:
+            resolved = self.backend.get_nearest_ways(
+                [points[i] for i in unresolved], [max_distances[i] for i in unresolved]
+            )
+            for i, result in zip(unresolved, resolved):
+                results[i] = result
+        return results
+
+    def get_lanes_at_coordinates(
+        self,
+        points: Sequence[Tuple[float, float]],
+        max_distance: Union[float, Sequence[float]] = 0.001,
+    ) -> List[Tuple[Optional[int], Optional[int], Optional[int], Optional[float]]]:
+        return [
+            (None, None, None, None) if result is None else (
+                result.lanes,
+                result.lanes_forward,
+                result.lanes_backward,
+                result.distance,
+            )
+            for result in self.get_nearest_ways(points, max_distance)
+        ]
+
+
+class AsyncCachedLookup(CachedLookup):
+    """``CachedLookup`` for a backend whose lookup methods are coroutines."""
+
+    async def _check_revision_async(self) -> None:
+        if self.revision_source is not None:
+            self._check_revision(await self.revision_source.current_async())
+        else:
+            self._check_revision()
+
+    async def get_nearest_way(self, lat: float, lon: float, max_distance: float = 0.001) -> Optional[Any]:
+        return (await self.get_nearest_ways([(lat, lon)], max_distance))[0]
+
+    async def get_nearest_ways(
+        self,
+        points: Sequence[Tuple[float, float]],
+        max_distance: Union[float, Sequence[float]] = 0.001,
+    ) -> List[Optional[Any]]:
+        await self._check_revision_async()
+        max_distances, keys, entries, missing, request = self._plan(points, max_distance)
+        if missing:
+            self._store(entries, missing, await self._fetch(request))
+        results, unresolved = self._answer(points, max_distances, keys, entries)
+        if unresolved:
+            resolved = await self.backend.get_nearest_ways(
+                [points[i] for i in unresolved], [max_distances[i] for i in unresolved]
+            )
+            for i, result in zip(unresolved, resolved):
+                results[i] = result
+        return results
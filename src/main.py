@@ -1,28 +1,105 @@
 import requests
-from parser import parse_osm_xml, extract_way_ids_from_relation
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from parser import OSMBatch, parse_osm_xml, extract_way_ids_from_relation
 from database import DatabaseManager
-import time
-from typing import List
+from osm_client import OSMClient, WAYS_PER_REQUEST, chunked
+from topology import RoadGraph
+from typing import List, Optional
 import os
 
-def fetch_osm_way(way_id: int) -> str:
-    url = f"https://api.openstreetmap.org/api/0.6/way/{way_id}/full"
-    response = requests.get(url)
-    response.raise_for_status()
-    return response.text
+def fetch_way_chunk(client: OSMClient, way_ids: List[int]) -> OSMBatch:
+    """Fetch and parse a chunk of ways, falling back to one request per way."""
+    try:
+        return parse_osm_xml(client.fetch_ways_full(way_ids), include_geom=False)
+    except requests.HTTPError as e:
+        # A single deleted way fails the whole multi-fetch request
+        if e.response is None or e.response.status_code not in (404, 410) or len(way_ids) == 1:
+            raise
 
-def process_way_ids(way_ids: List[int], db_manager: DatabaseManager):
-    total = len(way_ids)
-    for i, way_id in enumerate(way_ids, 1):
+    nodes, ways, way_nodes = [], [], []
+    for way_id in way_ids:
         try:
-            print(f"Processing way {way_id} ({i}/{total})...")
-            xml_data = fetch_osm_way(way_id)
-            nodes, ways, way_nodes = parse_osm_xml(xml_data)
-            db_manager.store_osm_data(nodes, ways, way_nodes)
-            print(f"Successfully processed way {way_id}")
-            time.sleep(1)  # Be nice to the OSM API
-        except Exception as e:
+            batch = parse_osm_xml(client.fetch_way_full(way_id), include_geom=False)
+        except requests.HTTPError as e:
             print(f"Error processing way {way_id}: {str(e)}")
+            continue
+        nodes.extend(batch[0])
+        ways.extend(batch[1])
+        way_nodes.extend(batch[2])
+    return nodes, ways, way_nodes
+
+def process_way_ids(
+    way_ids: List[int],
+    db_manager: DatabaseManager,
+    client: Optional[OSMClient] = None,
+    workers: int = 4,
+    chunk_size: int = WAYS_PER_REQUEST,
+    flush_rows: int = 50000,
+) -> None:
+    """
+    Fetch ways concurrently and store them through a single batched writer.
+    
+    Chunks of ``chunk_size`` ways are fetched by a pool of ``workers``
+    threads sharing one rate-limited ``OSMClient``. The calling thread is the
+    only writer: parsed chunks are buffered and handed to
+    ``bulk_store_osm_data`` whenever ``flush_rows`` rows have accumulated.
+    At most two chunks per worker are in flight, and each is released once
+    handled, so parsed batches that are not yet written stay bounded.
+    
+    Args:
+        way_ids: IDs of the ways to fetch
+        db_manager: Database to store into
+        client: OSM API client (defaults to the public API, see OSM_API_URL)
+        workers: Number of concurrent fetch threads
+        chunk_size: Ways per multi-fetch request
+        flush_rows: Rows buffered before writing to the database
+    """
+    client = client or OSMClient()
+    chunks = chunked(way_ids, chunk_size)
+    total = len(way_ids)
+    done = 0
+    pending = []
+    pending_rows = 0
+
+    def flush():
+        nonlocal pending, pending_rows
+        if pending:
+            stats = db_manager.bulk_store_osm_data(pending)
+            print(f"Stored {stats['rows']} rows ({stats['rows_per_second']:.0f} rows/s)")
+        pending = []
+        pending_rows = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        remaining = iter(chunks)
+        futures = {}
+        while True:
+            for chunk in remaining:
+                futures[executor.submit(fetch_way_chunk, client, chunk)] = chunk
+                if len(futures) >= workers * 2:
+                    break
+            if not futures:
+                break
+            completed, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in completed:
+                chunk = futures.pop(future)
+                done += len(chunk)
+                try:
+                    batch = future.result()
+                except Exception as e:
+                    print(f"Error processing ways {chunk[0]}..{chunk[-1]}: {str(e)}")
+                    continue
+                print(f"Fetched {len(batch[1])} ways ({done}/{total})...")
+                pending.append(batch)
+                pending_rows += sum(len(rows) for rows in batch)
+                if pending_rows >= flush_rows:
+                    flush()
+    flush()
+
+def relation_chains(relation_xml: str, db_manager: DatabaseManager) -> List[List[int]]:
+    """Order the stored ways of a route relation into chains along the road."""
+    graph = RoadGraph(db_manager, listen=False)
+    graph.load()
+    return graph.chains(extract_way_ids_from_relation(relation_xml))
 
 def main():
     # Initialize database
@@ -57,6 +134,15 @@ def main():
         print(f"Name: {result.name}")
         print(f"Max Speed: {result.maxspeed}")
         print(f"Distance: {result.distance} degrees")
+    
+    # Ways of the relation in driving order, one chain per direction or gap
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    xml_path = os.path.join(os.path.dirname(script_dir), 'data', '156071.xml')
+    with open(xml_path, 'r') as f:
+        chains = relation_chains(f.read(), db_manager)
+    print(f"\nRelation 156071 forms {len(chains)} chains")
+    for chain in chains[:5]:
+        print(f"  {len(chain)} ways: {chain[0]} -> {chain[-1]}")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,342 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from database import DatabaseManager, segment_id_for_way
+from spatial_index import SpatialIndex, _GridState
+
+# (user_data id, device_id, timestamp, lat, lon) as streamed by
+# DatabaseManager.iter_user_data_points
+ProbePoint = Tuple[int, Optional[str], datetime, float, float]
+
+# Defaults, in degrees (~111 km per degree of latitude)
+DEFAULT_SEARCH_RADIUS = 0.0005   # ~50 m
+DEFAULT_MAX_CANDIDATES = 8
+DEFAULT_SIGMA = 0.0001           # GPS noise, ~10 m
+DEFAULT_BETA = 0.0002            # tolerated route/straight-line mismatch, ~20 m
+DEFAULT_SWITCH_PENALTY = 10.0    # log-prob cost of jumping to an unconnected way
+DEFAULT_HEADING_WEIGHT = 4.0     # log-prob cost of driving against a segment
+DEFAULT_MAX_GAP = 60.0           # seconds between probes of one trajectory
+
+
+def split_trajectories(
+    points: Iterable[ProbePoint], max_gap: float = DEFAULT_MAX_GAP
+) -> Iterator[List[ProbePoint]]:
+    """
+    Group probes ordered by device and time into trajectories.
+
+    A new trajectory starts with each device and after every gap longer
+    than ``max_gap`` seconds. Probes without a device are single-point
+    trajectories.
+    """
+    current = []
+    for point in points:
+        if current:
+            previous = current[-1]
+            if (
+                point[1] is None
+                or point[1] != previous[1]
+                or (point[2] - previous[2]).total_seconds() > max_gap
+            ):
+                yield current
+                current = []
+        current.append(point)
+    if current:
+        yield current
+
+
+def _connected_way_pairs(grid: _GridState) -> np.ndarray:
+    """Sorted ``a * n_ways + b`` keys for every pair of ways sharing a vertex."""
+    n_ways = len(grid.ways)
+    if not len(grid.way_index):
+        return np.empty(0, dtype=np.int64)
+    # Vertices are compared on a 1e-7 degree grid, the precision OSM stores
+    xs = np.round(np.concatenate([grid.x1, grid.x2]) * 1e7).astype(np.int64)
+    ys = np.round(np.concatenate([grid.y1, grid.y2]) * 1e7).astype(np.int64)
+    ways = np.concatenate([grid.way_index, grid.way_index]).astype(np.int64)
+    vertices = np.unique(np.stack([xs, ys, ways], axis=1), axis=0)
+
+    same = np.all(vertices[1:, :2] == vertices[:-1, :2], axis=1)
+    starts = np.flatnonzero(np.concatenate([[True], ~same]))
+    ends = np.append(starts[1:], len(vertices))
+    keys = []
+    for start, end in zip(starts, ends):
+        if end - start < 2:
+            continue
+        members = vertices[start:end, 2]
+        keys.append((members[:, None] * n_ways + members[None, :]).ravel())
+    if not keys:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(keys))
+
+
+class MapMatcher:
+    """
+    Hidden-Markov map matcher over a ``SpatialIndex`` network snapshot.
+
+    Hidden states are the nearest ways around each probe (best segment per
+    way). Emissions score the distance to the way; transitions score how
+    well the distance between projected points agrees with the distance
+    between probes, penalize jumps between ways that share no vertex, and
+    penalize candidates whose segment points against the direction of
+    travel, which separates parallel carriageways. The most likely
+    sequence is found with a vectorized Viterbi pass.
+    """
+
+    def __init__(
+        self,
+        grid: _GridState,
+        search_radius: float = DEFAULT_SEARCH_RADIUS,
+        max_candidates: int = DEFAULT_MAX_CANDIDATES,
+        sigma: float = DEFAULT_SIGMA,
+        beta: float = DEFAULT_BETA,
+        switch_penalty: float = DEFAULT_SWITCH_PENALTY,
+        heading_weight: float = DEFAULT_HEADING_WEIGHT,
+    ):
+        self.grid = grid
+        self.search_radius = search_radius
+        self.max_candidates = max_candidates
+        self.sigma = sigma
+        self.beta = beta
+        self.switch_penalty = switch_penalty
+        self.heading_weight = heading_weight
+        self._connected = _connected_way_pairs(grid)
+
+        dx = grid.x2 - grid.x1
+        dy = grid.y2 - grid.y1
+        length = np.hypot(dx, dy)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self._dir_x = np.nan_to_num(dx / length)
+            self._dir_y = np.nan_to_num(dy / length)
+
+    @classmethod
+    def from_index(cls, index: SpatialIndex, **kwargs) -> 'MapMatcher':
+        return cls(index.grid, **kwargs)
+
+    def candidates(self, lat: float, lon: float) -> Optional[Tuple[np.ndarray, ...]]:
+        """
+        Return (way positions, distances, x, y, dir_x, dir_y) of the nearest
+        segment of each way within the search radius, closest first, or
+        None if there is no way nearby.
+        """
+        grid = self.grid
+        segments = np.unique(grid.candidates(lat, lon, self.search_radius))
+        if not len(segments):
+            return None
+        distances, px, py = grid.project(lat, lon, segments)
+        order = np.argsort(distances, kind='stable')
+        order = order[distances[order] <= self.search_radius]
+        if not len(order):
+            return None
+
+        # Keep the closest segment of each way
+        ways = grid.way_index[segments[order]]
+        _, first = np.unique(ways, return_index=True)
+        keep = order[np.sort(first)][:self.max_candidates]
+        kept_segments = segments[keep]
+        return (
+            grid.way_index[kept_segments].astype(np.int64),
+            distances[keep],
+            px[keep],
+            py[keep],
+            self._dir_x[kept_segments],
+            self._dir_y[kept_segments],
+        )
+
+    def match(self, points: Sequence[Tuple[float, float]]) -> List[Optional[int]]:
+        """
+        Match one trajectory of (lat, lon) points.
+
+        Returns the matched way ID for each point, or None for points with
+        no way within the search radius. Such points split the trajectory.
+        """
+        results = [None] * len(points)
+        chain = []
+        for i, (lat, lon) in enumerate(points):
+            found = self.candidates(lat, lon)
+            if found is None:
+                self._decode(chain, results)
+                chain = []
+                continue
+            chain.append((i, lat, lon, found))
+        self._decode(chain, results)
+        return results
+
+    def _decode(self, chain, results: List[Optional[int]]) -> None:
+        if not chain:
+            return
+        n_ways = len(self.grid.ways)
+        inv_two_sigma_sq = 0.5 / (self.sigma * self.sigma)
+
+        _, _, _, (ways, distances, px, py, _, _) = chain[0]
+        scores = -distances * distances * inv_two_sigma_sq
+        backpointers = []
+        for step in range(1, len(chain)):
+            _, prev_lat, prev_lon, (prev_ways, _, prev_px, prev_py, _, _) = chain[step - 1]
+            _, lat, lon, (ways, distances, px, py, dir_x, dir_y) = chain[step]
+
+            move_x = lon - prev_lon
+            move_y = lat - prev_lat
+            observed = np.hypot(move_x, move_y)
+            travelled = np.hypot(px[None, :] - prev_px[:, None], py[None, :] - prev_py[:, None])
+            transition = -np.abs(travelled - observed) / self.beta
+
+            switched = prev_ways[:, None] != ways[None, :]
+            pair_keys = prev_ways[:, None] * n_ways + ways[None, :]
+            unconnected = switched & ~np.isin(pair_keys, self._connected)
+            transition -= unconnected * self.switch_penalty
+
+            emission = -distances * distances * inv_two_sigma_sq
+            if observed > 0:
+                # cos = 1 when moving along the segment, -1 when against it
+                cos = (move_x * dir_x + move_y * dir_y) / observed
+                emission = emission - self.heading_weight * (1.0 - cos) / 2.0
+
+            total = scores[:, None] + transition
+            best_previous = np.argmax(total, axis=0)
+            scores = total[best_previous, np.arange(len(ways))] + emission
+            backpointers.append(best_previous)
+
+        state = int(np.argmax(scores))
+        for step in range(len(chain) - 1, -1, -1):
+            index, _, _, (ways, _, _, _, _, _) = chain[step]
+            results[index] = self.grid.ways[ways[state]][0]
+            if step:
+                state = int(backpointers[step - 1][state])
+
+
+_worker_matcher = None
+
+
+def _init_worker(matcher: MapMatcher) -> None:
+    global _worker_matcher
+    _worker_matcher = matcher
+
+
+def match_trajectories(
+    trajectories: List[List[ProbePoint]], matcher: Optional[MapMatcher] = None
+) -> List[Tuple[int, str]]:
+    """Match trajectories and return (user_data id, segment_id) for matched probes."""
+    matcher = matcher or _worker_matcher
+    assignments = []
+    for trajectory in trajectories:
+        way_ids = matcher.match([(point[3], point[4]) for point in trajectory])
+        assignments.extend(
+            (point[0], segment_id_for_way(way_id))
+            for point, way_id in zip(trajectory, way_ids)
+            if way_id is not None
+        )
+    return assignments
+
+
+def _chunks(
+    trajectories: Iterable[List[ProbePoint]], chunk_points: int
+) -> Iterator[List[List[ProbePoint]]]:
+    chunk = []
+    size = 0
+    for trajectory in trajectories:
+        chunk.append(trajectory)
+        size += len(trajectory)
+        if size >= chunk_points:
+            yield chunk
+            chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+def match_stored_probes(
+    db_manager: DatabaseManager,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    workers: int = 4,
+    max_gap: float = DEFAULT_MAX_GAP,
+    chunk_points: int = 20000,
+    flush_rows: int = 50000,
+    **matcher_kwargs,
+) -> dict:
+    """
+    Map-match stored probes and rewrite their ``segment_id`` in bulk.
+
+    Probes are streamed from the database, split into trajectories and
+    matched in ``workers`` processes, each holding one copy of the network
+    snapshot. Results are written back with
+    ``DatabaseManager.update_user_data_segments`` every ``flush_rows``
+    probes. Probes with no way nearby keep their segment_id.
+    """
+    index = SpatialIndex(db_manager)
+    index.load()
+    matcher = MapMatcher.from_index(index, **matcher_kwargs)
+
+    stats = {'points': 0, 'matched': 0, 'updated': 0}
+    pending = []
+
+    def collect(assignments):
+        stats['matched'] += len(assignments)
+        pending.extend(assignments)
+        if len(pending) >= flush_rows:
+            stats['updated'] += db_manager.update_user_data_segments(pending)
+            pending.clear()
+
+    points = db_manager.iter_user_data_points(since, until)
+
+    def counted(items):
+        for item in items:
+            stats['points'] += 1
+            yield item
+
+    chunks = _chunks(split_trajectories(counted(points), max_gap), chunk_points)
+    if workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(matcher,)
+        ) as executor:
+            # Keep a bounded number of chunks in flight so memory stays flat
+            in_flight = []
+            for chunk in chunks:
+                in_flight.append(executor.submit(match_trajectories, chunk))
+                if len(in_flight) >= workers * 2:
+                    collect(in_flight.pop(0).result())
+            for future in in_flight:
+                collect(future.result())
+    else:
+        for chunk in chunks:
+            collect(match_trajectories(chunk, matcher))
+
+    if pending:
+        stats['updated'] += db_manager.update_user_data_segments(pending)
+    return stats
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Map-match stored speed probes to ways")
+    parser.add_argument('--since', type=datetime.fromisoformat, default=None,
+                        help="only probes at or after this ISO timestamp")
+    parser.add_argument('--until', type=datetime.fromisoformat, default=None,
+                        help="only probes before this ISO timestamp")
+    parser.add_argument('--workers', type=int, default=4, help="matcher processes")
+    parser.add_argument('--max-gap', type=float, default=DEFAULT_MAX_GAP,
+                        help="seconds between probes that split a trajectory")
+    parser.add_argument('--search-radius', type=float, default=DEFAULT_SEARCH_RADIUS,
+                        help="candidate search radius in degrees")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    db = DatabaseManager()
+    db.init_db()
+    stats = match_stored_probes(
+        db, args.since, args.until, workers=args.workers,
+        max_gap=args.max_gap, search_radius=args.search_radius,
+    )
+    print(f"Matched {stats['matched']} of {stats['points']} probes, "
+          f"{stats['updated']} segment IDs changed")
+    if stats['updated']:
+        # Rollups are keyed by segment_id, so moved probes must be recounted
+        print(f"Rebuilt {db.rebuild_speed_rollups()} speed rollups")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _StackCounter, deque
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (metric name, type, help, [(labels, value)])
+MetricFamily = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic counter with labels."""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self) -> List[MetricFamily]:
+        with self._lock:
+            samples = [
+                (dict(zip(self.labelnames, key)), value) for key, value in self._values.items()
+            ]
+        return [(self.name, 'counter', self.help, samples)]
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels, in Prometheus layout."""
+
+    def __init__(
+        self, name: str, help: str, labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last is +Inf), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self) -> List[MetricFamily]:
+        samples = []
+        with self._lock:
+            series = [(key, list(s[0]), s[1], s[2]) for key, s in self._series.items()]
+        for key, counts, total, count in series:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append(({**labels, 'le': _format_value(bound)}, cumulative, '_bucket'))
+            samples.append((labels, total, '_sum'))
+            samples.append((labels, count, '_count'))
+        return [(self.name, 'histogram', self.help, samples)]
+
+
+class MetricsRegistry:
+    """
+    Collection of metrics rendered in the Prometheus text format.
+
+    Besides counters and histograms, collectors can be registered: callables
+    returning metric families that are evaluated on every scrape, used for
+    pool and cache statistics that other objects already track.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def histogram(
+        self, name: str, help: str, labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable[[], Iterable[MetricFamily]]) -> None:
+        with self._lock:
+            self._collectors.append(collector)
+
+    def register_stats(self, prefix: str, stats: Callable[[], Optional[Dict[str, Any]]], help: str = '') -> None:
+        """Export every numeric value of a ``stats()`` dict as a ``{prefix}_{key}`` gauge."""
+        def collect():
+            values = stats() or {}
+            return [
+                (f"{prefix}_{key}", 'gauge', help or f"{prefix} {key}", [({}, value)])
+                for key, value in values.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool)
+            ]
+        self.register_collector(collect)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        families = []
+        for metric in metrics:
+            families.extend(metric.collect())
+        for collector in collectors:
+            try:
+                families.extend(collector())
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+
+        lines = []
+        for name, kind, help, samples in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample in samples:
+                labels, value = sample[0], sample[1]
+                suffix = sample[2] if len(sample) > 2 else ''
+                lines.append(f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|JOIN)\s+([A-Za-z_][\w.]*)', re.IGNORECASE)
+
+
+def statement_name(statement: str) -> str:
+    """
+    Low-cardinality label for a SQL statement: its verb and first table.
+
+    Statements in this code base are fixed templates with bound parameters,
+    so this groups every execution of the same query.
+    """
+    text = statement.lstrip()
+    if text.startswith('--'):
+        text = text.split('\n', 1)[-1].lstrip()
+    verb = text.split(None, 1)[0].upper() if text else 'UNKNOWN'
+    if verb == 'WITH':
+        # Name CTE queries after the statement that follows the CTEs
+        match = re.search(r'\)\s*(SELECT|INSERT|UPDATE|DELETE)\b', text, re.IGNORECASE)
+        verb = f"WITH {match.group(1).upper()}" if match else verb
+    table = _STATEMENT_TABLE.search(text)
+    return f"{verb} {table.group(1)}" if table else verb
+
+
+def instrument_engine(engine, registry: MetricsRegistry) -> None:
+    """Time every statement executed through ``engine`` and count its rows and errors."""
+    from sqlalchemy import event
+
+    duration = registry.histogram(
+        'db_statement_duration_seconds', 'SQL statement execution time', ['statement']
+    )
+    rows = registry.counter('db_statement_rows_total', 'Rows returned or affected', ['statement'])
+    errors = registry.counter('db_statement_errors_total', 'Failed SQL statements', ['statement'])
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['metrics_started'].pop()
+        name = statement_name(statement)
+        duration.observe(time.perf_counter() - started, statement=name)
+        if cursor.rowcount and cursor.rowcount > 0:
+            rows.inc(cursor.rowcount, statement=name)
+
+    @event.listens_for(engine, 'handle_error')
+    def on_error(context):
+        stack = context.connection.info.get('metrics_started') if context.connection is not None else None
+        if stack:
+            stack.pop()
+        errors.inc(statement=statement_name(context.statement or ''))
+
+    def pool_stats():
+        pool = engine.pool
+        samples = []
+        for key in ('size', 'checkedin', 'checkedout', 'overflow'):
+            getter = getattr(pool, key, None)
+            if callable(getter):
+                samples.append((f"db_pool_{key}", 'gauge', f"Connection pool {key}", [({}, getter())]))
+        return samples
+
+    registry.register_collector(pool_stats)
+
+
+def instrument_methods(obj: Any, registry: MetricsRegistry, names: Iterable[str], metric: str, help: str) -> None:
+    """
+    Time calls of ``obj``'s methods ``names`` into a histogram labelled by method.
+
+    Covers code paths that bypass engine events, such as COPY through raw
+    psycopg2 connections.
+    """
+    duration = registry.histogram(metric, help, ['method'])
+    for name in names:
+        method = getattr(obj, name)
+
+        def timed(*args, __method=method, __name=name, **kwargs):
+            started = time.perf_counter()
+            try:
+                return __method(*args, **kwargs)
+            finally:
+                duration.observe(time.perf_counter() - started, method=__name)
+
+        setattr(obj, name, timed)
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for slow requests, switchable at runtime.
+
+    While enabled, a background thread samples the stack of every thread
+    currently serving a request each ``interval`` seconds. Requests that
+    take at least ``threshold`` seconds keep their folded stacks
+    (``module:function;...`` -> samples, ready for flame graph tools);
+    the most recent ``keep`` profiles are retained.
+    """
+
+    def __init__(self, threshold: float = 0.5, interval: float = 0.005, keep: int = 50, max_stacks: int = 50):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.profiles = deque(maxlen=keep)
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._enabled = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled.is_set()
+
+    def configure(
+        self, enabled: bool, threshold: Optional[float] = None, interval: Optional[float] = None
+    ) -> None:
+        if interval is not None and interval <= 0:
+            raise ValueError("interval must be positive")
+        if threshold is not None:
+            self.threshold = threshold
+        if interval is not None:
+            self.interval = interval
+        if not enabled:
+            self._enabled.clear()
+            return
+        self._enabled.set()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def start_request(self) -> None:
+        if self.enabled:
+            with self._lock:
+                self._active[threading.get_ident()] = _StackCounter()
+
+    def end_request(self, label: str, duration: float) -> None:
+        with self._lock:
+            stacks = self._active.pop(threading.get_ident(), None)
+        if stacks is None or duration < self.threshold:
+            return
+        self.profiles.append({
+            'endpoint': label,
+            'duration_ms': round(duration * 1000, 3),
+            'finished_at': time.time(),
+            'samples': sum(stacks.values()),
+            'stacks': dict(stacks.most_common(self.max_stacks)),
+        })
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while self._enabled.is_set():
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, stacks in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is None or thread_id == me:
+                        continue
+                    stacks[_fold(frame)] += 1
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'threshold_ms': self.threshold * 1000,
+            'interval_ms': self.interval * 1000,
+            'profiles': list(self.profiles),
+        }
+
+
+def _fold(frame) -> str:
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(parts))
+
+
+def instrument_flask(app, registry: MetricsRegistry, profiler: Optional[SamplingProfiler] = None) -> None:
+    """Record latency per endpoint, method and status, and count unhandled exceptions."""
+    from flask import g, got_request_exception, request
+
+    duration = registry.histogram(
+        'http_request_duration_seconds', 'HTTP request latency', ['endpoint', 'method', 'status']
+    )
+    exceptions = registry.counter(
+        'http_request_exceptions_total', 'Unhandled exceptions by endpoint', ['endpoint', 'exception']
+    )
+
+    def endpoint_label() -> str:
+        return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+        if profiler is not None:
+            profiler.start_request()
+
+    @app.after_request
+    def record(response):
+        started = g.get('metrics_started')
+        if started is not None:
+            elapsed = time.perf_counter() - started
+            duration.observe(elapsed, endpoint=endpoint_label(), method=request.method, status=response.status_code)
+        return response
+
+    @app.teardown_request
+    def finish_profile(exception=None):
+        # Teardown runs even when after_request is skipped, so the sampler never
+        # keeps a finished request's thread
+        started = g.pop('metrics_started', None)
+        if profiler is not None and started is not None:
+            profiler.end_request(f"{request.method} {endpoint_label()}", time.perf_counter() - started)
+
+    def on_exception(sender, exception, **extra):
+        exceptions.inc(endpoint=endpoint_label(), exception=type(exception).__name__)
+
+    # Flask keeps weak references to receivers; the app holds this one
+    app.metrics_exception_receiver = on_exception
+    got_request_exception.connect(on_exception, app)
@@ -1,6 +1,7 @@
 from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, BigInteger
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
+from sqlalchemy.dialects.postgresql import ARRAY
 from geoalchemy2 import Geometry
 from datetime import datetime
 
@@ -51,6 +52,31 @@ class WayNode(Base):
         return f"<WayNode(way_id={self.way_id}, node_id={self.node_id}, sequence={self.sequence})>"
 
 
+class WaySegment(Base):
+    """Line between two consecutive nodes of a way, used for KNN lookups."""
+    __tablename__ = 'way_segments'
+
+    way_id = Column(BigInteger, ForeignKey('ways.way_id'), primary_key=True)
+    sequence = Column(Integer, primary_key=True)
+    # GeoAlchemy creates a GiST index on the column
+    geom = Column(Geometry('LINESTRING', srid=4326))
+
+    def __repr__(self):
+        return f"<WaySegment(way_id={self.way_id}, sequence={self.sequence})>"
+
+
+class WayShape(Base):
+    """Whole-way LineString simplified for one zoom band (see polyline.ZOOM_BANDS)."""
+    __tablename__ = 'way_shapes'
+
+    way_id = Column(BigInteger, ForeignKey('ways.way_id'), primary_key=True)
+    band = Column(Integer, primary_key=True)
+    geom = Column(Geometry('LINESTRING', srid=4326))
+
+    def __repr__(self):
+        return f"<WayShape(way_id={self.way_id}, band={self.band})>"
+
+
 class UserData(Base):
     __tablename__ = 'user_data'
 
@@ -61,6 +87,8 @@ class UserData(Base):
     speed = Column(Float)
     lane_index = Column(Integer)
     segment_id = Column(String(50))
+    # Probes from the same device form trajectories for map matching
+    device_id = Column(String(64), index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     def __repr__(self):
@@ -69,3 +97,66 @@ class UserData(Base):
             f"speed={self.speed})>"
         )
 
+
+
+class NetworkRevision(Base):
+    """Single-row counter bumped whenever the road network tables change."""
+    __tablename__ = 'network_revision'
+
+    id = Column(Integer, primary_key=True)
+    revision = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<NetworkRevision(revision={self.revision})>"
+
+
+class ReplicationState(Base):
+    """Single-row record of the last applied osmChange sequence number."""
+    __tablename__ = 'replication_state'
+
+    id = Column(Integer, primary_key=True)
+    sequence_number = Column(BigInteger)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<ReplicationState(sequence_number={self.sequence_number})>"
+
+
+class ImportedFile(Base):
+    """An OSM XML file loaded by ``fetch_freeways.py --input``, keyed by content hash."""
+    __tablename__ = 'imported_files'
+
+    sha256 = Column(String(64), primary_key=True)
+    path = Column(String(1024))
+    size = Column(BigInteger)
+    imported_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<ImportedFile(sha256={self.sha256}, path={self.path})>"
+
+
+class SpeedRollup(Base):
+    """
+    Running speed statistics per segment, lane and hour of the week.
+
+    ``m2`` is the sum of squared deviations from the mean (variance is
+    m2 / count) and ``histogram`` counts probes per speed bin. Bucket -1
+    holds all-time statistics.
+    """
+    __tablename__ = 'speed_rollups'
+
+    segment_id = Column(String(50), primary_key=True)
+    lane_index = Column(Integer, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    count = Column(BigInteger, nullable=False)
+    mean = Column(Float, nullable=False)
+    m2 = Column(Float, nullable=False)
+    histogram = Column(ARRAY(Integer), nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return (
+            f"<SpeedRollup(segment_id={self.segment_id}, lane_index={self.lane_index}, "
+            f"bucket={self.bucket}, count={self.count})>"
+        )
@@ -0,0 +1,104 @@
+import argparse
+import os
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from parser import OSMChangeBatch, iter_osm_change, parse_osm_xml
+from pbf_reader import DEFAULT_HIGHWAY_TYPES
+from osm_client import OSMClient, NODES_PER_REQUEST, chunked
+
+# Replication diffs are stored as .../AAA/BBB/CCC.osc.gz for sequence AAABBBCCC
+SEQUENCE_PATTERN = re.compile(r'(\d{3})/(\d{3})/(\d{3})\.osc(\.gz)?$')
+
+
+def sequence_from_path(path: str) -> Optional[int]:
+    """Return the replication sequence number encoded in a diff path, if any."""
+    match = SEQUENCE_PATTERN.search(path.replace(os.sep, '/'))
+    if match is None:
+        return None
+    return int(''.join(match.group(1, 2, 3)))
+
+
+def filter_highways(
+    batches: Iterable[OSMChangeBatch],
+    highway_types: Optional[Iterable[str]] = DEFAULT_HIGHWAY_TYPES,
+) -> Iterator[OSMChangeBatch]:
+    """
+    Keep created/modified ways of the imported highway types.
+
+    Other created/modified ways are turned into deletions, so a way that
+    was retagged away from a kept type is removed from the network (and a
+    way that was never stored is a no-op). ``None`` keeps every highway.
+    """
+    highway_types = set(highway_types) if highway_types is not None else None
+    for nodes, ways, way_nodes, deleted_nodes, deleted_ways in batches:
+        kept = []
+        for way in ways:
+            highway = way['highway_type']
+            if highway is not None and (highway_types is None or highway in highway_types):
+                kept.append(way)
+            else:
+                deleted_ways.append({'way_id': way['way_id'], 'version': way['version']})
+        kept_ids = {way['way_id'] for way in kept}
+        way_nodes = [wn for wn in way_nodes if wn['way_id'] in kept_ids]
+        yield nodes, kept, way_nodes, deleted_nodes, deleted_ways
+
+
+def node_fetcher(client: OSMClient):
+    """Return a ``fetch_nodes`` callback that pulls missing nodes from the OSM API."""
+    def fetch_nodes(node_ids: List[int]) -> List[Dict[str, Any]]:
+        nodes = []
+        for chunk in chunked(node_ids, NODES_PER_REQUEST):
+            xml_data = client.get('nodes', params={'nodes': ','.join(str(i) for i in chunk)})
+            chunk_nodes, _, _ = parse_osm_xml(xml_data, include_geom=False)
+            nodes.extend(chunk_nodes)
+        print(f"Fetched {len(nodes)} of {len(node_ids)} missing nodes")
+        return nodes
+    return fetch_nodes
+
+
+def main():
+    from database import DatabaseManager
+    from fetch_freeways import print_load_stats
+
+    arg_parser = argparse.ArgumentParser(description="Apply osmChange (.osc/.osc.gz) diffs")
+    arg_parser.add_argument('paths', nargs='+', help="diff files, applied in the given order")
+    arg_parser.add_argument(
+        '--sequence', type=int, default=None,
+        help="replication sequence number (single diff only; default: taken from the path)",
+    )
+    arg_parser.add_argument(
+        '--highway', action='append', default=None,
+        help="highway type to keep (repeatable, default: motorway/trunk and links)",
+    )
+    arg_parser.add_argument('--all-highways', action='store_true', help="keep every highway type")
+    arg_parser.add_argument(
+        '--fetch-missing-nodes', action='store_true',
+        help="fetch nodes referenced by changed ways but missing from the diff from the OSM API",
+    )
+    args = arg_parser.parse_args()
+    if args.sequence is not None and len(args.paths) > 1:
+        arg_parser.error("--sequence can only be used with a single diff")
+
+    highway_types = None if args.all_highways else (args.highway or DEFAULT_HIGHWAY_TYPES)
+    fetch_nodes = node_fetcher(OSMClient()) if args.fetch_missing_nodes else None
+    db = DatabaseManager()
+    db.init_db()
+
+    for path in args.paths:
+        sequence = args.sequence if args.sequence is not None else sequence_from_path(path)
+        stats = db.apply_osm_change(
+            filter_highways(iter_osm_change(path), highway_types),
+            sequence=sequence,
+            fetch_nodes=fetch_nodes,
+        )
+        if stats is None:
+            print(f"Skipping {path}: sequence {sequence} already applied")
+            continue
+        print(f"Applied {path}" + (f" (sequence {sequence})" if sequence is not None else ""))
+        print_load_stats(stats)
+        print(f"  deleted {stats['deleted']['ways']} ways, {stats['deleted']['nodes']} nodes")
+
+
+if __name__ == "__main__":
+    main()
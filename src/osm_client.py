@@ -0,0 +1,151 @@
+import os
+import random
+import threading
+import time
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterable, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+OSM_API_URL = os.getenv('OSM_API_URL', 'https://api.openstreetmap.org/api/0.6')
+
+# The API rejects multi-fetch URLs that grow too long
+WAYS_PER_REQUEST = 50
+NODES_PER_REQUEST = 200
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+
+    Tokens refill continuously at ``rate`` per second up to ``capacity``;
+    ``acquire`` blocks until a token is available.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class OSMClient:
+    """
+    Rate-limited OSM API client with pooled connections and retries.
+
+    Each thread gets its own ``requests.Session`` so worker threads reuse
+    keep-alive connections without sharing a session. Failed requests
+    (connection errors and 429/5xx responses) are retried with exponential
+    backoff and jitter.
+    """
+
+    def __init__(
+        self,
+        base_url: str = OSM_API_URL,
+        rate: float = 2.0,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        timeout: float = 60.0,
+        pool_size: int = 8,
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.limiter = TokenBucket(rate)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+        return session
+
+    def get(self, path: str, params: Optional[Dict[str, str]] = None) -> str:
+        """GET ``path`` relative to the API root and return the response text."""
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.text
+                error = requests.HTTPError(
+                    f"{response.status_code} for {response.url}", response=response
+                )
+                retry_after = response.headers.get('Retry-After')
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                retry_after = None
+
+            if attempt == self.max_retries:
+                raise error
+            delay = self.backoff * (2 ** attempt) * (1 + random.random())
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            time.sleep(delay)
+
+    def fetch_way_full(self, way_id: int) -> str:
+        """Fetch one way with all its nodes."""
+        return self.get(f"way/{way_id}/full")
+
+    def fetch_ways_full(self, way_ids: Iterable[int]) -> str:
+        """
+        Fetch several ways and all their nodes as a single OSM XML document.
+
+        Uses the multi-fetch ``ways`` and ``nodes`` calls, so a chunk of
+        ``WAYS_PER_REQUEST`` ways costs one request plus one per
+        ``NODES_PER_REQUEST`` referenced nodes.
+        """
+        way_ids = list(way_ids)
+        if not way_ids:
+            return '<osm version="0.6"/>'
+        ways_root = ET.fromstring(
+            self.get('ways', params={'ways': ','.join(str(i) for i in way_ids)})
+        )
+
+        node_ids = []
+        seen = set()
+        for nd in ways_root.iter('nd'):
+            ref = int(nd.get('ref'))
+            if ref not in seen:
+                seen.add(ref)
+                node_ids.append(ref)
+
+        # Nodes first so the combined document matches /full output order
+        combined = ET.Element('osm', ways_root.attrib)
+        for start in range(0, len(node_ids), NODES_PER_REQUEST):
+            chunk = node_ids[start:start + NODES_PER_REQUEST]
+            nodes_root = ET.fromstring(
+                self.get('nodes', params={'nodes': ','.join(str(i) for i in chunk)})
+            )
+            combined.extend(nodes_root.findall('node'))
+        combined.extend(ways_root.findall('way'))
+        return ET.tostring(combined, encoding='unicode')
+
+
+def chunked(items: List[int], size: int) -> List[List[int]]:
+    return [items[start:start + size] for start in range(0, len(items), size)]
@@ -1,8 +1,33 @@
+import gzip
 import xml.etree.ElementTree as ET
+from io import BytesIO
 from datetime import datetime
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, BinaryIO, Iterable, Iterator, Optional, Union
 from geoalchemy2.shape import from_shape
 from shapely.geometry import Point
+import numpy as np
+
+from columnar import DTYPES, MISSING, OSMColumns, concat_columns
+
+# Default number of nodes + ways + way_nodes rows per yielded batch
+DEFAULT_BATCH_SIZE = 50000
+
+OSMBatch = Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]
+# (nodes, ways, way_nodes, deleted_nodes, deleted_ways)
+OSMChangeBatch = Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]],
+                       List[Dict[str, Any]], List[Dict[str, Any]]]
+
+# OSM tag key -> ways column
+WAY_TAG_COLUMNS = {
+    'lanes': 'lanes',
+    'lanes:forward': 'lanes_forward',
+    'lanes:backward': 'lanes_backward',
+    'highway': 'highway_type',
+    'name': 'name',
+    'maxspeed': 'maxspeed',
+}
+# Tag columns stored as integers; unparseable values are treated as untagged
+INTEGER_TAG_COLUMNS = ('lanes', 'lanes_forward', 'lanes_backward')
 
 def parse_timestamp(timestamp_str: str) -> datetime:
     return datetime.strptime(timestamp_str, "%Y-%m-%dT%H:%M:%SZ")
@@ -18,75 +43,327 @@ def extract_way_ids_from_relation(xml_data: str) -> List[int]:
     
     return way_ids
 
-def parse_osm_xml(xml_data: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]:
-    root = ET.fromstring(xml_data)
+def _parse_node(elem: ET.Element, include_geom: bool = True) -> Dict[str, Any]:
+    lat = float(elem.get('lat'))
+    lon = float(elem.get('lon'))
+    node = {
+        'node_id': int(elem.get('id')),
+        'lat': lat,
+        'lon': lon,
+        'version': int(elem.get('version')),
+        'timestamp': parse_timestamp(elem.get('timestamp')),
+    }
+    if include_geom:
+        node['geom'] = from_shape(Point(lon, lat), srid=4326)
+    return node
+
+def build_way_record(
+    way_id: int, version: Optional[int], timestamp: Optional[datetime], tags: Iterable[Tuple[str, str]]
+) -> Dict[str, Any]:
+    """Build a ``ways`` row from an OSM way's metadata and (key, value) tags."""
+    way_data = {
+        'way_id': way_id,
+        'lanes': None,
+        'lanes_forward': None,
+        'lanes_backward': None,
+        'highway_type': None,
+        'name': None,
+        'maxspeed': None,
+        'version': version,
+        'timestamp': timestamp,
+    }
+    
+    # Get way attributes
+    for key, value in tags:
+        column = WAY_TAG_COLUMNS.get(key)
+        if column is None:
+            continue
+        if column in INTEGER_TAG_COLUMNS:
+            try:
+                way_data[column] = int(value)
+            except ValueError:
+                pass
+        else:
+            way_data[column] = value
+    return way_data
+
+def _parse_way(elem: ET.Element) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    way_id = int(elem.get('id'))
+    way_data = build_way_record(
+        way_id,
+        int(elem.get('version')),
+        parse_timestamp(elem.get('timestamp')),
+        ((tag.get('k'), tag.get('v')) for tag in elem.findall('tag')),
+    )
+    
+    # Get node sequence
+    way_nodes = [
+        {'way_id': way_id, 'node_id': int(nd.get('ref')), 'sequence': i}
+        for i, nd in enumerate(elem.findall('nd'))
+    ]
+    return way_data, way_nodes
+
+def iter_osm_xml(
+    source: Union[str, BinaryIO],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    include_geom: bool = True,
+) -> Iterator[OSMBatch]:
+    """
+    Incrementally parse OSM XML and yield (nodes, ways, way_nodes) batches.
+    
+    Elements are cleared as soon as they have been converted, so memory use
+    is bounded by ``batch_size`` rather than by the size of the document.
     
+    Args:
+        source: Path to an OSM XML file or a binary file-like object
+            (e.g. an open file or ``response.raw``)
+        batch_size: Number of rows (nodes + ways + way_nodes) per batch
+        include_geom: Build a ``geom`` WKB element for every node. Not needed
+            by ``DatabaseManager.bulk_store_osm_data``, which builds point
+            geometries on the server.
+    
+    Yields:
+        Tuples of (nodes, ways, way_nodes) lists in the same format as
+        ``parse_osm_xml``. Rows appear in document order, so nodes precede
+        the ways that reference them in standard OSM output.
+    """
     nodes = []
     ways = []
     way_nodes = []
+    root = None
+    
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+        
+        if elem.tag == 'node':
+            nodes.append(_parse_node(elem, include_geom))
+        elif elem.tag == 'way':
+            way_data, refs = _parse_way(elem)
+            ways.append(way_data)
+            way_nodes.extend(refs)
+        elif elem.tag != 'relation':
+            # Children (tag, nd, member) are consumed with their parent
+            continue
+        
+        # Drop the finished element and any siblings held by the root
+        elem.clear()
+        root.clear()
+        
+        if len(nodes) + len(ways) + len(way_nodes) >= batch_size:
+            yield nodes, ways, way_nodes
+            nodes, ways, way_nodes = [], [], []
+    
+    if nodes or ways or way_nodes:
+        yield nodes, ways, way_nodes
+
+class _ColumnBuilder:
+    """Accumulates parsed elements in flat lists until they become an ``OSMColumns`` batch."""
+
+    def __init__(self):
+        self.nodes = ([], [], [], [], [])  # id, lat, lon, version, timestamp
+        self.ways = ([], [], [])  # id, version, timestamp
+        self.tags = {column: [] for column in WAY_TAG_COLUMNS.values()}
+        self.offsets = [0]
+        self.refs = []
+
+    @property
+    def rows(self) -> int:
+        return len(self.nodes[0]) + len(self.ways[0]) + len(self.refs)
+
+    def add_node(self, elem: ET.Element) -> None:
+        node_id, lat, lon, version, timestamp = self.nodes
+        node_id.append(int(elem.get('id')))
+        lat.append(float(elem.get('lat')))
+        lon.append(float(elem.get('lon')))
+        version.append(int(elem.get('version')))
+        timestamp.append(elem.get('timestamp'))
+
+    def add_way(self, elem: ET.Element) -> None:
+        way_id, version, timestamp = self.ways
+        way_id.append(int(elem.get('id')))
+        version.append(int(elem.get('version')))
+        timestamp.append(elem.get('timestamp'))
+        values = {}
+        for tag in elem.iterfind('tag'):
+            column = WAY_TAG_COLUMNS.get(tag.get('k'))
+            if column is not None:
+                values[column] = tag.get('v')
+        for column, column_values in self.tags.items():
+            value = values.get(column)
+            if column in INTEGER_TAG_COLUMNS:
+                try:
+                    value = int(value) if value is not None else MISSING
+                except ValueError:
+                    value = MISSING
+            column_values.append(value)
+        self.refs.extend(int(nd.get('ref')) for nd in elem.iterfind('nd'))
+        self.offsets.append(len(self.refs))
+
+    def build(self) -> OSMColumns:
+        def array(values: List[Any], name: str) -> np.ndarray:
+            dtype = DTYPES[name]
+            if dtype == object:
+                column = np.empty(len(values), dtype=object)
+                column[:] = values
+                return column
+            return np.array(values, dtype=dtype)
+
+        def timestamps(values: List[Optional[str]]) -> np.ndarray:
+            # numpy warns about the UTC designator, so parse without it
+            return np.array(
+                [value[:-1] if value and value.endswith('Z') else (value or 'NaT') for value in values],
+                dtype=DTYPES['node_timestamp'],
+            )
+
+        node_id, lat, lon, node_version, node_timestamp = self.nodes
+        way_id, way_version, way_timestamp = self.ways
+        return OSMColumns(
+            node_id=array(node_id, 'node_id'),
+            lat=array(lat, 'lat'),
+            lon=array(lon, 'lon'),
+            node_version=array(node_version, 'node_version'),
+            node_timestamp=timestamps(node_timestamp),
+            way_id=array(way_id, 'way_id'),
+            way_version=array(way_version, 'way_version'),
+            way_timestamp=timestamps(way_timestamp),
+            way_node_offsets=array(self.offsets, 'way_node_offsets'),
+            way_node_ids=array(self.refs, 'way_node_ids'),
+            **{column: array(values, column) for column, values in self.tags.items()},
+        )
+
+def iter_osm_xml_columnar(
+    source: Union[str, BinaryIO],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> Iterator[OSMColumns]:
+    """
+    Incrementally parse OSM XML into columnar ``OSMColumns`` batches.
+    
+    Same traversal as ``iter_osm_xml``, but no dict, datetime or geometry
+    object is built per element: values go straight into typed arrays,
+    with way nodes in CSR layout. A way's nodes may be in an earlier batch;
+    use ``concat_columns`` or ``parse_osm_xml_columnar`` when one batch
+    must hold the whole network.
+    
+    Args:
+        source: Path to an OSM XML file or a binary file-like object
+        batch_size: Number of rows (nodes + ways + way_nodes) per batch
+    """
+    builder = _ColumnBuilder()
+    root = None
     
-    for elem in root:
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+        
         if elem.tag == 'node':
-            lat = float(elem.get('lat'))
-            lon = float(elem.get('lon'))
-            node = {
-                'node_id': int(elem.get('id')),
-                'lat': lat,
-                'lon': lon,
-                'version': int(elem.get('version')),
-                'timestamp': parse_timestamp(elem.get('timestamp')),
-                'geom': from_shape(Point(lon, lat), srid=4326)
-            }
-            nodes.append(node)
-            
+            builder.add_node(elem)
+        elif elem.tag == 'way':
+            builder.add_way(elem)
+        elif elem.tag != 'relation':
+            continue
+        
+        elem.clear()
+        root.clear()
+        
+        if builder.rows >= batch_size:
+            yield builder.build()
+            builder = _ColumnBuilder()
+    
+    if builder.rows:
+        yield builder.build()
+
+def iter_osm_change(
+    source: Union[str, BinaryIO],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> Iterator[OSMChangeBatch]:
+    """
+    Incrementally parse an osmChange (.osc) diff.
+    
+    Elements inside ``<create>`` and ``<modify>`` are parsed like
+    ``iter_osm_xml``; elements inside ``<delete>`` only keep their ID and
+    version. Relations are ignored.
+    
+    Args:
+        source: Path to an .osc or .osc.gz file or a binary file-like object
+        batch_size: Number of rows per batch
+    
+    Yields:
+        Tuples of (nodes, ways, way_nodes, deleted_nodes, deleted_ways), where
+        deletions are dicts with ``node_id``/``way_id`` and ``version``.
+    """
+    if isinstance(source, str) and source.endswith('.gz'):
+        with gzip.open(source, 'rb') as f:
+            yield from iter_osm_change(f, batch_size)
+        return
+    
+    nodes, ways, way_nodes, deleted_nodes, deleted_ways = [], [], [], [], []
+    root = None
+    # Element whose children are the entities being parsed: the current
+    # <create>/<modify>/<delete> block, or the root between blocks
+    parent = None
+    action = None
+    
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = parent = elem
+            elif elem.tag in ('create', 'modify', 'delete'):
+                action = elem.tag
+                parent = elem
+            continue
+        
+        if elem.tag in ('create', 'modify', 'delete'):
+            action = None
+            parent = root
+            del root[:]
+            continue
+        elif elem.tag not in ('node', 'way', 'relation'):
+            continue
+        elif action == 'delete':
+            version = elem.get('version')
+            version = int(version) if version is not None else None
+            if elem.tag == 'node':
+                deleted_nodes.append({'node_id': int(elem.get('id')), 'version': version})
+            elif elem.tag == 'way':
+                deleted_ways.append({'way_id': int(elem.get('id')), 'version': version})
+        elif elem.tag == 'node':
+            nodes.append(_parse_node(elem, include_geom=False))
         elif elem.tag == 'way':
-            way_id = int(elem.get('id'))
-            way_data = {
-                'way_id': way_id,
-                'lanes': None,
-                'lanes_forward': None,
-                'lanes_backward': None,
-                'highway_type': None,
-                'name': None,
-                'maxspeed': None,
-                'version': int(elem.get('version')),
-                'timestamp': parse_timestamp(elem.get('timestamp')),
-            }
-            
-            # Get way attributes
-            for tag in elem.findall('tag'):
-                key = tag.get('k')
-                value = tag.get('v')
-                if key == 'lanes':
-                    try:
-                        way_data['lanes'] = int(value)
-                    except ValueError:
-                        pass
-                elif key == 'lanes:forward':
-                    try:
-                        way_data['lanes_forward'] = int(value)
-                    except ValueError:
-                        pass
-                elif key == 'lanes:backward':
-                    try:
-                        way_data['lanes_backward'] = int(value)
-                    except ValueError:
-                        pass
-                elif key == 'highway':
-                    way_data['highway_type'] = value
-                elif key == 'name':
-                    way_data['name'] = value
-                elif key == 'maxspeed':
-                    way_data['maxspeed'] = value
-            
+            way_data, refs = _parse_way(elem)
             ways.append(way_data)
-            
-            # Get node sequence
-            for i, nd in enumerate(elem.findall('nd')):
-                way_nodes.append({
-                    'way_id': way_id,
-                    'node_id': int(nd.get('ref')),
-                    'sequence': i
-                })
-    
-    return nodes, ways, way_nodes 
+            way_nodes.extend(refs)
+        
+        elem.clear()
+        # Drop parsed entities from their block, which can hold a whole diff
+        del parent[:]
+        
+        rows = len(nodes) + len(ways) + len(way_nodes) + len(deleted_nodes) + len(deleted_ways)
+        if rows >= batch_size:
+            yield nodes, ways, way_nodes, deleted_nodes, deleted_ways
+            nodes, ways, way_nodes, deleted_nodes, deleted_ways = [], [], [], [], []
+    
+    if nodes or ways or way_nodes or deleted_nodes or deleted_ways:
+        yield nodes, ways, way_nodes, deleted_nodes, deleted_ways
+
+def parse_osm_xml(xml_data: str, include_geom: bool = True) -> OSMBatch:
+    nodes = []
+    ways = []
+    way_nodes = []
+    
+    source = BytesIO(xml_data.encode('utf-8') if isinstance(xml_data, str) else xml_data)
+    for batch_nodes, batch_ways, batch_way_nodes in iter_osm_xml(source, include_geom=include_geom):
+        nodes.extend(batch_nodes)
+        ways.extend(batch_ways)
+        way_nodes.extend(batch_way_nodes)
+    
+    return nodes, ways, way_nodes
+
+def parse_osm_xml_columnar(xml_data: Union[str, bytes]) -> OSMColumns:
+    """Parse an OSM XML document into a single ``OSMColumns`` batch."""
+    source = BytesIO(xml_data.encode('utf-8') if isinstance(xml_data, str) else xml_data)
+    return concat_columns(iter_osm_xml_columnar(source))
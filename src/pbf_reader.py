@@ -0,0 +1,392 @@
+import argparse
+import lzma
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from parser import DEFAULT_BATCH_SIZE, OSMBatch, build_way_record
+
+# Same road classes as the Overpass query in fetch_freeways.py
+DEFAULT_HIGHWAY_TYPES = ('motorway', 'motorway_link', 'trunk', 'trunk_link')
+
+# (offset, length) of a blob's bytes within the file
+BlobLocation = Tuple[int, int]
+
+# Protocol buffer wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+
+def _read_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _iter_fields(buf: bytes) -> Iterator[Tuple[int, int, Any]]:
+    """Yield (field number, wire type, value) for each field of a message."""
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == VARINT:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = _read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == FIXED64:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == FIXED32:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        yield field, wire_type, value
+
+
+def _packed_varints(data: bytes) -> np.ndarray:
+    """Decode a packed repeated varint field into uint64 values, vectorized."""
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if not len(raw):
+        return np.empty(0, dtype=np.uint64)
+    ends = np.flatnonzero(raw < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # Position of each byte inside its varint gives its 7-bit shift
+    owner = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = ((np.arange(len(raw)) - starts[owner]) * 7).astype(np.uint64)
+    payload = (raw & 0x7f).astype(np.uint64) << shifts
+    return np.add.reduceat(payload, starts)
+
+
+def _packed_sint64(data: bytes) -> np.ndarray:
+    """Decode a packed zigzag-encoded sint64 field."""
+    values = _packed_varints(data)
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def _zigzag(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
+
+
+def _int64(value: int) -> int:
+    """Reinterpret a decoded (unsigned) varint as a two's complement int64."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _read_blob(path: str, location: BlobLocation) -> bytes:
+    """Read a blob and return its decompressed payload."""
+    offset, length = location
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        blob = f.read(length)
+    for field, _, value in _iter_fields(blob):
+        if field == 1:
+            return bytes(value)
+        if field == 3:
+            return zlib.decompress(value)
+        if field == 4:
+            return lzma.decompress(value)
+    raise ValueError("Unsupported blob compression")
+
+
+def scan_blobs(path: str) -> List[BlobLocation]:
+    """Return the locations of all OSMData blobs, reading only the headers."""
+    locations = []
+    with open(path, 'rb') as f:
+        while True:
+            size_bytes = f.read(4)
+            if len(size_bytes) < 4:
+                break
+            (header_size,) = struct.unpack('>I', size_bytes)
+            header = f.read(header_size)
+            blob_type = None
+            data_size = 0
+            for field, _, value in _iter_fields(header):
+                if field == 1:
+                    blob_type = bytes(value).decode('utf-8')
+                elif field == 3:
+                    data_size = value
+            if blob_type == 'OSMData':
+                locations.append((f.tell(), data_size))
+            f.seek(data_size, os.SEEK_CUR)
+    return locations
+
+
+def _parse_block(payload: bytes) -> Tuple[List[bytes], List[bytes], Dict[str, int]]:
+    """Split a PrimitiveBlock into its string table, groups and coordinate settings."""
+    strings = []
+    groups = []
+    settings = {'granularity': 100, 'lat_offset': 0, 'lon_offset': 0, 'date_granularity': 1000}
+    for field, _, value in _iter_fields(payload):
+        if field == 1:
+            strings = [bytes(s) for f, _, s in _iter_fields(value) if f == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            settings['granularity'] = value
+        elif field == 18:
+            settings['date_granularity'] = value
+        elif field == 19:
+            settings['lat_offset'] = _int64(value)
+        elif field == 20:
+            settings['lon_offset'] = _int64(value)
+    return strings, groups, settings
+
+
+def _decode_info(info: bytes) -> Tuple[Optional[int], Optional[int]]:
+    version = timestamp = None
+    for field, _, value in _iter_fields(info):
+        if field == 1:
+            version = value
+        elif field == 2:
+            timestamp = value
+    return version, timestamp
+
+
+def decode_ways(
+    path: str, location: BlobLocation, highway_types: Optional[Tuple[str, ...]]
+) -> Tuple[bool, List[Tuple[int, Optional[int], Optional[int], List[Tuple[str, str]], np.ndarray]]]:
+    """
+    Decode the highway ways of one block. Runs in a worker process.
+
+    Returns:
+        Whether the block holds nodes, and (way_id, version, timestamp
+        seconds, tags, node refs) for every way passing the highway filter
+    """
+    strings, groups, settings = _parse_block(_read_blob(path, location))
+    try:
+        highway_index = strings.index(b'highway')
+    except ValueError:
+        highway_index = None
+
+    has_nodes = False
+    ways = []
+    for group in groups:
+        for field, _, value in _iter_fields(group):
+            if field in (1, 2):
+                has_nodes = True
+                continue
+            if field != 3 or highway_index is None:
+                continue
+
+            way_id = 0
+            keys = vals = refs = None
+            info = None
+            for way_field, _, way_value in _iter_fields(value):
+                if way_field == 1:
+                    way_id = way_value
+                elif way_field == 2:
+                    keys = _packed_varints(way_value)
+                elif way_field == 3:
+                    vals = _packed_varints(way_value)
+                elif way_field == 4:
+                    info = way_value
+                elif way_field == 8:
+                    refs = way_value
+
+            # Filter on the highway tag before decoding anything else
+            if keys is None or highway_index not in keys:
+                continue
+            highway = strings[int(vals[int(np.flatnonzero(keys == highway_index)[0])])].decode('utf-8')
+            if highway_types is not None and highway not in highway_types:
+                continue
+
+            tags = [
+                (strings[int(k)].decode('utf-8'), strings[int(v)].decode('utf-8'))
+                for k, v in zip(keys, vals)
+            ]
+            version, timestamp = _decode_info(info) if info is not None else (None, None)
+            if timestamp is not None:
+                timestamp = timestamp * settings['date_granularity'] // 1000
+            node_refs = np.cumsum(_packed_sint64(refs)) if refs is not None else np.empty(0, np.int64)
+            ways.append((way_id, version, timestamp, tags, node_refs))
+    return has_nodes, ways
+
+
+def decode_nodes(path: str, location: BlobLocation) -> Dict[str, np.ndarray]:
+    """Decode all nodes of one block into arrays. Runs in a worker process."""
+    _, groups, settings = _parse_block(_read_blob(path, location))
+    columns = {'node_id': [], 'lat': [], 'lon': [], 'version': [], 'timestamp': []}
+
+    def add(ids, lats, lons, versions, timestamps):
+        columns['node_id'].append(ids)
+        columns['lat'].append(1e-9 * (settings['lat_offset'] + settings['granularity'] * lats))
+        columns['lon'].append(1e-9 * (settings['lon_offset'] + settings['granularity'] * lons))
+        columns['version'].append(versions)
+        columns['timestamp'].append(timestamps * settings['date_granularity'] // 1000)
+
+    for group in groups:
+        for field, _, value in _iter_fields(group):
+            if field == 2:
+                ids = lats = lons = None
+                versions = timestamps = None
+                for dense_field, _, dense_value in _iter_fields(value):
+                    if dense_field == 1:
+                        ids = np.cumsum(_packed_sint64(dense_value))
+                    elif dense_field == 8:
+                        lats = np.cumsum(_packed_sint64(dense_value))
+                    elif dense_field == 9:
+                        lons = np.cumsum(_packed_sint64(dense_value))
+                    elif dense_field == 5:
+                        for info_field, _, info_value in _iter_fields(dense_value):
+                            if info_field == 1:
+                                versions = _packed_varints(info_value).astype(np.int64)
+                            elif info_field == 2:
+                                timestamps = np.cumsum(_packed_sint64(info_value))
+                if ids is None:
+                    continue
+                missing = np.full(len(ids), -1, dtype=np.int64)
+                add(
+                    ids, lats, lons,
+                    versions if versions is not None else missing,
+                    timestamps if timestamps is not None else missing,
+                )
+            elif field == 1:
+                node_id = lat = lon = 0
+                version, timestamp = -1, -1
+                for node_field, _, node_value in _iter_fields(value):
+                    if node_field == 1:
+                        node_id = _zigzag(node_value)
+                    elif node_field == 8:
+                        lat = _zigzag(node_value)
+                    elif node_field == 9:
+                        lon = _zigzag(node_value)
+                    elif node_field == 4:
+                        info_version, info_timestamp = _decode_info(node_value)
+                        version = info_version if info_version is not None else -1
+                        timestamp = info_timestamp if info_timestamp is not None else -1
+                add(*(np.array([v], dtype=np.int64) for v in (node_id, lat, lon, version, timestamp)))
+
+    if not columns['node_id']:
+        return {
+            'node_id': np.empty(0, np.int64), 'lat': np.empty(0), 'lon': np.empty(0),
+            'version': np.empty(0, np.int64), 'timestamp': np.empty(0, np.int64),
+        }
+    return {name: np.concatenate(arrays) for name, arrays in columns.items()}
+
+
+def _timestamp(seconds: Optional[int]) -> Optional[datetime]:
+    if seconds is None or seconds < 0:
+        return None
+    return datetime.utcfromtimestamp(seconds)
+
+
+def iter_pbf(
+    path: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    highway_types: Optional[Iterable[str]] = DEFAULT_HIGHWAY_TYPES,
+    workers: Optional[int] = None,
+) -> Iterator[OSMBatch]:
+    """
+    Read highway ways and their nodes from an ``.osm.pbf`` file.
+
+    Blocks are decompressed and decoded in parallel worker processes. A
+    first pass decodes ways, keeping only those whose ``highway`` tag is in
+    ``highway_types`` (any highway if None). A second pass decodes only the
+    node blocks and keeps the nodes referenced by those ways.
+
+    Args:
+        path: Path to the ``.osm.pbf`` file
+        batch_size: Number of rows per yielded batch
+        highway_types: Highway tag values to keep, or None for all highways
+        workers: Number of worker processes (defaults to the CPU count)
+
+    Yields:
+        (nodes, ways, way_nodes) batches in the format of ``parse_osm_xml``
+        (without node ``geom``), ready for ``DatabaseManager.bulk_store_osm_data``.
+        All nodes are yielded before any way.
+    """
+    highway_types = tuple(highway_types) if highway_types is not None else None
+    locations = scan_blobs(path)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        decoded = list(executor.map(
+            decode_ways,
+            [path] * len(locations), locations, [highway_types] * len(locations),
+        ))
+        node_locations = [loc for loc, (has_nodes, _) in zip(locations, decoded) if has_nodes]
+        ways = [way for _, block_ways in decoded for way in block_ways]
+        del decoded
+
+        needed = np.unique(np.concatenate([way[4] for way in ways])) if ways else np.empty(0, np.int64)
+
+        nodes = []
+        for block in executor.map(decode_nodes, [path] * len(node_locations), node_locations):
+            keep = np.isin(block['node_id'], needed, assume_unique=False)
+            if not keep.any():
+                continue
+            for node_id, lat, lon, version, timestamp in zip(
+                block['node_id'][keep].tolist(), block['lat'][keep].tolist(),
+                block['lon'][keep].tolist(), block['version'][keep].tolist(),
+                block['timestamp'][keep].tolist(),
+            ):
+                nodes.append({
+                    'node_id': node_id,
+                    'lat': lat,
+                    'lon': lon,
+                    'version': version if version >= 0 else None,
+                    'timestamp': _timestamp(timestamp),
+                })
+                if len(nodes) >= batch_size:
+                    yield nodes, [], []
+                    nodes = []
+        if nodes:
+            yield nodes, [], []
+
+    way_rows = []
+    way_nodes = []
+    for way_id, version, timestamp, tags, refs in ways:
+        way_rows.append(build_way_record(way_id, version, _timestamp(timestamp), tags))
+        way_nodes.extend(
+            {'way_id': way_id, 'node_id': node_id, 'sequence': i}
+            for i, node_id in enumerate(refs.tolist())
+        )
+        if len(way_rows) + len(way_nodes) >= batch_size:
+            yield [], way_rows, way_nodes
+            way_rows, way_nodes = [], []
+    if way_rows:
+        yield [], way_rows, way_nodes
+
+
+def main():
+    from database import DatabaseManager
+    from fetch_freeways import print_load_stats
+
+    arg_parser = argparse.ArgumentParser(description="Load highways from an .osm.pbf extract")
+    arg_parser.add_argument('path', help="path to the .osm.pbf file")
+    arg_parser.add_argument('--workers', type=int, default=None, help="decoder processes")
+    arg_parser.add_argument(
+        '--highway', action='append', default=None,
+        help="highway type to keep (repeatable, default: motorway/trunk and links)",
+    )
+    arg_parser.add_argument('--all-highways', action='store_true', help="keep every highway type")
+    args = arg_parser.parse_args()
+
+    highway_types = None if args.all_highways else (args.highway or DEFAULT_HIGHWAY_TYPES)
+    db = DatabaseManager()
+    db.init_db()
+    stats = db.bulk_store_osm_data(iter_pbf(args.path, highway_types=highway_types, workers=args.workers))
+    print(f"Stored {stats['ways']['staged']} ways and {stats['nodes']['staged']} nodes")
+    print_load_stats(stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from speed_prediction import fetch_pems_lanes
+
+# Per-lane samples kept for prediction
+DEFAULT_HISTORY = 30
+
+
+class _Station:
+    """Rolling lane history and fetch bookkeeping for one station."""
+
+    def __init__(self, history: int):
+        self.lanes = {}
+        self.history = history
+        self.fetched_at = None
+        self.last_access = time.monotonic()
+        # Set while a fetch is in flight; callers needing its result wait on it
+        self.inflight = None
+        self.failures = 0
+        self.last_error = None
+        self.failed_at = None
+
+    @property
+    def refreshing(self) -> bool:
+        return self.inflight is not None
+
+    def add_sample(self, speeds: Dict[int, float], now: float, min_interval: float) -> bool:
+        """
+        Append one sample per lane, taken at ``now``. Returns False if skipped.
+
+        Prediction treats samples as ``min_interval`` apart, so a sample
+        closer than that to the previous one is not appended.
+        """
+        self.failures = 0
+        self.last_error = None
+        self.failed_at = None
+        if self.fetched_at is not None and now - self.fetched_at < min_interval:
+            return False
+        for lane, speed in speeds.items():
+            self.lanes.setdefault(lane, deque(maxlen=self.history)).append(speed)
+        # Lanes missing from the latest sample are closed or no longer reported
+        for lane in set(self.lanes) - set(speeds):
+            del self.lanes[lane]
+        self.fetched_at = now
+        return True
+
+
+class PemsPoller:
+    """
+    Background PeMS poller with a TTL cache and stale-while-revalidate.
+
+    Stations that were requested recently (or passed to ``watch``) are
+    refreshed every ``interval`` seconds by worker threads, each poll
+    appending one sample per lane to a rolling history. ``get`` never
+    waits on PeMS when data exists: data older than ``ttl`` is returned
+    while a refresh runs in the background, until it is older than
+    ``stale_ttl``. Only a station without usable data is fetched inline,
+    with one fetch shared by concurrent requests, and after a failed
+    fetch ``get`` returns None at once for ``failure_ttl`` seconds instead
+    of waiting on PeMS again. Stations not requested for ``idle_ttl``
+    seconds stop being polled.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[int], Dict[int, float]] = fetch_pems_lanes,
+        interval: float = 30.0,
+        ttl: float = 60.0,
+        stale_ttl: float = 600.0,
+        idle_ttl: float = 3600.0,
+        failure_ttl: float = 30.0,
+        history: int = DEFAULT_HISTORY,
+        workers: int = 8,
+    ):
+        self.fetch = fetch
+        self.interval = interval
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.idle_ttl = idle_ttl
+        self.failure_ttl = failure_ttl
+        self.history = history
+        self._stations = {}
+        self._pinned = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pems-fetch')
+        self._thread = None
+        self._stop = threading.Event()
+        self.fetches = 0
+        self.fetch_failures = 0
+        self.inline_fetches = 0
+        self.stale_served = 0
+        self.failures_served = 0
+        self.samples_skipped = 0
+        self.last_cycle_seconds = None
+
+    def watch(self, station_ids: Iterable[int]) -> None:
+        """Poll these stations for as long as the poller runs, requested or not."""
+        with self._lock:
+            for station_id in station_ids:
+                self._pinned.add(station_id)
+                self._stations.setdefault(station_id, _Station(self.history))
+
+    def refresh(self, station_id: int) -> bool:
+        """
+        Fetch one station now. Returns False if the fetch failed.
+
+        Only one fetch per station runs at a time: if one is already in
+        flight, this waits for it and reports its outcome.
+        """
+        with self._lock:
+            station = self._stations.setdefault(station_id, _Station(self.history))
+            event = station.inflight
+            if event is None:
+                station.inflight = threading.Event()
+        if event is not None:
+            event.wait()
+            return station.last_error is None
+        return self._fetch(station_id, station)
+
+    def _fetch(self, station_id: int, station: _Station) -> bool:
+        # The caller has set station.inflight. Samples are stamped with the
+        # fetch start, so polled samples stay at least ``interval`` apart
+        started = time.monotonic()
+        try:
+            speeds = self.fetch(station_id)
+        except Exception as e:
+            with self._lock:
+                self.fetch_failures += 1
+                station.failures += 1
+                station.last_error = str(e)
+                station.failed_at = time.monotonic()
+                self._finish(station)
+            return False
+        with self._lock:
+            self.fetches += 1
+            if not station.add_sample(speeds, started, self.interval):
+                self.samples_skipped += 1
+            self._finish(station)
+        return True
+
+    def _finish(self, station: _Station) -> None:
+        # Called with the lock held
+        event, station.inflight = station.inflight, None
+        event.set()
+
+    def _schedule(self, station_id: int, station: _Station) -> None:
+        # Called with the lock held; at most one fetch per station in flight
+        if station.inflight is None:
+            station.inflight = threading.Event()
+            self._executor.submit(self._fetch, station_id, station)
+
+    def get(self, station_id: int) -> Optional[Tuple[Dict[int, List[float]], float]]:
+        """
+        Return (lane history, age in seconds) for a station.
+
+        Returns None if PeMS could not be reached and there is no data
+        younger than ``stale_ttl``.
+        """
+        now = time.monotonic()
+        with self._lock:
+            station = self._stations.setdefault(station_id, _Station(self.history))
+            station.last_access = now
+            age = None if station.fetched_at is None else now - station.fetched_at
+            if age is not None and age <= self.stale_ttl:
+                if age > self.ttl:
+                    self.stale_served += 1
+                    self._schedule(station_id, station)
+                return {lane: list(speeds) for lane, speeds in station.lanes.items()}, age
+            if station.failed_at is not None and now - station.failed_at < self.failure_ttl:
+                # PeMS just failed for this station; don't make every request wait on it
+                self.failures_served += 1
+                return None
+            self.inline_fetches += 1
+
+        self.refresh(station_id)
+        with self._lock:
+            if station.fetched_at is None or time.monotonic() - station.fetched_at > self.stale_ttl:
+                return None
+            lanes = {lane: list(speeds) for lane, speeds in station.lanes.items()}
+            return lanes, time.monotonic() - station.fetched_at
+
+    def poll_once(self) -> int:
+        """Refresh every station that is due and forget idle ones. Returns the number scheduled."""
+        started = time.monotonic()
+        with self._lock:
+            for station_id in [
+                station_id for station_id, station in self._stations.items()
+                if station_id not in self._pinned and started - station.last_access > self.idle_ttl
+            ]:
+                del self._stations[station_id]
+            due = [
+                station_id for station_id, station in self._stations.items()
+                if not station.refreshing and (
+                    station.fetched_at is None or started - station.fetched_at >= self.interval
+                )
+            ]
+            stations = [self._stations[station_id] for station_id in due]
+            for station in stations:
+                station.inflight = threading.Event()
+        futures = [
+            self._executor.submit(self._fetch, station_id, station)
+            for station_id, station in zip(due, stations)
+        ]
+        for future in futures:
+            future.result()
+        self.last_cycle_seconds = time.monotonic() - started
+        return len(due)
+
+    def start(self) -> None:
+        """Poll in a background thread until ``stop`` is called."""
+        if self._thread is not None:
+            return
+
+        def run():
+            while True:
+                try:
+                    self.poll_once()
+                except Exception as e:
+                    print(f"PeMS poll failed: {e}")
+                if self._stop.wait(self.interval):
+                    return
+
+        self._thread = threading.Thread(target=run, name='pems-poller', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown(wait=False)
+
+    def metrics(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            ages = [
+                now - station.fetched_at
+                for station in self._stations.values()
+                if station.fetched_at is not None
+            ]
+            failing = {
+                str(station_id): {'failures': station.failures, 'last_error': station.last_error}
+                for station_id, station in self._stations.items()
+                if station.failures
+            }
+            return {
+                'stations': len(self._stations),
+                'watched': len(self._pinned),
+                'with_data': len(ages),
+                'fresh': sum(1 for age in ages if age <= self.ttl),
+                'stale': sum(1 for age in ages if self.ttl < age <= self.stale_ttl),
+                'max_age_seconds': max(ages) if ages else None,
+                'mean_age_seconds': sum(ages) / len(ages) if ages else None,
+                'fetches': self.fetches,
+                'fetch_failures': self.fetch_failures,
+                'inline_fetches': self.inline_fetches,
+                'stale_served': self.stale_served,
+                'failures_served': self.failures_served,
+                'samples_skipped': self.samples_skipped,
+                'last_cycle_seconds': self.last_cycle_seconds,
+                'failing_stations': failing,
+            }
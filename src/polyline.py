@@ -0,0 +1,88 @@
+from typing import List, Optional, Sequence
+
+# (highest zoom level in band, simplification tolerance in degrees).
+# Shapes for every band are precomputed into way_shapes; the last band
+# holds full-resolution geometry.
+ZOOM_BANDS = [
+    (8, 0.005),
+    (11, 0.0005),
+    (14, 0.00005),
+    (None, 0.0),
+]
+
+FULL_RESOLUTION_BAND = len(ZOOM_BANDS) - 1
+
+
+def band_for_zoom(zoom: Optional[int]) -> int:
+    """Return the index of the zoom band serving ``zoom`` (None means full resolution)."""
+    if zoom is None:
+        return FULL_RESOLUTION_BAND
+    for band, (max_zoom, _) in enumerate(ZOOM_BANDS):
+        if max_zoom is None or zoom <= max_zoom:
+            return band
+    return FULL_RESOLUTION_BAND
+
+
+def _quantize(coords: Sequence[Sequence[float]], precision: int) -> List[List[int]]:
+    factor = 10 ** precision
+    return [[int(round(lat * factor)), int(round(lon * factor))] for lat, lon in coords]
+
+
+def encode_polyline(coords: Sequence[Sequence[float]], precision: int = 5) -> str:
+    """
+    Encode [lat, lon] pairs with the Google encoded polyline algorithm.
+
+    Args:
+        coords: Sequence of [lat, lon] pairs
+        precision: Number of decimal places kept (5 for Google Maps, 6 for OSRM)
+
+    Returns:
+        str: Encoded polyline
+    """
+    chunks = []
+    prev_lat = prev_lon = 0
+    for lat, lon in _quantize(coords, precision):
+        for delta in (lat - prev_lat, lon - prev_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        prev_lat, prev_lon = lat, lon
+    return ''.join(chunks)
+
+
+def decode_polyline(encoded: str, precision: int = 5) -> List[List[float]]:
+    """Inverse of ``encode_polyline``."""
+    coords = []
+    values = [0, 0]
+    index = 0
+    factor = 10 ** precision
+    while index < len(encoded):
+        for i in range(2):
+            shift = result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            values[i] += ~(result >> 1) if result & 1 else result >> 1
+        coords.append([values[0] / factor, values[1] / factor])
+    return coords
+
+
+def encode_deltas(coords: Sequence[Sequence[float]], precision: int = 5) -> List[int]:
+    """
+    Encode [lat, lon] pairs as a flat list of delta-quantized integers.
+
+    The first pair is absolute, every following pair is the difference to
+    the previous one, all scaled by ``10 ** precision``.
+    """
+    flat = []
+    prev_lat = prev_lon = 0
+    for lat, lon in _quantize(coords, precision):
+        flat.extend((lat - prev_lat, lon - prev_lon))
+        prev_lat, prev_lon = lat, lon
+    return flat
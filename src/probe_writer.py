@@ -0,0 +1,186 @@
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Sequence, Tuple
+
+
+class ProbeWriter:
+    """
+    Write-behind buffer for user speed probes.
+
+    ``submit`` only appends to an in-memory queue; a background thread
+    writes queued rows with ``DatabaseManager.store_user_data_batch`` once
+    ``batch_size`` rows are waiting or the oldest row is ``flush_interval``
+    seconds old. When ``max_queue`` rows are pending, ``submit`` rejects new
+    probes so callers can shed load instead of growing memory.
+
+    A failed batch is retried with exponential backoff up to
+    ``max_retries`` times, ahead of newer rows. After that it is split in
+    halves, each written on its own, so rows the database rejects are
+    isolated; a single row that still fails goes to ``dead_letters`` (the
+    last ``dead_letter_size`` are kept) and the writer moves on. ``close``
+    drains the queue.
+    """
+
+    def __init__(
+        self,
+        db_manager: Any,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        max_queue: int = 50000,
+        max_retries: int = 5,
+        dead_letter_size: int = 1000,
+    ):
+        self.db_manager = db_manager
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self._queue = deque()
+        # (batch, failed attempts) to write before anything in _queue
+        self._retries = deque()
+        self._retry_rows = 0
+        self.dead_letters = deque(maxlen=dead_letter_size)
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self.submitted = 0
+        self.rejected = 0
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dead_lettered = 0
+        self._thread = threading.Thread(target=self._run, name='probe-writer', daemon=True)
+        self._thread.start()
+
+    def __len__(self) -> int:
+        return len(self._queue) + self._retry_rows
+
+    def submit(self, rows: Sequence[Dict[str, Any]]) -> bool:
+        """
+        Queue rows for writing.
+
+        All rows are accepted or none are. Returns False when the queue is
+        full or the writer has been closed.
+        """
+        with self._cond:
+            if self._closed or len(self._queue) + self._retry_rows + len(rows) > self.max_queue:
+                self.rejected += len(rows)
+                return False
+            was_empty = not self._queue
+            if was_empty:
+                self._oldest = time.monotonic()
+            self._queue.extend(rows)
+            self.submitted += len(rows)
+            # Wake the writer to start the flush timer or write a full batch
+            if was_empty or len(self._queue) >= self.batch_size:
+                self._cond.notify()
+            return True
+
+    def _take_batch(self) -> Tuple[List[Dict[str, Any]], int]:
+        # Called with the lock held; retries go first
+        if self._retries:
+            batch, attempts = self._retries.popleft()
+            self._retry_rows -= len(batch)
+            return batch, attempts
+        count = min(self.batch_size, len(self._queue))
+        batch = [self._queue.popleft() for _ in range(count)]
+        self._oldest = time.monotonic() if self._queue else None
+        return batch, 0
+
+    def _retry(self, *batches: List[Dict[str, Any]], attempts: int) -> None:
+        with self._cond:
+            for batch in reversed(batches):
+                self._retries.appendleft((batch, attempts))
+                self._retry_rows += len(batch)
+
+    def _write(self, batch: List[Dict[str, Any]], attempts: int = 0) -> bool:
+        try:
+            self.db_manager.store_user_data_batch(batch)
+        except Exception as e:
+            self.failures += 1
+            attempts += 1
+            if attempts < self.max_retries:
+                print(f"Probe flush of {len(batch)} rows failed (attempt {attempts}): {e}")
+                self._retry(batch, attempts=attempts)
+            elif len(batch) > 1:
+                # Retried enough: bisect to isolate the rows the database rejects
+                middle = len(batch) // 2
+                self._retry(batch[:middle], batch[middle:], attempts=attempts)
+            else:
+                print(f"Dropping probe after {attempts} failed writes: {e}")
+                with self._cond:
+                    self.dead_letters.append(batch[0])
+                    self.dead_lettered += 1
+            return False
+        self.written += len(batch)
+        self.flushes += 1
+        return True
+
+    def _backoff(self, attempts: int) -> float:
+        """Seconds to wait after attempt number ``attempts`` (from 0) of a batch failed."""
+        if attempts + 1 >= self.max_retries:
+            # The batch is being split, not retried whole
+            return 0.0
+        return self.flush_interval * 2 ** attempts
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._retries or len(self._queue) >= self.batch_size:
+                        break
+                    if self._oldest is not None:
+                        wait = self._oldest + self.flush_interval - time.monotonic()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self._cond.wait(wait)
+                if self._closed:
+                    return
+                batch, attempts = self._take_batch()
+            if not self._write(batch, attempts):
+                # Back off so a database outage does not turn into a busy loop
+                time.sleep(self._backoff(attempts))
+
+    def close(self, timeout: float = 30.0) -> int:
+        """
+        Stop accepting probes, stop the background thread and write out
+        everything still queued.
+
+        Returns the number of rows that could not be written before
+        ``timeout`` seconds passed.
+        """
+        with self._cond:
+            if self._closed:
+                return len(self)
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._cond:
+                if not self._queue and not self._retries:
+                    break
+                batch, attempts = self._take_batch()
+            if not self._write(batch, attempts):
+                time.sleep(min(self._backoff(attempts), max(0.0, deadline - time.monotonic())))
+        if len(self):
+            print(f"Dropping {len(self)} unwritten probes")
+        return len(self)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'queued': len(self._queue),
+                'retrying': self._retry_rows,
+                'max_queue': self.max_queue,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'written': self.written,
+                'flushes': self.flushes,
+                'failures': self.failures,
+                'dead_lettered': self.dead_lettered,
+            }
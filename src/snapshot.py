@@ -0,0 +1,241 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from columnar import DTYPES, OSMColumns, concat_columns
+from parser import DEFAULT_BATCH_SIZE, iter_osm_xml_columnar
+
+MAGIC = b'OSMSNAP\0'
+FORMAT_VERSION = 1
+
+# magic, format version, header length
+_PREAMBLE = struct.Struct('<8sII')
+# Arrays start on cache-line boundaries so every view is aligned
+ALIGNMENT = 64
+
+SNAPSHOT_SUFFIX = '.snapshot'
+
+
+def snapshot_path_for(source: str) -> str:
+    """Default snapshot location: next to the source file."""
+    return source + SNAPSHOT_SUFFIX
+
+
+def source_fingerprint(path: str) -> Dict[str, Any]:
+    """Size, modification time and SHA-256 of ``path``."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    stat = os.stat(path)
+    return {
+        'path': os.path.abspath(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': digest.hexdigest(),
+    }
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _encode_strings(values: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Dictionary-encode an object column of str/None.
+
+    Tags like highway_type and maxspeed repeat heavily, so each distinct
+    string is stored once as UTF-8 and rows hold an int32 code (-1 for None).
+    """
+    table = {}
+    codes = np.fromiter(
+        (-1 if value is None else table.setdefault(value, len(table)) for value in values),
+        dtype=np.int32, count=len(values),
+    )
+    encoded = [value.encode('utf-8') for value in table]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return {
+        'codes': codes,
+        'offsets': offsets,
+        'data': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+    }
+
+
+def _decode_strings(codes: np.ndarray, offsets: np.ndarray, data: np.ndarray) -> np.ndarray:
+    blob = data.tobytes()
+    bounds = offsets.tolist()
+    # The trailing None is what code -1 selects
+    table = np.empty(len(bounds), dtype=object)
+    table[:-1] = [blob[start:end].decode('utf-8') for start, end in zip(bounds, bounds[1:])]
+    table[-1] = None
+    return table[codes]
+
+
+def write_snapshot(
+    path: str,
+    batch: OSMColumns,
+    source: Optional[Dict[str, Any]] = None,
+    revision: Optional[int] = None,
+) -> None:
+    """
+    Write ``batch`` to ``path`` in the snapshot format.
+
+    Numeric arrays are stored raw (little-endian) so ``open_snapshot`` can
+    map them without copying; str columns are dictionary-encoded. ``source``
+    (see ``source_fingerprint``) is kept in the header for ``is_current``,
+    and ``revision`` is the database network revision the batch matches,
+    if it was stored (None for a snapshot of a file only).
+    The file is written beside ``path`` and renamed into place, so readers
+    never see a partial snapshot and processes mapping the old one keep it.
+    """
+    arrays = {}
+    for name, dtype in DTYPES.items():
+        values = getattr(batch, name)
+        if dtype == object:
+            for part, array in _encode_strings(values).items():
+                arrays[f"{name}.{part}"] = array
+        else:
+            arrays[name] = np.ascontiguousarray(values, dtype=dtype.newbyteorder('<'))
+
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'length': len(array), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({
+        'created_at': datetime.utcnow().isoformat(),
+        'source': source,
+        'revision': revision,
+        'arrays': layout,
+    }).encode('utf-8')
+    # Array offsets are relative to the aligned end of the header
+    data_start = _align(_PREAMBLE.size + len(header))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+class NetworkSnapshot:
+    """
+    A snapshot file mapped read-only into memory.
+
+    ``columns`` is an ``OSMColumns`` whose numeric arrays are read-only
+    views of the mapping: nothing is copied on open, and every process
+    that opens the same file shares its pages through the OS page cache.
+    Only the str tag columns are decoded into Python objects.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _PREAMBLE.size:
+                raise ValueError(f"{path} is not a network snapshot")
+            # The mapping stays valid after the file is closed or replaced
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, header_length = _PREAMBLE.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a network snapshot")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"{path} has snapshot format {version}, expected {FORMAT_VERSION}")
+        header = json.loads(bytes(self._mmap[_PREAMBLE.size:_PREAMBLE.size + header_length]))
+        self.version = version
+        self.created_at = header['created_at']
+        self.source = header['source']
+        self.revision = header.get('revision')
+
+        data_start = _align(_PREAMBLE.size + header_length)
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            offset = data_start + spec['offset']
+            if offset + spec['length'] * dtype.itemsize > size:
+                raise ValueError(f"{path} is truncated")
+            arrays[name] = np.frombuffer(self._mmap, dtype=dtype, count=spec['length'], offset=offset)
+
+        columns = {}
+        for name, dtype in DTYPES.items():
+            if dtype == object:
+                columns[name] = _decode_strings(
+                    arrays[f"{name}.codes"], arrays[f"{name}.offsets"], arrays[f"{name}.data"]
+                )
+            else:
+                columns[name] = arrays[name]
+        self.columns = OSMColumns(**columns)
+
+    def is_current(self, source: str) -> bool:
+        """
+        True if ``source`` is the file this snapshot was built from, unchanged.
+
+        A matching size and modification time is trusted without reading the
+        file; otherwise its SHA-256 decides, so a file that was only touched
+        or copied still matches.
+        """
+        if not self.source or not os.path.exists(source):
+            return False
+        stat = os.stat(source)
+        if stat.st_size != self.source['size']:
+            return False
+        if stat.st_mtime_ns == self.source['mtime_ns']:
+            return True
+        return source_fingerprint(source)['sha256'] == self.source['sha256']
+
+
+def open_snapshot(path: str) -> NetworkSnapshot:
+    """Map a snapshot written by ``write_snapshot``. Raises ValueError for a bad file."""
+    return NetworkSnapshot(path)
+
+
+def current_snapshot(source: str, snapshot_path: Optional[str] = None) -> Optional[NetworkSnapshot]:
+    """The snapshot of ``source`` if it exists and ``source`` has not changed since, else None."""
+    snapshot_path = snapshot_path or snapshot_path_for(source)
+    if not os.path.exists(snapshot_path):
+        return None
+    try:
+        snapshot = open_snapshot(snapshot_path)
+    except ValueError as e:
+        print(f"Ignoring snapshot: {e}")
+        return None
+    if not snapshot.is_current(source):
+        print(f"Ignoring snapshot {snapshot_path}: {source} has changed")
+        return None
+    return snapshot
+
+
+def load_network(
+    source: str,
+    snapshot_path: Optional[str] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> Tuple[OSMColumns, bool]:
+    """
+    Parse an OSM XML file into one ``OSMColumns`` batch, through its snapshot.
+
+    If the snapshot (``<source>.snapshot`` by default) is current, it is
+    mapped instead of parsing. Otherwise the file is parsed and a new
+    snapshot written. Returns (columns, True if read from the snapshot).
+    """
+    snapshot_path = snapshot_path or snapshot_path_for(source)
+    snapshot = current_snapshot(source, snapshot_path)
+    if snapshot is not None:
+        return snapshot.columns, True
+
+    fingerprint = source_fingerprint(source)
+    columns = concat_columns(iter_osm_xml_columnar(source, batch_size))
+    write_snapshot(snapshot_path, columns, fingerprint)
+    return columns, False
+
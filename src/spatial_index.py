@@ -0,0 +1,313 @@
+import threading
+from collections import namedtuple
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from columnar import OSMColumns
+from database import DatabaseManager
+from snapshot import open_snapshot
+
+# Same fields as the row returned by DatabaseManager.get_nearest_way
+NearestWay = namedtuple(
+    'NearestWay',
+    ['way_id', 'lanes', 'lanes_forward', 'lanes_backward',
+     'highway_type', 'name', 'maxspeed', 'distance'],
+)
+
+# Same fields as the rows returned by DatabaseManager.get_nearby_segments
+NearbySegment = namedtuple(
+    'NearbySegment',
+    ['way_id', 'lanes', 'lanes_forward', 'lanes_backward', 'highway_type', 'name', 'maxspeed',
+     'lat1', 'lon1', 'lat2', 'lon2', 'distance'],
+)
+
+# Grid cell edge length in degrees (~1 km)
+DEFAULT_CELL_SIZE = 0.01
+
+
+class _GridState:
+    """Immutable snapshot of the loaded network and its grid."""
+
+    def __init__(self, ways, segments, cell_size: float, revision: int):
+        ways = [tuple(way) for way in ways]
+        way_positions = {way[0]: i for i, way in enumerate(ways)}
+        segments = [seg for seg in segments if seg[0] in way_positions]
+        self._build(
+            ways,
+            np.array([way_positions[seg[0]] for seg in segments], dtype=np.int32),
+            np.array([seg[1] for seg in segments], dtype=np.float64),
+            np.array([seg[2] for seg in segments], dtype=np.float64),
+            np.array([seg[3] for seg in segments], dtype=np.float64),
+            np.array([seg[4] for seg in segments], dtype=np.float64),
+            cell_size,
+            revision,
+        )
+
+    @classmethod
+    def from_columns(cls, batch: OSMColumns, cell_size: float, revision: int) -> '_GridState':
+        """Build the grid straight from a columnar batch's CSR way nodes."""
+        state = cls.__new__(cls)
+        way_index, lat1, lon1, lat2, lon2 = batch.segments()
+        state._build(
+            batch.way_rows(), way_index.astype(np.int32), lat1, lon1, lat2, lon2, cell_size, revision
+        )
+        return state
+
+    def _build(self, ways, way_index, y1, x1, y2, x2, cell_size: float, revision: int) -> None:
+        self.revision = revision
+        self.cell_size = cell_size
+        self.ways = ways
+        self.way_index = way_index
+        # Coordinates are stored as x=lon, y=lat to match PostGIS
+        self.y1 = y1
+        self.x1 = x1
+        self.y2 = y2
+        self.x2 = x2
+
+        if not len(way_index):
+            self.cell_keys = np.empty(0, dtype=np.int64)
+            self.cell_entries = np.empty(0, dtype=np.int64)
+            self.origin_x = self.origin_y = 0.0
+            self.nx = self.ny = 0
+            return
+
+        min_x = np.minimum(self.x1, self.x2)
+        max_x = np.maximum(self.x1, self.x2)
+        min_y = np.minimum(self.y1, self.y2)
+        max_y = np.maximum(self.y1, self.y2)
+        self.origin_x = float(min_x.min())
+        self.origin_y = float(min_y.min())
+
+        ix0 = np.floor((min_x - self.origin_x) / cell_size).astype(np.int64)
+        ix1 = np.floor((max_x - self.origin_x) / cell_size).astype(np.int64)
+        iy0 = np.floor((min_y - self.origin_y) / cell_size).astype(np.int64)
+        iy1 = np.floor((max_y - self.origin_y) / cell_size).astype(np.int64)
+        self.nx = int(ix1.max()) + 1
+        self.ny = int(iy1.max()) + 1
+
+        # Register every segment in each cell overlapped by its bounding box
+        spans_y = iy1 - iy0 + 1
+        counts = (ix1 - ix0 + 1) * spans_y
+        entries = np.repeat(np.arange(len(way_index), dtype=np.int64), counts)
+        starts = np.repeat(np.cumsum(counts) - counts, counts)
+        local = np.arange(len(entries), dtype=np.int64) - starts
+        cell_x = np.repeat(ix0, counts) + local // np.repeat(spans_y, counts)
+        cell_y = np.repeat(iy0, counts) + local % np.repeat(spans_y, counts)
+        keys = cell_x * self.ny + cell_y
+
+        order = np.argsort(keys, kind='stable')
+        self.cell_keys = keys[order]
+        self.cell_entries = entries[order]
+
+    def candidates(self, lat: float, lon: float, max_distance: float) -> np.ndarray:
+        """Return indices of segments in grid cells within ``max_distance``."""
+        if not len(self.cell_keys):
+            return self.cell_entries
+        size = self.cell_size
+        ix0 = max(int(np.floor((lon - max_distance - self.origin_x) / size)), 0)
+        ix1 = min(int(np.floor((lon + max_distance - self.origin_x) / size)), self.nx - 1)
+        iy0 = max(int(np.floor((lat - max_distance - self.origin_y) / size)), 0)
+        iy1 = min(int(np.floor((lat + max_distance - self.origin_y) / size)), self.ny - 1)
+        if ix0 > ix1 or iy0 > iy1:
+            return self.cell_entries[:0]
+
+        # Cells of one grid column have consecutive keys, so each column is one slice
+        columns = np.arange(ix0, ix1 + 1, dtype=np.int64) * self.ny
+        lo = np.searchsorted(self.cell_keys, columns + iy0, side='left')
+        hi = np.searchsorted(self.cell_keys, columns + iy1, side='right')
+        slices = [self.cell_entries[a:b] for a, b in zip(lo, hi) if b > a]
+        if not slices:
+            return self.cell_entries[:0]
+        return np.concatenate(slices)
+
+    def project(
+        self, lat: float, lon: float, candidates: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Project the point onto each candidate segment.
+
+        Returns the planar distances in degrees and the x (lon) and y (lat)
+        coordinates of the projected points.
+        """
+        x1 = self.x1[candidates]
+        y1 = self.y1[candidates]
+        dx = self.x2[candidates] - x1
+        dy = self.y2[candidates] - y1
+        length_sq = dx * dx + dy * dy
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = ((lon - x1) * dx + (lat - y1) * dy) / length_sq
+        # Zero-length segments (single-node ways) project onto their start
+        t = np.clip(np.nan_to_num(t, nan=0.0, posinf=0.0, neginf=0.0), 0.0, 1.0)
+        px = x1 + t * dx
+        py = y1 + t * dy
+        return np.hypot(px - lon, py - lat), px, py
+
+    def distances(self, lat: float, lon: float, candidates: np.ndarray) -> np.ndarray:
+        """Planar distance in degrees from the point to each candidate segment.
+
+        Matches PostGIS ``<->``/``ST_Distance`` on SRID 4326 geometries.
+        """
+        return self.project(lat, lon, candidates)[0]
+
+
+class SpatialIndex:
+    """
+    In-memory nearest-way lookup over a uniform grid of road segments.
+
+    Drop-in replacement for the lookup methods of ``DatabaseManager``: the
+    road network is loaded once into NumPy arrays and queries are answered
+    without a database round trip. The index is reloaded whenever the
+    network revision in the database changes.
+    """
+
+    def __init__(self, db_manager: DatabaseManager, cell_size: float = DEFAULT_CELL_SIZE):
+        self.db_manager = db_manager
+        self.cell_size = cell_size
+        self._state = _GridState([], [], cell_size, revision=-1)
+        self._refresh_lock = threading.Lock()
+        self._refresh_thread = None
+        self._stop = threading.Event()
+
+    @property
+    def revision(self) -> int:
+        return self._state.revision
+
+    @property
+    def grid(self) -> _GridState:
+        """The current network snapshot. It is replaced, never mutated, on reload."""
+        return self._state
+
+    @property
+    def segment_count(self) -> int:
+        return len(self._state.way_index)
+
+    def load(self) -> None:
+        """Load the full road network from the database."""
+        with self._refresh_lock:
+            revision = self.db_manager.get_network_revision()
+            ways, segments = self.db_manager.get_road_network()
+            # Swapping a single reference keeps concurrent readers consistent
+            self._state = _GridState(ways, segments, self.cell_size, revision)
+
+    def load_columns(self, batch: OSMColumns, revision: int = 0) -> None:
+        """
+        Index a parsed ``OSMColumns`` batch instead of the database network.
+
+        The batch must hold the nodes of its ways (see ``concat_columns``).
+        ``revision`` is reported like a database revision; auto refresh
+        would replace this network with the database's.
+        """
+        with self._refresh_lock:
+            self._state = _GridState.from_columns(batch, self.cell_size, revision)
+
+    def load_snapshot(self, path: str) -> None:
+        """
+        Index a network snapshot (see ``snapshot.write_snapshot``).
+
+        The snapshot's arrays are mapped, not parsed or queried, so worker
+        processes start quickly and share one copy of the raw network. It is
+        only used if it was written at the database's current network
+        revision; otherwise the network is loaded from the database.
+        """
+        snapshot = open_snapshot(path)
+        revision = self.db_manager.get_network_revision()
+        if snapshot.revision is None or snapshot.revision != revision:
+            print(f"Snapshot {path} is at revision {snapshot.revision}, database at {revision}; "
+                  "loading from the database")
+            self.load()
+            return
+        self.load_columns(snapshot.columns, revision)
+
+    def refresh(self) -> bool:
+        """Reload the network if its revision changed. Returns True if reloaded."""
+        if self.db_manager.get_network_revision() == self._state.revision:
+            return False
+        self.load()
+        return True
+
+    def start_auto_refresh(self, interval: float = 30.0) -> None:
+        """Poll the network revision every ``interval`` seconds in the background."""
+        if self._refresh_thread is not None:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Spatial index refresh failed: {e}")
+
+        self._refresh_thread = threading.Thread(
+            target=run, name='spatial-index-refresh', daemon=True
+        )
+        self._refresh_thread.start()
+
+    def stop_auto_refresh(self) -> None:
+        self._stop.set()
+        if self._refresh_thread is not None:
+            self._refresh_thread.join()
+            self._refresh_thread = None
+
+    def get_nearest_way(self, lat: float, lon: float, max_distance: float = 0.001) -> Optional[NearestWay]:
+        state = self._state
+        candidates = state.candidates(lat, lon, max_distance)
+        if not len(candidates):
+            return None
+
+        distances = state.distances(lat, lon, candidates)
+        best = int(np.argmin(distances))
+        distance = float(distances[best])
+        if distance > max_distance:
+            return None
+
+        way = state.ways[state.way_index[candidates[best]]]
+        return NearestWay(*way, distance)
+
+    def get_lanes_at_coordinate(
+        self, lat: float, lon: float, max_distance: float = 0.001
+    ) -> Tuple[Optional[int], Optional[int], Optional[int], Optional[float]]:
+        """Same contract as ``DatabaseManager.get_lanes_at_coordinate``."""
+        result = self.get_nearest_way(lat, lon, max_distance)
+
+        if result is None:
+            return None, None, None, None
+
+        return (
+            result.lanes,
+            result.lanes_forward,
+            result.lanes_backward,
+            result.distance,
+        )
+
+    def get_nearest_ways(
+        self,
+        points: Sequence[Tuple[float, float]],
+        max_distance: Union[float, Sequence[float]] = 0.001,
+    ) -> List[Optional[NearestWay]]:
+        """Same contract as ``DatabaseManager.get_nearest_ways``."""
+        if isinstance(max_distance, (int, float)):
+            max_distances = [float(max_distance)] * len(points)
+        else:
+            max_distances = [float(d) for d in max_distance]
+            if len(max_distances) != len(points):
+                raise ValueError("max_distance must have one value per point")
+        return [
+            self.get_nearest_way(lat, lon, distance)
+            for (lat, lon), distance in zip(points, max_distances)
+        ]
+
+    def get_lanes_at_coordinates(
+        self,
+        points: Sequence[Tuple[float, float]],
+        max_distance: Union[float, Sequence[float]] = 0.001,
+    ) -> List[Tuple[Optional[int], Optional[int], Optional[int], Optional[float]]]:
+        """Same contract as ``DatabaseManager.get_lanes_at_coordinates``."""
+        return [
+            (None, None, None, None) if result is None else (
+                result.lanes,
+                result.lanes_forward,
+                result.lanes_backward,
+                result.distance,
+            )
+            for result in self.get_nearest_ways(points, max_distance)
+        ]
@@ -1,10 +1,33 @@
+import os
 import random
-from typing import Dict, List
+from typing import Dict, Hashable, List, Sequence
 
 import numpy as np
-from sklearn.linear_model import LinearRegression
 import requests
 
+# PeMS endpoint for one station; override to point at a mirror or a local fake server
+PEMS_URL = os.getenv('PEMS_URL', 'https://pems.dot.ca.gov/?station_id={station_id}&d=1')
+
+
+def fetch_pems_lanes(station_id: int, timeout: float = 5.0) -> Dict[int, float]:
+    """Fetch the current speed of each lane from PeMS.
+
+    Raises on network errors and on responses without lane data.
+    """
+    resp = requests.get(PEMS_URL.format(station_id=station_id), timeout=timeout)
+    resp.raise_for_status()
+    data = resp.json()
+    # Expect data format: {'lanes': {'1': speed1, '2': speed2, ...}}
+    lanes = {int(k): float(v) for k, v in data.get('lanes', {}).items()}
+    if not lanes:
+        raise ValueError(f"No lane data for station {station_id}")
+    return lanes
+
+
+def synthetic_speeds() -> Dict[int, List[float]]:
+    """Random speeds for three lanes, used when PeMS is unreachable."""
+    return {i: [float(random.randint(40, 65))] for i in range(1, 4)}
+
 
 def fetch_pems_speed(station_id: int) -> Dict[int, List[float]]:
     """Fetch current speed data for each lane from PeMS.
@@ -13,42 +36,75 @@ def fetch_pems_speed(station_id: int) -> Dict[int, List[float]]:
     retrieve data from the public endpoint and falls back to synthetic data
     if the request fails (e.g., due to lack of network access).
     """
-    url = f"https://pems.dot.ca.gov/?station_id={station_id}&d=1"
     try:
-        resp = requests.get(url, timeout=5)
-        resp.raise_for_status()
-        data = resp.json()
-        # Expect data format: {'lanes': {'1': speed1, '2': speed2, ...}}
-        lanes = {int(k): [float(v)] for k, v in data.get('lanes', {}).items()}
-        if lanes:
-            return lanes
+        return {lane: [speed] for lane, speed in fetch_pems_lanes(station_id).items()}
     except Exception:
         pass
 
     # Fallback: generate random speeds for three lanes
-    return {i: [float(random.randint(40, 65))] for i in range(1, 4)}
+    return synthetic_speeds()
+
+
+def predict_speed_series(
+    series: Sequence[Sequence[float]], horizon: int = 30, sample_interval: float = 1.0
+) -> np.ndarray:
+    """
+    Extrapolate many speed series at once with ordinary least squares.
+
+    Every series is fit against its sample index (0, 1, ...), with samples
+    ``sample_interval`` seconds apart, and predicted for each of the
+    ``horizon`` seconds after its last sample. All series are padded into one
+    2-D array and solved with the closed-form slope/intercept formulas, so
+    the cost is a handful of NumPy reductions regardless of how many lanes
+    are predicted. Empty series predict 0, single samples are held
+    constant, and predictions are clipped at 0.
+
+    Returns:
+        np.ndarray: Array of shape (len(series), horizon)
+    """
+    counts = np.array([len(s) for s in series], dtype=np.float64)
+    if not len(counts):
+        return np.empty((0, horizon))
+
+    width = max(int(counts.max()), 1)
+    y = np.zeros((len(series), width))
+    for row, values in enumerate(series):
+        y[row, :len(values)] = values
+    x = np.arange(width, dtype=np.float64)
+    mask = x[None, :] < counts[:, None]
+
+    sum_x = (mask * x).sum(axis=1)
+    sum_xx = (mask * x * x).sum(axis=1)
+    sum_y = y.sum(axis=1)
+    sum_xy = (y * x).sum(axis=1)
+    denominator = counts * sum_xx - sum_x * sum_x
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = np.where(denominator > 0, (counts * sum_xy - sum_x * sum_y) / denominator, 0.0)
+        intercept = np.where(counts > 0, (sum_y - slope * sum_x) / counts, 0.0)
+
+    # Seconds ahead, converted to fractional sample steps
+    future = counts[:, None] - 1 + np.arange(1, horizon + 1)[None, :] / sample_interval
+    return np.maximum(intercept[:, None] + slope[:, None] * future, 0.0)
+
+
+def predict_station_speeds(
+    stations: Dict[Hashable, Dict[int, List[float]]],
+    horizon: int = 30,
+    sample_interval: float = 1.0,
+) -> Dict[Hashable, Dict[int, List[float]]]:
+    """Predict every lane of every station in a single batched fit."""
+    keys = [(station, lane) for station, lanes in stations.items() for lane in lanes]
+    predictions = predict_speed_series(
+        [stations[s][lane] for s, lane in keys], horizon, sample_interval
+    )
+    result = {station: {} for station in stations}
+    for (station, lane), values in zip(keys, predictions.tolist()):
+        result[station][lane] = values
+    return result
 
 
 def predict_next_speeds(
-    speeds_per_lane: Dict[int, List[float]], horizon: int = 30
+    speeds_per_lane: Dict[int, List[float]], horizon: int = 30, sample_interval: float = 1.0
 ) -> Dict[int, List[float]]:
     """Predict speeds for each lane for the next `horizon` seconds."""
-    predictions: Dict[int, List[float]] = {}
-    for lane, speeds in speeds_per_lane.items():
-        if not speeds:
-            predictions[lane] = [0.0] * horizon
-            continue
-
-        if len(speeds) < 2:
-            predictions[lane] = [float(speeds[-1])] * horizon
-            continue
-
-        x = np.arange(len(speeds)).reshape(-1, 1)
-        y = np.array(speeds)
-        model = LinearRegression()
-        model.fit(x, y)
-        last_t = len(speeds) - 1
-        future_x = np.arange(last_t + 1, last_t + horizon + 1).reshape(-1, 1)
-        preds = model.predict(future_x)
-        predictions[lane] = [max(0.0, float(p)) for p in preds]
-    return predictions
+    return predict_station_speeds({None: speeds_per_lane}, horizon, sample_interval)[None]
@@ -0,0 +1,113 @@
+import argparse
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Histogram bins of SPEED_BIN_WIDTH speed units; the last bin is open-ended
+SPEED_BIN_WIDTH = 5.0
+SPEED_BINS = 32
+
+# Rollups are kept per hour of the week (0 = Monday 00:00 UTC) and for all time
+HOURS_PER_WEEK = 7 * 24
+ALL_TIME_BUCKET = -1
+
+# Below this many samples an hourly rollup falls back to the all-time one
+MIN_BUCKET_SAMPLES = 5
+
+RollupKey = Tuple[str, int, int]
+
+
+def time_bucket(timestamp: datetime) -> int:
+    """Hour-of-week bucket of a timestamp. Matches the SQL used by the backfill."""
+    return timestamp.weekday() * 24 + timestamp.hour
+
+
+def speed_bin(speed: float) -> int:
+    return min(max(int(speed // SPEED_BIN_WIDTH), 0), SPEED_BINS - 1)
+
+
+def aggregate(rows: Iterable[Dict[str, Any]]) -> Dict[RollupKey, List[Any]]:
+    """
+    Summarize probe rows into partial rollups.
+
+    Returns {(segment_id, lane_index, bucket): [count, mean, m2, histogram]}
+    with Welford's running mean and sum of squared deviations (m2). Every
+    probe counts towards its hour-of-week bucket and the all-time bucket.
+    Rows without a segment, lane, speed or timestamp are skipped.
+    """
+    partials = {}
+    for row in rows:
+        segment_id = row.get('segment_id')
+        lane_index = row.get('lane_index')
+        speed = row.get('speed')
+        timestamp = row.get('timestamp')
+        if segment_id is None or lane_index is None or speed is None or timestamp is None:
+            continue
+        speed = float(speed)
+        for bucket in (time_bucket(timestamp), ALL_TIME_BUCKET):
+            partial = partials.get((segment_id, lane_index, bucket))
+            if partial is None:
+                partial = partials[(segment_id, lane_index, bucket)] = [0, 0.0, 0.0, [0] * SPEED_BINS]
+            partial[0] += 1
+            delta = speed - partial[1]
+            partial[1] += delta / partial[0]
+            partial[2] += delta * (speed - partial[1])
+            partial[3][speed_bin(speed)] += 1
+    return partials
+
+
+def percentile(histogram: Sequence[int], q: float) -> Optional[float]:
+    """Estimate the ``q`` quantile (0..1) from a histogram, interpolating within the bin."""
+    total = sum(histogram)
+    if not total:
+        return None
+    target = q * total
+    seen = 0
+    for index, count in enumerate(histogram):
+        if count and seen + count >= target:
+            fraction = (target - seen) / count
+            return (index + fraction) * SPEED_BIN_WIDTH
+        seen += count
+    return len(histogram) * SPEED_BIN_WIDTH
+
+
+def summarize(rollup: Optional[Tuple[int, float, float, Sequence[int]]]) -> Optional[Dict[str, Any]]:
+    """Turn a stored (count, mean, m2, histogram) rollup into reported statistics."""
+    if rollup is None or not rollup[0]:
+        return None
+    count, mean, m2, histogram = rollup
+    return {
+        'samples': count,
+        'mean': mean,
+        'stddev': (m2 / count) ** 0.5 if count > 1 else 0.0,
+        'p15': percentile(histogram, 0.15),
+        'p50': percentile(histogram, 0.50),
+        'p85': percentile(histogram, 0.85),
+    }
+
+
+def pick_rollup(
+    rollups: Dict[RollupKey, Tuple[int, float, float, Sequence[int]]],
+    segment_id: str,
+    lane_index: int,
+    bucket: int,
+) -> Optional[Dict[str, Any]]:
+    """Summary for the hourly bucket, or the all-time one if the hour has too few samples."""
+    hourly = rollups.get((segment_id, lane_index, bucket))
+    if hourly is not None and hourly[0] >= MIN_BUCKET_SAMPLES:
+        return summarize(hourly)
+    return summarize(rollups.get((segment_id, lane_index, ALL_TIME_BUCKET)))
+
+
+def main():
+    from database import DatabaseManager
+
+    parser = argparse.ArgumentParser(description="Rebuild speed rollups from stored user_data")
+    parser.parse_args()
+    db = DatabaseManager()
+    db.init_db()
+    rows = db.rebuild_speed_rollups()
+    print(f"Rebuilt {rows} speed rollups")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+from io import StringIO
+from typing import List, Optional, TextIO, Tuple
+
+# (south, west, north, east) of the generated network: the San Jose area
+DEFAULT_BBOX = (37.2, -122.1, 37.5, -121.7)
+
+# highway type, lanes, maxspeed, relative frequency
+ROAD_CLASSES = [
+    ('motorway', 4, '65 mph', 1),
+    ('motorway_link', 1, '45 mph', 2),
+    ('trunk', 3, '55 mph', 2),
+    ('primary', 2, '45 mph', 4),
+    ('secondary', 2, '35 mph', 6),
+    ('residential', 1, '25 mph', 10),
+]
+
+TIMESTAMP = '2024-01-01T00:00:00Z'
+
+
+def _road_class(rng: random.Random) -> Tuple[str, int, str, int]:
+    return rng.choices(ROAD_CLASSES, weights=[c[3] for c in ROAD_CLASSES])[0]
+
+
+def generate_osm_xml(
+    out: TextIO,
+    nodes: int,
+    seed: int = 42,
+    bbox: Tuple[float, float, float, float] = DEFAULT_BBOX,
+    junction_rate: float = 0.05,
+) -> Tuple[int, int]:
+    """
+    Write a synthetic road network as OSM XML.
+
+    Ways are random walks of 10 to 200 nodes with highway, lanes, name and
+    maxspeed tags. About ``junction_rate`` of the ways start on a node of an
+    earlier way so the network has junctions. The same seed always produces
+    the same document. Node elements are written as they are generated and
+    ways are spooled to a temporary file, so memory use stays flat up to
+    tens of millions of nodes.
+
+    Returns:
+        (node count, way count)
+    """
+    rng = random.Random(seed)
+    south, west, north, east = bbox
+    step = min(north - south, east - west) / 2000.0
+    # Bounded reservoir of earlier node positions that later ways can branch from
+    anchors: List[Tuple[int, float, float]] = []
+
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.write('<osm version="0.6" generator="synthetic_osm">\n')
+    out.write(f' <bounds minlat="{south}" minlon="{west}" maxlat="{north}" maxlon="{east}"/>\n')
+
+    node_id = 0
+    way_id = 0
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as ways_file:
+        while node_id < nodes:
+            length = rng.randint(10, 200)
+            refs = []
+            if anchors and rng.random() < junction_rate:
+                start_id, lat, lon = rng.choice(anchors)
+                refs.append(start_id)
+            else:
+                lat = rng.uniform(south, north)
+                lon = rng.uniform(west, east)
+            heading_lat, heading_lon = rng.uniform(-1, 1), rng.uniform(-1, 1)
+
+            while len(refs) < length and node_id < nodes:
+                # Gentle curvature: the heading drifts a little every step
+                heading_lat += rng.uniform(-0.2, 0.2)
+                heading_lon += rng.uniform(-0.2, 0.2)
+                lat = min(max(lat + heading_lat * step, south), north)
+                lon = min(max(lon + heading_lon * step, west), east)
+                node_id += 1
+                out.write(
+                    f' <node id="{node_id}" version="1" timestamp="{TIMESTAMP}" '
+                    f'lat="{lat:.7f}" lon="{lon:.7f}"/>\n'
+                )
+                refs.append(node_id)
+                if len(anchors) < 10000:
+                    anchors.append((node_id, lat, lon))
+                elif rng.random() < 0.01:
+                    anchors[rng.randrange(len(anchors))] = (node_id, lat, lon)
+
+            if len(refs) < 2:
+                continue
+            way_id += 1
+            highway, lanes, maxspeed, _ = _road_class(rng)
+            ways_file.write(f' <way id="{way_id}" version="1" timestamp="{TIMESTAMP}">\n')
+            ways_file.writelines(f'  <nd ref="{ref}"/>\n' for ref in refs)
+            ways_file.write(f'  <tag k="highway" v="{highway}"/>\n')
+            ways_file.write(f'  <tag k="lanes" v="{lanes}"/>\n')
+            ways_file.write(f'  <tag k="name" v="Synthetic {highway.title()} {way_id}"/>\n')
+            ways_file.write(f'  <tag k="maxspeed" v="{maxspeed}"/>\n')
+            ways_file.write(' </way>\n')
+
+        ways_file.seek(0)
+        shutil.copyfileobj(ways_file, out)
+    out.write('</osm>\n')
+    return node_id, way_id
+
+
+def generate_osm_file(path: str, nodes: int, seed: int = 42, **kwargs) -> Tuple[int, int]:
+    """Write a synthetic network to ``path``. See ``generate_osm_xml``."""
+    with open(path, 'w', encoding='utf-8') as out:
+        return generate_osm_xml(out, nodes, seed, **kwargs)
+
+
+def generate_osm_string(nodes: int, seed: int = 42, **kwargs) -> str:
+    """Return a synthetic network as a string, for small benchmarks."""
+    out = StringIO()
+    generate_osm_xml(out, nodes, seed, **kwargs)
+    return out.getvalue()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic OSM road network")
+    parser.add_argument('path', help="output .osm file")
+    parser.add_argument('--nodes', type=int, default=100000, help="number of nodes (default: 100000)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument(
+        '--bbox', type=lambda value: tuple(float(v) for v in value.split(',')),
+        default=DEFAULT_BBOX, help="south,west,north,east",
+    )
+    args = parser.parse_args(argv)
+    node_count, way_count = generate_osm_file(args.path, args.nodes, args.seed, bbox=args.bbox)
+    size_mb = os.path.getsize(args.path) / 1e6
+    print(f"Wrote {node_count} nodes and {way_count} ways to {args.path} ({size_mb:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,11 +12,49 @@ def test_lanes():
     r = requests.get(f'{BASE_URL}/api/lanes', params=params)
     print('GET /api/lanes:', r.status_code, r.json())
 
+def test_lanes_batch():
+    payload = {
+        'points': [
+            {'lat': 37.3981366, 'lon': -121.8752114},
+            {'lat': 37.3969108, 'lon': -121.8747250, 'errordist': 0.002},
+            {'lat': 37.3382, 'lon': -121.8863},
+        ]
+    }
+    r = requests.post(f'{BASE_URL}/api/lanes/batch', json=payload)
+    print('POST /api/lanes/batch:', r.status_code, r.json())
+
+def test_lanes_ahead():
+    params = {'lat': 37.3981366, 'lon': -121.8752114, 'heading': 0, 'distance_km': 5}
+    r = requests.get(f'{BASE_URL}/api/lanes/ahead', params=params)
+    data = r.json()
+    print('GET /api/lanes/ahead:', r.status_code, data.get('distance_m'),
+          [(w['way_id'], w['lanes_in_direction']) for w in data.get('ways', [])])
+
 def test_suggested_speed():
     params = {'lat': 37.3981366, 'lon': -121.8752114, 'lane': 2}
     r = requests.get(f'{BASE_URL}/api/suggested_speed', params=params)
     print('GET /api/suggested_speed:', r.status_code, r.json())
 
+def test_recommended_speeds():
+    r = requests.get(f'{BASE_URL}/api/recommended_speeds', params={'station_ids': '1234,1235'})
+    print('GET /api/recommended_speeds:', r.status_code, list(r.json().get('recommendations', {})))
+
+def test_metrics():
+    r = requests.get(f'{BASE_URL}/metrics')
+    lines = [line for line in r.text.splitlines() if line and not line.startswith('#')]
+    print('GET /metrics:', r.status_code, len(lines), 'samples')
+
+def test_topology():
+    way = requests.get(f'{BASE_URL}/api/lanes', params={'lat': 37.3981366, 'lon': -121.8752114}).json()
+    if not way.get('found'):
+        print('GET /api/topology/downstream: skipped, no way at the test coordinate')
+        return
+    params = {'way_id': way['way_id'], 'max_distance': 5000, 'limit': 10}
+    r = requests.get(f'{BASE_URL}/api/topology/downstream', params=params)
+    print('GET /api/topology/downstream:', r.status_code, [w['way_id'] for w in r.json().get('ways', [])])
+    r = requests.post(f'{BASE_URL}/api/topology/chains', json={'way_ids': [way['way_id']]})
+    print('POST /api/topology/chains:', r.status_code, r.json())
+
 def test_post_speed():
     payload = {
         "lat": 37.3981366,  # Use a known coordinate in the database
@@ -28,6 +66,20 @@ def test_post_speed():
     r = requests.post(f'{BASE_URL}/speed', json=payload)
     print('POST /speed:', r.status_code, r.json())
 
+def test_post_speed_batch():
+    probes = [
+        {
+            "lat": 37.3981366 + i * 0.0001,
+            "lon": -121.8752114,
+            "timestamp": "2025-06-24T18:12:00Z",
+            "speed": 44 + i,
+            "lane_index": 2
+        }
+        for i in range(5)
+    ]
+    r = requests.post(f'{BASE_URL}/speed/batch', json={'probes': probes})
+    print('POST /speed/batch:', r.status_code, r.json())
+
 def test_segments():
     r = requests.get(f'{BASE_URL}/segments')
     print('GET /segments:', r.status_code)
@@ -42,13 +94,47 @@ def test_segments():
     except Exception as e:
         print('  Error parsing segments response:', e)
 
+def test_segments_paging():
+    params = {'name': '', 'bbox': '-121.9,37.3,-121.8,37.5', 'limit': 5}
+    r = requests.get(f'{BASE_URL}/segments', params=params)
+    print('GET /segments (bbox, limit=5):', r.status_code, 'next after:', r.headers.get('X-Next-After'))
+    etag = r.headers.get('ETag')
+    if etag:
+        r = requests.get(f'{BASE_URL}/segments', params=params, headers={'If-None-Match': etag})
+        print('GET /segments (If-None-Match):', r.status_code)
+    params = {'name': '', 'zoom': 10, 'format': 'encoded', 'limit': 5}
+    r = requests.get(f'{BASE_URL}/segments', params=params)
+    print('GET /segments (zoom=10, encoded):', r.status_code,
+          r.headers.get('Content-Encoding'), len(r.content), 'bytes')
+
+def test_osm_change_delete():
+    """Ways modified or created and then deleted in one diff must not be stored."""
+    import os
+    from database import DatabaseManager
+    from parser import iter_osm_change
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'modify_delete.osc')
+    db = DatabaseManager()
+    stats = db.apply_osm_change(iter_osm_change(path))
+    ways, way_nodes = db.get_way_topology([9900000001, 9900000002])
+    print('apply_osm_change (modify+delete):', 'ok' if not ways and not way_nodes else 'FAILED',
+          stats['ways'], stats['deleted'])
+
 def main():
     print('--- Testing API Endpoints ---')
     test_health()
     test_lanes()
+    test_lanes_batch()
+    test_lanes_ahead()
     test_suggested_speed()
+    test_recommended_speeds()
     test_post_speed()
+    test_post_speed_batch()
     test_segments()
+    test_segments_paging()
+    test_metrics()
+    test_topology()
+    test_osm_change_delete()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,576 @@
+import heapq
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from columnar import MISSING, OSMColumns
+from database import DatabaseManager
+
+# Ways do not store the oneway tag; these highway types are one-way by OSM
+# convention unless backward lanes are tagged
+ONEWAY_HIGHWAY_TYPES = frozenset({'motorway', 'motorway_link'})
+
+EARTH_RADIUS_M = 6371008.8
+
+# A way reached by a traversal: how far along the road (meters) and at which node
+ReachedWay = namedtuple('ReachedWay', ['way_id', 'distance', 'node_id'])
+
+# One way of a look-ahead corridor: traveled in node order (forward) or not,
+# from ``start`` to ``end`` meters along the corridor, with the lanes in the
+# direction of travel (None if unknown) and the traveled [lat, lon] pairs
+CorridorWay = namedtuple('CorridorWay', ['way_id', 'forward', 'start', 'end', 'lanes', 'coords'])
+
+# (way row, node IDs, lats, lons) of one way
+WayRecord = Tuple[Tuple[Any, ...], np.ndarray, np.ndarray, np.ndarray]
+
+
+def haversine_m(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    """Great-circle distance in meters, elementwise."""
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def bearing(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Compass bearing in degrees from the first point to the second (short distances)."""
+    dx = (lon2 - lon1) * np.cos(np.radians((lat1 + lat2) / 2))
+    return float(np.degrees(np.arctan2(dx, lat2 - lat1)) % 360)
+
+
+def turn_angle(a: float, b: float) -> float:
+    """Absolute difference between two bearings, 0 to 180 degrees."""
+    return abs((b - a + 180) % 360 - 180)
+
+
+def project_onto_line(lats: np.ndarray, lons: np.ndarray, lat: float, lon: float) -> Tuple[int, float, float]:
+    """
+    Closest point to (lat, lon) on a polyline.
+
+    Returns (index of the segment's first point, lat, lon of the point).
+    Uses a local equirectangular projection, fine at road scale.
+    """
+    scale = np.cos(np.radians(lat))
+    ax, ay = lons[:-1] * scale, lats[:-1]
+    dx, dy = (lons[1:] - lons[:-1]) * scale, lats[1:] - lats[:-1]
+    squared = np.maximum(dx * dx + dy * dy, 1e-18)
+    t = np.clip(((lon * scale - ax) * dx + (lat - ay) * dy) / squared, 0.0, 1.0)
+    distance = (ax + t * dx - lon * scale) ** 2 + (ay + t * dy - lat) ** 2
+    i = int(np.argmin(distance))
+    return i, float(lats[i] + t[i] * (lats[i + 1] - lats[i])), float(lons[i] + t[i] * (lons[i + 1] - lons[i]))
+
+
+def is_oneway(highway_type: Optional[str], lanes_backward: Optional[int]) -> bool:
+    return highway_type in ONEWAY_HIGHWAY_TYPES and not lanes_backward
+
+
+def _direction_lanes(row: Tuple[Any, ...]) -> Tuple[int, int]:
+    """(forward, backward) lane counts of a way row, ``MISSING`` where unknown."""
+    _, lanes, lanes_forward, lanes_backward, highway_type = row[:5]
+    if is_oneway(highway_type, lanes_backward):
+        forward = lanes_forward if lanes_forward is not None else lanes
+        return (forward if forward is not None else MISSING), 0
+    return (
+        lanes_forward if lanes_forward is not None else MISSING,
+        lanes_backward if lanes_backward is not None else MISSING,
+    )
+
+
+def way_records(ways: Sequence[Any], way_nodes: Sequence[Any]) -> Dict[int, WayRecord]:
+    """Group ``DatabaseManager.get_way_topology`` rows by way."""
+    records = {}
+    if way_nodes:
+        columns = list(zip(*way_nodes))
+        owner = np.array(columns[0], dtype=np.int64)
+        node_ids = np.array(columns[1], dtype=np.int64)
+        lats = np.array(columns[2], dtype=np.float64)
+        lons = np.array(columns[3], dtype=np.float64)
+        starts = np.concatenate(([0], np.flatnonzero(owner[1:] != owner[:-1]) + 1, [len(owner)]))
+        nodes = {
+            int(owner[start]): (node_ids[start:end], lats[start:end], lons[start:end])
+            for start, end in zip(starts[:-1], starts[1:])
+        }
+    else:
+        nodes = {}
+    empty = (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0))
+    for way in ways:
+        way = tuple(way)
+        records[way[0]] = (way,) + nodes.get(way[0], empty)
+    return records
+
+
+def column_records(batch: OSMColumns) -> Dict[int, WayRecord]:
+    """Way records of a columnar batch; way nodes missing from the batch are dropped."""
+    positions = batch.node_positions(batch.way_node_ids)
+    offsets = batch.way_node_offsets.tolist()
+    records = {}
+    for i, way in enumerate(batch.way_rows()):
+        found = positions[offsets[i]:offsets[i + 1]]
+        found = found[found >= 0]
+        records[way[0]] = (way, batch.node_id[found], batch.lat[found], batch.lon[found])
+    return records
+
+
+class _Topology:
+    """
+    Immutable directed road graph in CSR layout.
+
+    Vertices are the OSM nodes used by ways (``node_ids``, sorted, located
+    at ``lat``/``lon``). Every pair of consecutive way nodes is an edge in
+    the way's direction of travel, and also reversed unless the way is
+    one-way. The outgoing edges of vertex ``v`` are ``indptr[v]:indptr[v + 1]``
+    of ``targets``, ``edge_way``, ``edge_forward`` (traveled in node order),
+    ``edge_length`` (meters) and ``edge_lanes`` (lanes in that direction,
+    ``MISSING`` if unknown). ``rev_indptr``/``rev_edges`` list the incoming
+    edges of each vertex for upstream traversal. The vertices of way ``i``
+    in node order are ``way_vertices[way_offsets[i]:way_offsets[i + 1]]``.
+    """
+
+    def __init__(self, records: Dict[int, WayRecord], revision: int):
+        self.revision = revision
+        way_ids = sorted(records)
+        self.ways = [records[way_id][0] for way_id in way_ids]
+        self.way_ids = np.array(way_ids, dtype=np.int64)
+        self.way_positions = {way_id: i for i, way_id in enumerate(way_ids)}
+        self.names = [way[5] for way in self.ways]
+        self.oneway = np.array([is_oneway(way[4], way[3]) for way in self.ways], dtype=bool)
+        self.lanes = np.array([_direction_lanes(way) for way in self.ways], dtype=np.int32).reshape(-1, 2)
+
+        counts = np.array([len(records[way_id][1]) for way_id in way_ids], dtype=np.int64)
+        node_ids = np.concatenate([records[w][1] for w in way_ids] or [np.empty(0, dtype=np.int64)])
+        lats = np.concatenate([records[w][2] for w in way_ids] or [np.empty(0)])
+        lons = np.concatenate([records[w][3] for w in way_ids] or [np.empty(0)])
+        owner = np.repeat(np.arange(len(way_ids), dtype=np.int32), counts)
+
+        self.node_ids = np.unique(node_ids)
+        vertex = np.searchsorted(self.node_ids, node_ids)
+        self.lat = np.empty(len(self.node_ids))
+        self.lon = np.empty(len(self.node_ids))
+        self.lat[vertex] = lats
+        self.lon[vertex] = lons
+        ends = np.cumsum(counts)
+        self.way_vertices = vertex
+        self.way_offsets = np.concatenate(([0], ends)).astype(np.int64)
+        has_nodes = counts > 0
+        # Entry and exit vertex of each way, -1 for ways without nodes
+        self.way_first = np.full(len(way_ids), -1, dtype=np.int64)
+        self.way_last = np.full(len(way_ids), -1, dtype=np.int64)
+        self.way_first[has_nodes] = vertex[(ends - counts)[has_nodes]]
+        self.way_last[has_nodes] = vertex[ends[has_nodes] - 1]
+
+        pair = owner[:-1] == owner[1:]
+        src, dst, way = vertex[:-1][pair], vertex[1:][pair], owner[:-1][pair]
+        length = haversine_m(lats[:-1][pair], lons[:-1][pair], lats[1:][pair], lons[1:][pair])
+        self.way_length = np.bincount(way, weights=length, minlength=len(way_ids))
+
+        back = ~self.oneway[way]
+        src, dst = np.concatenate((src, dst[back])), np.concatenate((dst, src[back]))
+        edge_lanes = np.concatenate((self.lanes[way, 0], self.lanes[way[back], 1]))
+        edge_forward = np.arange(len(way) + int(back.sum())) < len(way)
+        way = np.concatenate((way, way[back]))
+        length = np.concatenate((length, length[back]))
+
+        order = np.argsort(src, kind='stable')
+        self.sources = src[order]
+        self.targets = dst[order]
+        self.edge_way = way[order]
+        self.edge_forward = edge_forward[order]
+        self.edge_length = length[order]
+        self.edge_lanes = edge_lanes[order]
+        self.indptr = self._indptr(self.sources)
+        self.rev_edges = np.argsort(self.targets, kind='stable')
+        self.rev_indptr = self._indptr(self.targets[self.rev_edges])
+
+    def _indptr(self, sorted_vertices: np.ndarray) -> np.ndarray:
+        indptr = np.zeros(len(self.node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sorted_vertices, minlength=len(self.node_ids)), out=indptr[1:])
+        return indptr
+
+    def vertices(self, position: int) -> np.ndarray:
+        return self.way_vertices[self.way_offsets[position]:self.way_offsets[position + 1]]
+
+    def search(
+        self,
+        start: int,
+        forward: bool,
+        skip_way: int,
+        max_distance: Optional[float],
+        limit: Optional[int],
+        name: Any,
+    ) -> List[ReachedWay]:
+        """Dijkstra from vertex ``start``, recording where each way is first reached."""
+        distances = {start: 0.0}
+        heap = [(0.0, start)]
+        reached = {}
+        while heap:
+            distance, v = heapq.heappop(heap)
+            if distance > distances[v]:
+                continue
+            if max_distance is not None and distance > max_distance:
+                break
+            if limit is not None and len(reached) >= limit:
+                break
+            if forward:
+                edges = range(self.indptr[v], self.indptr[v + 1])
+                neighbors = self.targets
+            else:
+                edges = self.rev_edges[self.rev_indptr[v]:self.rev_indptr[v + 1]]
+                neighbors = self.sources
+            for e in edges:
+                way = self.edge_way[e]
+                # The start way is not part of its own neighbourhood, and paths
+                # that loop back through it would report the wrong distances
+                if way == skip_way:
+                    continue
+                if name is not None and self.names[way] != name:
+                    continue
+                if way not in reached:
+                    reached[way] = ReachedWay(int(self.way_ids[way]), distance, int(self.node_ids[v]))
+                next_distance = distance + self.edge_length[e]
+                n = neighbors[e]
+                if next_distance < distances.get(n, float('inf')):
+                    distances[n] = next_distance
+                    heapq.heappush(heap, (next_distance, n))
+        results = list(reached.values())
+        return results[:limit] if limit is not None else results
+
+
+class RoadGraph:
+    """
+    Directed graph of ways joined at shared nodes, for upstream/downstream
+    traversal and ordering ways into chains.
+
+    Built from ``ways``/``way_nodes`` into CSR arrays (see ``_Topology``).
+    As a change listener it only records which ways a load or diff touched;
+    a background thread waits ``debounce`` seconds for more changes, re-reads
+    those ways from the database and rebuilds the arrays. The rebuild is a
+    full one, off the ingest path: readers keep the previous graph until
+    the new one is swapped in, and ``flush`` applies pending changes now.
+    """
+
+    def __init__(self, db_manager: DatabaseManager, listen: bool = True, debounce: float = 1.0):
+        self.db_manager = db_manager
+        self.debounce = debounce
+        self._records = {}
+        self._state = _Topology({}, revision=-1)
+        self._lock = threading.RLock()
+        self._refresh_thread = None
+        self._stop = threading.Event()
+        # Way IDs changed since the last rebuild, or None to reload everything
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._changed = threading.Event()
+        self._rebuild_thread = None
+        if listen:
+            db_manager.add_change_listener(self.apply_changes)
+
+    @property
+    def revision(self) -> int:
+        return self._state.revision
+
+    @property
+    def topology(self) -> _Topology:
+        return self._state
+
+    def load(self) -> None:
+        """Build the graph from the full network in the database."""
+        with self._lock:
+            revision = self.db_manager.get_network_revision()
+            self._records = way_records(*self.db_manager.get_way_topology())
+            self._state = _Topology(self._records, revision)
+
+    def load_columns(self, batch: OSMColumns, revision: int = 0) -> None:
+        """Build the graph from a parsed batch or snapshot instead of the database."""
+        with self._lock:
+            self._records = column_records(batch)
+            self._state = _Topology(self._records, revision)
+
+    def apply_changes(self, way_ids: Optional[Set[int]]) -> None:
+        """
+        Change listener: queue ``way_ids`` (None for everything) for the background rebuild.
+
+        Returns at once; the graph reflects the changes after the rebuild.
+        """
+        if self._state.revision < 0:
+            # Not loaded yet; ensure_loaded reads the whole network
+            return
+        self._queue(way_ids)
+        with self._pending_lock:
+            if self._rebuild_thread is None:
+                self._rebuild_thread = threading.Thread(target=self._rebuild, name='road-graph-rebuild', daemon=True)
+                self._rebuild_thread.start()
+        self._changed.set()
+
+    def _queue(self, way_ids: Optional[Set[int]]) -> None:
+        with self._pending_lock:
+            if way_ids is None or self._pending is None:
+                self._pending = None
+            else:
+                self._pending |= way_ids
+
+    def _rebuild(self) -> None:
+        while True:
+            self._changed.wait()
+            # Let a burst of diffs settle into one rebuild
+            time.sleep(self.debounce)
+            self._changed.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Road graph rebuild failed: {e}")
+
+    def flush(self) -> None:
+        """
+        Apply queued changes now: re-read the changed ways and rebuild.
+
+        Ways that no longer exist in the database are removed. On failure
+        the changes stay queued for the next rebuild.
+        """
+        with self._lock:
+            with self._pending_lock:
+                way_ids, self._pending = self._pending, set()
+            try:
+                if way_ids is None:
+                    self.load()
+                elif way_ids and self._state.revision >= 0:
+                    revision = self.db_manager.get_network_revision()
+                    ways, way_nodes = self.db_manager.get_way_topology(way_ids)
+                    records = dict(self._records)
+                    for way_id in way_ids:
+                        records.pop(way_id, None)
+                    records.update(way_records(ways, way_nodes))
+                    self._records = records
+                    self._state = _Topology(records, revision)
+            except Exception:
+                self._queue(way_ids)
+                raise
+
+    def ensure_loaded(self) -> None:
+        """Load the graph on first use."""
+        with self._lock:
+            if self._state.revision < 0:
+                self.load()
+
+    def refresh(self) -> bool:
+        """Reload the graph if the network revision changed. Returns True if reloaded."""
+        if self._state.revision < 0:
+            # Never loaded; ensure_loaded builds it on demand
+            return False
+        if self.db_manager.get_network_revision() == self._state.revision:
+            return False
+        self.load()
+        return True
+
+    def start_auto_refresh(self, interval: float = 30.0) -> None:
+        """Poll the network revision every ``interval`` seconds, for changes made by other processes."""
+        if self._refresh_thread is not None:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Road graph refresh failed: {e}")
+
+        self._refresh_thread = threading.Thread(target=run, name='road-graph-refresh', daemon=True)
+        self._refresh_thread.start()
+
+    def stop_auto_refresh(self) -> None:
+        self._stop.set()
+        if self._refresh_thread is not None:
+            self._refresh_thread.join()
+            self._refresh_thread = None
+
+    def stats(self) -> Dict[str, int]:
+        state = self._state
+        return {
+            'revision': state.revision,
+            'ways': len(state.ways),
+            'nodes': len(state.node_ids),
+            'edges': len(state.targets),
+        }
+
+    def __contains__(self, way_id: int) -> bool:
+        return way_id in self._state.way_positions
+
+    def way(self, way_id: int) -> Tuple[Any, ...]:
+        """(way_id, lanes, lanes_forward, lanes_backward, highway_type, name, maxspeed) of a way."""
+        state = self._state
+        return state.ways[state.way_positions[way_id]]
+
+    def way_length(self, way_id: int) -> float:
+        """Length of a way in meters."""
+        state = self._state
+        return float(state.way_length[state.way_positions[way_id]])
+
+    def downstream(
+        self,
+        way_id: int,
+        max_distance: Optional[float] = None,
+        limit: Optional[int] = None,
+        same_name: bool = False,
+    ) -> List[ReachedWay]:
+        """
+        Ways reachable by driving on from the end of ``way_id``, nearest first.
+
+        ``distance`` is measured in meters from the end of ``way_id`` to the
+        node where each way is entered. Raises KeyError for an unknown way.
+
+        Args:
+            way_id: Way to start from, traveled in its node order
+            max_distance: Stop searching beyond this many meters
+            limit: Return at most this many ways
+            same_name: Only follow ways with the same name as ``way_id``
+        """
+        return self._traverse(way_id, True, max_distance, limit, same_name)
+
+    def upstream(
+        self,
+        way_id: int,
+        max_distance: Optional[float] = None,
+        limit: Optional[int] = None,
+        same_name: bool = False,
+    ) -> List[ReachedWay]:
+        """Ways that lead into the start of ``way_id``, nearest first. See ``downstream``."""
+        return self._traverse(way_id, False, max_distance, limit, same_name)
+
+    def _traverse(
+        self, way_id: int, forward: bool, max_distance: Optional[float], limit: Optional[int], same_name: bool
+    ) -> List[ReachedWay]:
+        state = self._state
+        position = state.way_positions[way_id]
+        start = state.way_last[position] if forward else state.way_first[position]
+        if start < 0:
+            return []
+        name = state.names[position] if same_name else None
+        return state.search(int(start), forward, position, max_distance, limit, name)
+
+    def corridor(
+        self,
+        way_id: int,
+        lat: float,
+        lon: float,
+        heading: Optional[float] = None,
+        distance: float = 5000.0,
+        max_ways: int = 500,
+    ) -> List[CorridorWay]:
+        """
+        The road ahead of a position on ``way_id``, in driving order.
+
+        The position is projected onto the way, which is traveled in the
+        direction closest to ``heading`` (compass degrees; node order if
+        None or if the way is one-way). At every junction the corridor
+        continues on a way with the same name if there is one, else on the
+        smallest turn, until it covers ``distance`` meters or reaches a dead
+        end. The first way starts at the projected position and the last
+        one is included whole. Raises KeyError for an unknown way.
+        """
+        state = self._state
+        position = state.way_positions[way_id]
+        vertices = state.vertices(position)
+        if len(vertices) < 2:
+            return []
+        i, start_lat, start_lon = project_onto_line(state.lat[vertices], state.lon[vertices], lat, lon)
+        forward = True
+        if heading is not None and not state.oneway[position]:
+            a, b = vertices[i], vertices[i + 1]
+            forward = turn_angle(heading, bearing(state.lat[a], state.lon[a], state.lat[b], state.lon[b])) <= 90
+        path = vertices[i + 1:] if forward else vertices[i::-1]
+        start = [(start_lat, start_lon)]
+
+        corridor = []
+        covered = 0.0
+        visited = set()
+        while True:
+            lats = np.concatenate(([p[0] for p in start], state.lat[path]))
+            lons = np.concatenate(([p[1] for p in start], state.lon[path]))
+            length = float(haversine_m(lats[:-1], lons[:-1], lats[1:], lons[1:]).sum())
+            lanes = int(state.lanes[position, 0 if forward else 1])
+            corridor.append(CorridorWay(
+                int(state.way_ids[position]), forward, covered, covered + length,
+                None if lanes == MISSING else lanes, np.column_stack((lats, lons)).tolist(),
+            ))
+            visited.add(position)
+            covered += length
+            if covered >= distance or len(corridor) >= max_ways:
+                break
+
+            exit_vertex = path[-1]
+            heading = bearing(lats[-2], lons[-2], lats[-1], lons[-1])
+            name = state.names[position]
+            best = None
+            for e in range(state.indptr[exit_vertex], state.indptr[exit_vertex + 1]):
+                way = state.edge_way[e]
+                if way in visited:
+                    continue
+                target = state.targets[e]
+                turn = turn_angle(heading, bearing(
+                    state.lat[exit_vertex], state.lon[exit_vertex], state.lat[target], state.lon[target]
+                ))
+                key = (name is None or state.names[way] != name, turn)
+                if best is None or key < best[0]:
+                    best = (key, e)
+            if best is None:
+                break
+
+            e = best[1]
+            position, forward = int(state.edge_way[e]), bool(state.edge_forward[e])
+            vertices = state.vertices(position)
+            # The index of the junction in the next way, where this edge leaves it
+            step = 1 if forward else -1
+            candidates = np.flatnonzero(vertices == exit_vertex)
+            index = next(
+                int(c) for c in candidates
+                if 0 <= c + step < len(vertices) and vertices[c + step] == state.targets[e]
+            )
+            path = vertices[index + 1:] if forward else vertices[index - 1::-1]
+            start = [(state.lat[exit_vertex], state.lon[exit_vertex])]
+        return corridor
+
+    def chains(self, way_ids: Sequence[int]) -> List[List[int]]:
+        """
+        Order ways, such as the members of a route relation, into connected chains.
+
+        Each chain follows the direction of travel: every way starts where
+        the previous one ends (two-way ways may also be entered from their
+        end). Where a chain forks, a way with the same name is preferred.
+        Chains start at ways nothing else in ``way_ids`` leads into; ways
+        unknown to the graph are left out.
+        """
+        state = self._state
+        members = list(dict.fromkeys(
+            state.way_positions[way_id] for way_id in way_ids if way_id in state.way_positions
+        ))
+        # Vertex -> (member, enters at its first node), in input order
+        entries = {}
+        for position in members:
+            if state.way_first[position] < 0:
+                continue
+            entries.setdefault(state.way_first[position], []).append((position, True))
+            if not state.oneway[position]:
+                entries.setdefault(state.way_last[position], []).append((position, False))
+        exits = {state.way_last[position] for position in members}
+        starts = [position for position in members if state.way_first[position] not in exits]
+
+        visited = set()
+        chains = []
+        for first in starts + members:
+            if first in visited:
+                continue
+            chain = []
+            position, forward = first, True
+            while position is not None:
+                visited.add(position)
+                chain.append(int(state.way_ids[position]))
+                exit_vertex = state.way_last[position] if forward else state.way_first[position]
+                candidates = [
+                    entry for entry in entries.get(exit_vertex, ()) if entry[0] not in visited
+                ]
+                name = state.names[position]
+                candidates.sort(key=lambda entry: state.names[entry[0]] != name)
+                position, forward = candidates[0] if candidates else (None, True)
+            chains.append(chain)
+        return chains